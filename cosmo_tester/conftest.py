@@ -1,6 +1,12 @@
 import pytest
 from path import Path
 
+from cosmo_tester.framework import (
+    fixture_profile,
+    manager_reset,
+    timeline,
+    vm_scheduling,
+)
 from cosmo_tester.framework.config import load_config
 from cosmo_tester.framework.logger import get_logger
 from cosmo_tester.framework.test_hosts import Hosts, VM
@@ -31,6 +37,18 @@ def session_tmpdir(request, tmpdir_factory, session_logger):
     return temp_dir
 
 
+@pytest.fixture(scope='session', autouse=True)
+def provisioning_timeline(session_tmpdir, session_logger):
+    """Record how long each phase of creating and destroying test hosts
+    takes, and report what the session spent its time waiting for.
+    """
+    yield timeline.TIMELINE
+    timeline_path = session_tmpdir / 'timeline.json'
+    timeline.TIMELINE.dump(timeline_path)
+    session_logger.info('Wrote provisioning timeline to %s', timeline_path)
+    session_logger.info('%s', timeline.TIMELINE.report())
+
+
 @pytest.fixture(scope='session')
 def ssh_key(session_tmpdir, session_logger):
     key = SSHKey(session_tmpdir, session_logger)
@@ -46,6 +64,59 @@ def pytest_addoption(parser):
         default='test_config.yaml',
         help='Location of the test config.',
     )
+    parser.addoption(
+        '--fixture-profile',
+        action='store',
+        nargs='?',
+        const=fixture_profile.DEFAULT_REPORT_PATH,
+        default=None,
+        metavar='PATH',
+        help='Record how long each fixture takes to set up and tear down, '
+             'and which tests used it. The report is written to PATH '
+             '(default: {}) and summarised at the end of the '
+             'session.'.format(fixture_profile.DEFAULT_REPORT_PATH),
+    )
+    parser.addoption(
+        '--vm-scheduling',
+        action='store_true',
+        default=False,
+        help='When running with xdist, send tests using the same session '
+             'VMs to the same worker, and start the longest running groups '
+             'of tests first.',
+    )
+    parser.addoption(
+        '--vm-quota',
+        action='store',
+        type=int,
+        default=0,
+        help='With --vm-scheduling, the most VMs to have at once across all '
+             'workers (0 for no limit).',
+    )
+
+
+def pytest_configure(config):
+    report_path = config.getoption('--fixture-profile')
+    if report_path:
+        config.pluginmanager.register(
+            fixture_profile.FixtureProfiler(config, report_path),
+            'fixture_profile',
+        )
+    if config.getoption('--vm-scheduling'):
+        config.pluginmanager.register(
+            vm_scheduling.DurationRecorder(config), 'test_durations',
+        )
+
+
+def pytest_collection_modifyitems(config, items):
+    if config.getoption('--vm-scheduling'):
+        vm_scheduling.record_shapes(config, items)
+
+
+@pytest.hookimpl(optionalhook=True)
+def pytest_xdist_make_scheduler(config, log):
+    if config.getoption('--vm-scheduling'):
+        return vm_scheduling.VMShapeScheduling(config, log)
+    return None
 
 
 @pytest.fixture(scope='session')
@@ -94,10 +165,19 @@ def session_manager(request, ssh_key, session_tmpdir, test_config,
 
 
 @pytest.fixture(scope='function')
-def image_based_manager(session_manager):
-    session_manager.bootstrap()
+def image_based_manager(request, session_manager, test_config,
+                        session_logger):
+    reset = test_config['test_manager']['reset_between_tests']
+    if not (reset and manager_reset.reuse_install(session_manager,
+                                                  session_logger)):
+        session_manager.bootstrap()
     yield session_manager
-    session_manager.teardown()
+    if request.node.get_closest_marker('mutates_manager'):
+        reset = False
+    if not (reset and manager_reset.keep_install(session_manager,
+                                                 test_config,
+                                                 session_logger)):
+        session_manager.teardown()
 
 
 @pytest.fixture(scope='function')
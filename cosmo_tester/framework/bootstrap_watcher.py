@@ -0,0 +1,163 @@
+from collections import deque
+import shlex
+import socket
+import time
+
+from paramiko.ssh_exception import SSHException
+
+BOOTSTRAP_COMPLETE_MARKER = '/tmp/bootstrap_complete'
+BOOTSTRAP_FAILED_MARKER = '/tmp/bootstrap_failed'
+BOOTSTRAP_LOGS_DIR = '/tmp/bs_logs'
+
+_DONE = '##COSMO_BOOTSTRAP_DONE##'
+_FAILED = '##COSMO_BOOTSTRAP_FAILED##'
+# Followed by the number of lines of a log printed so far, and its path
+_OFFSET = '##COSMO_BOOTSTRAP_OFFSET##'
+# How many of the latest log lines to show if the bootstrap fails
+FAILURE_LOG_LINES = 50
+
+# Runs on the node for as long as the bootstrap does, printing only log
+# lines it hasn't printed before and finally one of the result markers.
+# After the new lines of each log it prints how many lines of that log have
+# been printed, so that a watcher started after a lost connection can carry
+# on from there.
+# It waits on inotify events where available so that completion is noticed
+# almost immediately, falling back to checking every second.
+_WATCH_SCRIPT = r'''
+emit_new_lines() {
+  for log in %(logs)s/*; do
+    [[ -f "$log" ]] || continue
+    total=$(wc -l < "$log")
+    previous=${seen[$log]:-0}
+    if (( total > previous )); then
+      tail -n +$((previous + 1)) "$log" | head -n $((total - previous)) \
+        | sed "s|^|$(basename "$log"): |"
+      seen[$log]=$total
+      echo "%(offset_marker)s $total $log"
+    fi
+  done
+}
+while true; do
+  # Check the state before reading the logs so that we don't miss any
+  # lines written just before the bootstrap finished.
+  state=running
+  [[ -f %(complete)s ]] && state=done
+  [[ -f %(failed)s ]] && state=failed
+  emit_new_lines
+  case $state in
+    done) echo '%(done_marker)s'; exit 0;;
+    failed) echo '%(failed_marker)s'; exit 0;;
+  esac
+  # To aid in troubleshooting (e.g. where a VM runs commands too slowly)
+  date > /tmp/cfy_mgr_last_check_time
+  if command -v inotifywait >/dev/null 2>&1; then
+    inotifywait -qq -t 1 -e create -e modify -e close_write \
+      /tmp %(logs)s >/dev/null 2>&1
+    # 2 is a timeout, 1 is an error (e.g. the logs dir doesn't exist yet)
+    [[ $? -eq 1 ]] && sleep 1
+  else
+    sleep 1
+  fi
+done
+''' % {
+    'logs': BOOTSTRAP_LOGS_DIR,
+    'complete': BOOTSTRAP_COMPLETE_MARKER,
+    'failed': BOOTSTRAP_FAILED_MARKER,
+    'done_marker': _DONE,
+    'failed_marker': _FAILED,
+    'offset_marker': _OFFSET,
+}
+
+
+class BootstrapTimeout(Exception):
+    """Bootstrap did not finish in the allowed time."""
+
+
+def _watch_script(offsets):
+    """The watch script, starting from the given number of lines already
+    printed of each log.
+    """
+    return '\n'.join(
+        ['declare -A seen']
+        + ['seen[{}]={:d}'.format(shlex.quote(log), lines)
+           for log, lines in sorted(offsets.items())]
+    ) + _WATCH_SCRIPT
+
+
+def _watch_once(node, logger, deadline, offsets, recent):
+    """Watch a bootstrap over one channel.
+
+    :param offsets: How many lines of each log have been printed, which is
+                    updated as more are.
+    :param recent: A deque, to which each log line is appended.
+    """
+    name = getattr(node, 'friendly_name', node.ip_address)
+    with node.ssh() as fabric_ssh:
+        channel = fabric_ssh.client.get_transport().open_session()
+        # Don't block forever on recv, so that we can enforce the deadline
+        channel.settimeout(5)
+        channel.exec_command(
+            'bash -c {}'.format(shlex.quote(_watch_script(offsets))))
+        pending = b''
+        try:
+            while True:
+                try:
+                    data = channel.recv(32 * 1024)
+                except socket.timeout:
+                    if deadline and time.time() > deadline:
+                        raise BootstrapTimeout(
+                            'Bootstrap of {} did not finish in '
+                            'time.'.format(name)
+                        )
+                    continue
+                if not data:
+                    raise SSHException(
+                        'Bootstrap watcher for {} exited without a '
+                        'result.'.format(name)
+                    )
+                lines = (pending + data).split(b'\n')
+                pending = lines.pop()
+                for line in lines:
+                    line = line.decode('utf-8', 'replace')
+                    if line == _DONE:
+                        return True
+                    elif line == _FAILED:
+                        return False
+                    elif line.startswith(_OFFSET + ' '):
+                        _, lines, log = line.split(' ', 2)
+                        offsets[log] = int(lines)
+                        continue
+                    recent.append(line)
+                    logger.debug('[%s] %s', name, line)
+        finally:
+            channel.close()
+
+
+def watch_bootstrap(node, logger, timeout=None, attempts=3):
+    """Wait for a bootstrap started on node to finish, logging new lines
+    from the bootstrap logs at debug level as they are written, and the
+    latest of them if the bootstrap fails.
+    One long-lived SSH channel is used for the whole wait. If the
+    connection is lost it will be re-established up to `attempts` times,
+    carrying on from the last lines that were logged.
+
+    :return: True if the bootstrap succeeded, False if it failed.
+    """
+    deadline = time.time() + timeout if timeout else None
+    offsets = {}
+    recent = deque(maxlen=FAILURE_LOG_LINES)
+    for attempt in range(1, attempts + 1):
+        try:
+            succeeded = _watch_once(node, logger, deadline, offsets, recent)
+            if not succeeded:
+                logger.error(
+                    'Last bootstrap log lines from %s:\n%s',
+                    node.ip_address, '\n'.join(recent),
+                )
+            return succeeded
+        except (SSHException, EOFError, socket.error) as err:
+            if attempt == attempts:
+                raise
+            logger.warning('Lost bootstrap watcher connection to %s, '
+                           'reconnecting: %s', node.ip_address, err)
+            time.sleep(3)
@@ -0,0 +1,161 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+
+from cosmo_tester.framework import util
+
+CERT_FILE = 'cert.pem'
+KEY_FILE = 'key.pem'
+META_FILE = 'meta.json'
+# Don't hand out certificates that would expire during a test run
+MIN_VALIDITY = 24 * 60 * 60
+
+
+def _digest(*parts):
+    return hashlib.sha256(
+        '\n'.join(str(part) for part in parts).encode('utf-8')
+    ).hexdigest()
+
+
+class CertCache(object):
+    """Certificates and their keys, kept on disk between test sessions.
+
+    Each entry is a directory named for the hash of what the certificate
+    is for, which is moved into place once complete so that sessions and
+    xdist workers sharing the cache never see partial entries.
+    Entries are evicted once they are older than max_age, close to expiry,
+    or (least recently used first) when there are more than max_entries.
+    """
+    def __init__(self, test_config, logger):
+        config = test_config['cert_cache']
+        self._logger = logger
+        self._directory = os.path.expanduser(config['directory'])
+        self._max_age = config['max_age']
+        self._max_entries = config['max_entries']
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def ca_key(identity):
+        """The cache key for the CA of a cluster.
+
+        :param identity: Things identifying the cluster, e.g. the addresses
+                         of all of its nodes.
+        """
+        return 'ca-' + _digest(*sorted(str(item) for item in identity))
+
+    @staticmethod
+    def cert_key(ca_cert_path, cn, ips):
+        """The cache key for a certificate signed by the given CA."""
+        with open(ca_cert_path, 'rb') as ca_handle:
+            ca_identity = hashlib.sha256(ca_handle.read()).hexdigest()
+        alt_names = sorted(
+            name for name in util._format_ips(ips).split(',') if name
+        )
+        return _digest(ca_identity, cn, *alt_names)
+
+    def _entry_path(self, key):
+        return os.path.join(self._directory, key)
+
+    def _usable(self, meta, now):
+        if now - meta['created_at'] > self._max_age:
+            return False
+        expires = meta.get('expires_at')
+        return expires is None or expires - now > MIN_VALIDITY
+
+    def fetch(self, key, cert_path, key_path):
+        """Copy a cached certificate and its key to the given paths.
+
+        :return: True if the certificate was cached, False otherwise.
+        """
+        entry = self._entry_path(key)
+        try:
+            with open(os.path.join(entry, META_FILE)) as meta_handle:
+                meta = json.load(meta_handle)
+            if not self._usable(meta, time.time()):
+                self.misses += 1
+                return False
+            shutil.copyfile(os.path.join(entry, CERT_FILE), cert_path)
+            shutil.copyfile(os.path.join(entry, KEY_FILE), key_path)
+            # Record the use, for least recently used eviction
+            os.utime(os.path.join(entry, META_FILE), None)
+        except (IOError, OSError, ValueError):
+            self.misses += 1
+            return False
+        os.chmod(key_path, 0o600)
+        self.hits += 1
+        return True
+
+    def store(self, key, cert_path, key_path, expires_at=None):
+        """Add a certificate and its key to the cache.
+
+        :param expires_at: When the certificate expires, as a timestamp.
+        """
+        if not os.path.isdir(self._directory):
+            os.makedirs(self._directory)
+        tmp_entry = tempfile.mkdtemp(dir=self._directory, prefix='.entry_')
+        try:
+            shutil.copyfile(cert_path, os.path.join(tmp_entry, CERT_FILE))
+            shutil.copyfile(key_path, os.path.join(tmp_entry, KEY_FILE))
+            os.chmod(os.path.join(tmp_entry, KEY_FILE), 0o600)
+            with open(os.path.join(tmp_entry, META_FILE), 'w') as meta_handle:
+                json.dump({'created_at': time.time(),
+                           'expires_at': expires_at}, meta_handle)
+            entry = self._entry_path(key)
+            # Replace any stale entry; if another session stores the same
+            # entry first then theirs is kept instead.
+            shutil.rmtree(entry, ignore_errors=True)
+            os.rename(tmp_entry, entry)
+        except OSError as err:
+            self._logger.warning('Could not cache certificate %s: %s',
+                                 cert_path, err)
+        finally:
+            shutil.rmtree(tmp_entry, ignore_errors=True)
+
+    def evict(self):
+        """Remove expired entries, and the least recently used ones if the
+        cache is too large.
+        """
+        if not os.path.isdir(self._directory):
+            return
+        now = time.time()
+        entries = []
+        for name in os.listdir(self._directory):
+            entry = self._entry_path(name)
+            meta_path = os.path.join(entry, META_FILE)
+            try:
+                with open(meta_path) as meta_handle:
+                    meta = json.load(meta_handle)
+                last_used = os.path.getmtime(meta_path)
+            except (IOError, OSError, ValueError):
+                # Incomplete entries that were abandoned by their sessions
+                # are removed once they are old enough to be safe to remove
+                try:
+                    if now - os.path.getmtime(entry) > 60 * 60:
+                        self._remove(entry)
+                except OSError:
+                    # Already removed by another session
+                    pass
+                continue
+            if self._usable(meta, now):
+                entries.append((last_used, entry))
+            else:
+                self._remove(entry)
+
+        entries.sort(reverse=True)
+        for _, entry in entries[self._max_entries:]:
+            self._remove(entry)
+
+    def _remove(self, entry):
+        shutil.rmtree(entry, ignore_errors=True)
+        self.evictions += 1
+
+    def __str__(self):
+        return '{hits} hits, {misses} misses, {evictions} evictions'.format(
+            hits=self.hits, misses=self.misses, evictions=self.evictions,
+        )
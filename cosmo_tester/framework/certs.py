@@ -0,0 +1,302 @@
+from collections import namedtuple
+from datetime import datetime, timedelta
+import ipaddress
+import logging
+from queue import Empty, Queue
+import threading
+import time
+
+try:
+    from cryptography import x509
+    from cryptography.hazmat.backends import default_backend
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa
+    from cryptography.x509.oid import NameOID
+except ImportError:
+    x509 = None
+
+from cosmo_tester.framework import util
+
+KEY_SIZE = 2048
+VALID_DAYS = 3650
+# Enough keys for our largest clusters, plus their load balancer and CA
+DEFAULT_POOL_SIZE = 12
+
+CertRequest = namedtuple('CertRequest', ['ips', 'cn', 'cert_path',
+                                         'key_path'])
+
+_KEY_POOL = None
+_KEY_POOL_LOCK = threading.Lock()
+
+
+def _new_key():
+    return rsa.generate_private_key(
+        public_exponent=65537,
+        key_size=KEY_SIZE,
+        backend=default_backend(),
+    )
+
+
+class KeyPool(object):
+    """RSA keys generated ahead of time by a background thread, as key
+    generation is by far the slowest part of creating a certificate.
+    If the pool is empty when a key is wanted, one is generated on the spot.
+    """
+    def __init__(self, size=DEFAULT_POOL_SIZE):
+        self._keys = Queue(maxsize=size)
+        self.hits = 0
+        self.misses = 0
+        self._thread = threading.Thread(target=self._fill,
+                                        name='cert_key_pool')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _fill(self):
+        while True:
+            # This blocks while the pool is full
+            self._keys.put(_new_key())
+
+    def get(self):
+        try:
+            key = self._keys.get_nowait()
+            self.hits += 1
+        except Empty:
+            key = _new_key()
+            self.misses += 1
+        return key
+
+    def __str__(self):
+        return '{hits} pooled keys used, {misses} generated on demand'.format(
+            hits=self.hits, misses=self.misses,
+        )
+
+
+def available():
+    """Whether certificates can be generated without calling openssl."""
+    return x509 is not None
+
+
+def _use_openssl(use_openssl, logger):
+    """Whether to generate certificates with the openssl command, warning
+    if that's only because cryptography can't be imported, as it is much
+    slower.
+    """
+    if use_openssl:
+        return True
+    if not available():
+        logger.warning('cryptography could not be imported, falling back '
+                       'to generating certificates with openssl.')
+        return True
+    return False
+
+
+def start_key_pool():
+    """Start generating keys in the background, if we can.
+    Call this well before certificates will be needed, e.g. while test VMs
+    are being created.
+    """
+    global _KEY_POOL
+    if not available():
+        return None
+    with _KEY_POOL_LOCK:
+        if _KEY_POOL is None:
+            _KEY_POOL = KeyPool()
+        return _KEY_POOL
+
+
+def _alt_names(ips):
+    """The subjectAltNames for a certificate, as used by the openssl path
+    (see util._format_ips).
+    """
+    alt_names = []
+    for entry in util._format_ips(ips).split(','):
+        if not entry:
+            continue
+        kind, _, value = entry.partition(':')
+        if kind == 'IP':
+            alt_names.append(
+                x509.IPAddress(ipaddress.ip_address(u'{}'.format(value))))
+        else:
+            alt_names.append(x509.DNSName(u'{}'.format(value)))
+    return alt_names
+
+
+def _write_key(key, path):
+    with open(path, 'wb') as key_handle:
+        key_handle.write(key.private_bytes(
+            encoding=serialization.Encoding.PEM,
+            format=serialization.PrivateFormat.PKCS8,
+            encryption_algorithm=serialization.NoEncryption(),
+        ))
+
+
+def _write_cert(cert, path):
+    with open(path, 'wb') as cert_handle:
+        cert_handle.write(cert.public_bytes(serialization.Encoding.PEM))
+
+
+def _name(cn):
+    return x509.Name([x509.NameAttribute(NameOID.COMMON_NAME,
+                                         u'{}'.format(cn))])
+
+
+def _builder(subject, issuer, public_key):
+    now = datetime.utcnow()
+    return x509.CertificateBuilder().subject_name(
+        subject,
+    ).issuer_name(
+        issuer,
+    ).public_key(
+        public_key,
+    ).serial_number(
+        x509.random_serial_number(),
+    ).not_valid_before(
+        now,
+    ).not_valid_after(
+        now + timedelta(days=VALID_DAYS),
+    )
+
+
+def _expiry():
+    return time.time() + VALID_DAYS * 24 * 60 * 60
+
+
+def generate_ca_cert(ca_cert_path, ca_key_path, use_openssl=False,
+                     cache=None, identity=None, logger=logging):
+    """Generate a self-signed CA cert and its key.
+
+    :param use_openssl: Use the openssl command even if certificates could
+                        be generated in process.
+    :param cache: A CertCache to reuse the CA from, if identity is given.
+    :param identity: Things identifying what the CA is for, e.g. the
+                     addresses of the nodes of a cluster.
+    """
+    cache_key = None
+    if cache and identity:
+        cache_key = cache.ca_key(identity)
+        if cache.fetch(cache_key, ca_cert_path, ca_key_path):
+            return
+    _generate_ca_cert(ca_cert_path, ca_key_path, use_openssl, logger)
+    if cache_key:
+        cache.store(cache_key, ca_cert_path, ca_key_path, _expiry())
+
+
+def _generate_ca_cert(ca_cert_path, ca_key_path, use_openssl, logger):
+    if _use_openssl(use_openssl, logger):
+        return util.generate_ca_cert(ca_cert_path, ca_key_path)
+
+    key = start_key_pool().get()
+    name = _name('cosmo_tester_ca')
+    cert = _builder(name, name, key.public_key()).add_extension(
+        x509.BasicConstraints(ca=True, path_length=None), critical=True,
+    ).add_extension(
+        x509.SubjectKeyIdentifier.from_public_key(key.public_key()),
+        critical=False,
+    ).add_extension(
+        x509.AuthorityKeyIdentifier.from_issuer_public_key(
+            key.public_key()),
+        critical=False,
+    ).sign(key, hashes.SHA256(), default_backend())
+    _write_key(key, ca_key_path)
+    _write_cert(cert, ca_cert_path)
+
+
+def generate_ssl_certificates(cert_requests,
+                              sign_cert=None,
+                              sign_key=None,
+                              sign_key_password=None,
+                              use_openssl=False,
+                              cache=None,
+                              logger=logging):
+    """Generate several certificates and their keys at once, all signed by
+    the same CA (or each self-signed if no CA is given).
+    Certificates match those made by util.generate_ssl_certificate.
+
+    :param cert_requests: A list of CertRequest.
+    :param sign_cert: Path to the signing cert.
+    :param sign_key: Path to the signing cert's key.
+    :param use_openssl: Use the openssl command even if certificates could
+                        be generated in process.
+    :param cache: A CertCache to reuse signed certificates from.
+    """
+    if not (cache and sign_cert and sign_key):
+        _generate_ssl_certificates(cert_requests, sign_cert, sign_key,
+                                   sign_key_password, use_openssl, logger)
+        return
+
+    missing = []
+    for request in cert_requests:
+        cache_key = cache.cert_key(sign_cert, request.cn, request.ips)
+        if not cache.fetch(cache_key, request.cert_path, request.key_path):
+            missing.append((cache_key, request))
+    if missing:
+        _generate_ssl_certificates(
+            [request for _, request in missing], sign_cert, sign_key,
+            sign_key_password, use_openssl, logger,
+        )
+        for cache_key, request in missing:
+            cache.store(cache_key, request.cert_path, request.key_path,
+                        _expiry())
+    logger.info('Reused %d of %d certificates from the cache (%s).',
+                len(cert_requests) - len(missing), len(cert_requests), cache)
+
+
+def _generate_ssl_certificates(cert_requests, sign_cert, sign_key,
+                               sign_key_password, use_openssl, logger):
+    start = time.time()
+    if _use_openssl(use_openssl, logger):
+        for request in cert_requests:
+            util.generate_ssl_certificate(
+                request.ips, request.cn, request.cert_path, request.key_path,
+                sign_cert, sign_key, sign_key_password, logger=logger,
+            )
+        logger.info('Generated %d certificates with openssl in %.1fs.',
+                    len(cert_requests), time.time() - start)
+        return
+
+    key_pool = start_key_pool()
+    ca_cert = ca_key = None
+    if sign_cert and sign_key:
+        with open(sign_cert, 'rb') as ca_cert_handle:
+            ca_cert = x509.load_pem_x509_certificate(ca_cert_handle.read(),
+                                                     default_backend())
+        with open(sign_key, 'rb') as ca_key_handle:
+            ca_key = serialization.load_pem_private_key(
+                ca_key_handle.read(),
+                password=(sign_key_password.encode('utf-8')
+                          if sign_key_password else None),
+                backend=default_backend(),
+            )
+
+    for request in cert_requests:
+        key = key_pool.get()
+        subject = _name(request.cn)
+        cert = _builder(
+            subject,
+            ca_cert.subject if ca_cert else subject,
+            key.public_key(),
+        ).add_extension(
+            x509.SubjectAlternativeName(_alt_names(request.ips)),
+            critical=False,
+        ).sign(ca_key or key, hashes.SHA256(), default_backend())
+        _write_key(key, request.key_path)
+        _write_cert(cert, request.cert_path)
+        logger.debug('Generated SSL certificate: {0} and key: {1}'.format(
+            request.cert_path, request.key_path,
+        ))
+    logger.info('Generated %d certificates in %.1fs (%s).',
+                len(cert_requests), time.time() - start, key_pool)
+
+
+def generate_ssl_certificate(ips, cn, cert_path, key_path, sign_cert=None,
+                             sign_key=None, sign_key_password=None,
+                             use_openssl=False, logger=logging):
+    """Generate one certificate and key.
+    Arguments are as for util.generate_ssl_certificate.
+    """
+    generate_ssl_certificates(
+        [CertRequest(ips, cn, cert_path, key_path)],
+        sign_cert, sign_key, sign_key_password,
+        use_openssl=use_openssl, logger=logger,
+    )
+    return cert_path, key_path
@@ -2,7 +2,7 @@ from retrying import retry
 
 from cosmo_tester.framework import util
 from cosmo_tester.framework.util import (
-    set_client_tenant,
+    tenant_client,
     wait_for_blueprint_upload
 )
 
@@ -15,14 +15,13 @@ def apply_and_check_deployment_update(manager, example_deployment, logger):
         'blueprints/compute/example_2_files.yaml'
     )
     blueprint_id = 'updated'
-    with set_client_tenant(manager.client,
-                           example_deployment.tenant):
-        manager.client.blueprints.upload(
-            modified_blueprint_path,
-            blueprint_id,
-            async_upload=True
-        )
-        wait_for_blueprint_upload(manager.client, blueprint_id)
+    client = tenant_client(manager.client, example_deployment.tenant)
+    client.blueprints.upload(
+        modified_blueprint_path,
+        blueprint_id,
+        async_upload=True
+    )
+    wait_for_blueprint_upload(client, blueprint_id)
 
     logger.info('Updating example deployment...')
     _update_deployment(manager.client,
@@ -47,12 +46,10 @@ def apply_and_check_deployment_update(manager, example_deployment, logger):
     # We have to clean up beforehand because the update uses the new inputs
     # instead of the old ones for the uninstall, which will fail if we don't
     # prepare.
-    with set_client_tenant(manager.client,
-                           example_deployment.tenant):
-        inst_id = util.get_node_instances(
-            'file', example_deployment.deployment_id,
-            manager.client,
-        )[0]['id']
+    inst_id = util.get_node_instances(
+        'file', example_deployment.deployment_id,
+        tenant_client(manager.client, example_deployment.tenant),
+    )[0]['id']
     suffix = inst_id.split('_')[-1]
     example_deployment.example_host.run_command(
         'rm {}_*'.format(original_path))
@@ -96,16 +93,16 @@ def _update_deployment(client,
                        logger,
                        skip_reinstall=False,
                        inputs=None):
-    with set_client_tenant(client, tenant):
-        dep_update = client.deployment_updates.update_with_existing_blueprint(
-            deployment_id=deployment_id,
-            blueprint_id=blueprint_id,
-            skip_reinstall=skip_reinstall,
-            inputs=inputs,
-        )
-        logger.info('Waiting for deployment update to complete...')
-        execution = client.executions.list(id=dep_update['execution_id'])[0]
-        util.wait_for_execution(client, execution, logger)
-
-        wait_for_deployment_update(client, dep_update['execution_id'], logger)
-        logger.info('Deployment update complete.')
+    client = tenant_client(client, tenant)
+    dep_update = client.deployment_updates.update_with_existing_blueprint(
+        deployment_id=deployment_id,
+        blueprint_id=blueprint_id,
+        skip_reinstall=skip_reinstall,
+        inputs=inputs,
+    )
+    logger.info('Waiting for deployment update to complete...')
+    execution = client.executions.list(id=dep_update['execution_id'])[0]
+    util.wait_for_execution(client, execution, logger)
+
+    wait_for_deployment_update(client, dep_update['execution_id'], logger)
+    logger.info('Deployment update complete.')
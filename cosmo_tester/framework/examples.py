@@ -5,12 +5,13 @@ import retrying
 
 from cloudify_rest_client.exceptions import CloudifyClientError
 
+from cosmo_tester.framework.polling import PollingPolicy
 from cosmo_tester.framework.util import (
     create_deployment,
     delete_deployment,
     get_resource_path,
     prepare_and_get_test_tenant,
-    set_client_tenant,
+    tenant_client,
     wait_for_execution,
 )
 
@@ -47,26 +48,30 @@ class BaseExample(object):
         self.installed = False
         self.windows = False
 
+    @property
+    def client(self):
+        """A client for the manager which acts on this example's tenant."""
+        return tenant_client(self.manager.client, self.tenant)
+
     def set_agent_key_secret(self):
         with open(self.ssh_key.private_key_path) as key_handle:
             ssh_key = key_handle.read()
-        with set_client_tenant(self.manager.client, self.tenant):
-            try:
-                self.manager.client.secrets.create(
-                    'agent_key',
-                    ssh_key,
-                )
-            except CloudifyClientError as err:
-                if self.manager._test_config['premium']:
-                    raise
-                # On community this can happen if multiple tests use the
-                # same manager (because the first will upload the secret and
-                # the later test(s) will then conflict due to it existing).
-                # Premium avoids this with multiple tenants.
-                if 'already exists' in str(err):
-                    pass
-                else:
-                    raise
+        try:
+            self.client.secrets.create(
+                'agent_key',
+                ssh_key,
+            )
+        except CloudifyClientError as err:
+            if self.manager._test_config['premium']:
+                raise
+            # On community this can happen if multiple tests use the
+            # same manager (because the first will upload the secret and
+            # the later test(s) will then conflict due to it existing).
+            # Premium avoids this with multiple tenants.
+            if 'already exists' in str(err):
+                pass
+            else:
+                raise
 
     def use_windows(self, user, password):
         self.inputs['agent_port'] = '5985'
@@ -85,21 +90,20 @@ class BaseExample(object):
         if self.create_secret:
             self.set_agent_key_secret()
 
-        with set_client_tenant(self.manager.client, self.tenant):
-            try:
-                self.manager.client.blueprints.upload(
-                    self.blueprint_file, self.blueprint_id)
-            except CloudifyClientError as err:
-                if self.manager._test_config['premium']:
-                    raise
-                # On community this can happen if multiple tests use the
-                # same manager (because the first will upload the blueprint;
-                # the later test(s) will then conflict due to it existing).
-                # Premium avoids this with multiple tenants.
-                if 'already exists' in str(err):
-                    pass
-                else:
-                    raise
+        try:
+            self.client.blueprints.upload(
+                self.blueprint_file, self.blueprint_id)
+        except CloudifyClientError as err:
+            if self.manager._test_config['premium']:
+                raise
+            # On community this can happen if multiple tests use the
+            # same manager (because the first will upload the blueprint;
+            # the later test(s) will then conflict due to it existing).
+            # Premium avoids this with multiple tenants.
+            if 'already exists' in str(err):
+                pass
+            else:
+                raise
 
     def create_deployment(self, skip_plugins_validation=False, wait=True):
         if 'path' not in self.inputs:
@@ -110,30 +114,31 @@ class BaseExample(object):
                 'Creating deployment [id=%s] with the following inputs:\n%s',
                 self.deployment_id,
                 json.dumps(self.inputs, indent=2))
-        with set_client_tenant(self.manager.client, self.tenant):
-            create_deployment(
-                self.manager.client, self.blueprint_id, self.deployment_id,
-                self.logger, inputs=self.inputs,
-                skip_plugins_validation=skip_plugins_validation,
-            )
-            self.logger.info('Deployments for tenant {}'.format(self.tenant))
-            for deployment in self.manager.client.deployments.list():
-                self.logger.info(deployment['id'])
+        client = self.client
+        create_deployment(
+            client, self.blueprint_id, self.deployment_id,
+            self.logger, inputs=self.inputs,
+            skip_plugins_validation=skip_plugins_validation,
+        )
+        self.logger.info('Deployments for tenant {}'.format(self.tenant))
+        for deployment in client.deployments.list():
+            self.logger.info(deployment['id'])
         if wait:
             self.wait_for_deployment_environment_creation()
 
-    def wait_for_deployment_environment_creation(self):
+    def wait_for_deployment_environment_creation(self, polling=None):
         self.logger.info('Waiting for deployment env creation.')
+        polling = polling or PollingPolicy()
         while True:
-            with set_client_tenant(self.manager.client, self.tenant):
-                executions = self.manager.client.executions.list(
-                    _include=['status'],
-                    deployment_id=self.deployment_id,
-                    workflow_id='create_deployment_environment',
-                )
-                if all(exc['status'] == 'terminated' for exc in executions):
-                    break
-        self.logger.info('Deployment env created.')
+            executions = self.client.executions.list(
+                _include=['status'],
+                deployment_id=self.deployment_id,
+                workflow_id='create_deployment_environment',
+            )
+            if all(exc['status'] == 'terminated' for exc in executions):
+                break
+            polling.wait([exc['status'] for exc in executions])
+        self.logger.info('Deployment env created (%s).', polling)
 
     def install(self):
         self.logger.info('Installing deployment...')
@@ -149,21 +154,19 @@ class BaseExample(object):
         if delete_dep:
             # The deployment needs removing to avoid problems with community
             # when multiple tests use the same manager
-            with set_client_tenant(self.manager.client, self.tenant):
-                delete_deployment(self.manager.client, self.deployment_id,
-                                  self.logger)
+            delete_deployment(self.client, self.deployment_id,
+                              self.logger)
 
     def execute(self, workflow_id, parameters=None):
         self.logger.info('Starting workflow: {}'.format(workflow_id))
         try:
-            with set_client_tenant(self.manager.client, self.tenant):
-                execution = self.manager.client.executions.start(
-                    deployment_id=self.deployment_id,
-                    workflow_id=workflow_id,
-                    parameters=parameters,
-                )
-                wait_for_execution(self.manager.client, execution,
-                                   self.logger)
+            client = self.client
+            execution = client.executions.start(
+                deployment_id=self.deployment_id,
+                workflow_id=workflow_id,
+                parameters=parameters,
+            )
+            wait_for_execution(client, execution, self.logger)
         except Exception as err:
             self.logger.error('Error on deployment execution: %s', err)
             raise
@@ -190,7 +193,7 @@ class BaseExample(object):
                     data = self.example_host.get_windows_remote_file_content(
                         file_path).strip()
                 else:
-                    data = self.example_host.get_remote_file_content(
+                    data = self.example_host.get_remote_file_bytes(
                         file_path)
                 assert data.decode('utf-8') == expected_content
 
@@ -219,16 +222,16 @@ class BaseExample(object):
 
     def assert_deployment_events_exist(self):
         self.logger.info('Verifying deployment events..')
-        with set_client_tenant(self.manager.client, self.tenant):
-            executions = self.manager.client.executions.list(
-                deployment_id=self.deployment_id,
-            )
-            events = self.manager.client.events.list(
-                execution_id=executions[0].id,
-                _offset=0,
-                _size=100,
-                _sort='@timestamp',
-            ).items
+        client = self.client
+        executions = client.executions.list(
+            deployment_id=self.deployment_id,
+        )
+        events = client.events.list(
+            execution_id=executions[0].id,
+            _offset=0,
+            _size=100,
+            _sort='@timestamp',
+        ).items
         assert len(events) > 0, (
             'There are no events for deployment: {0}'.format(
                 self.deployment_id,
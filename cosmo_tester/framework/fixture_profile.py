@@ -0,0 +1,229 @@
+import glob
+import json
+import os
+import time
+
+import pytest
+
+DEFAULT_REPORT_PATH = 'fixture_profile.json'
+# How many fixtures and tests to show in the terminal summary
+SUMMARY_LENGTH = 15
+
+
+class FixtureRecord(object):
+    """One instance of a fixture, from its setup to its teardown."""
+    def __init__(self, fixturedef, worker):
+        self.name = fixturedef.argname
+        self.scope = fixturedef.scope
+        self.baseid = fixturedef.baseid
+        self.worker = worker
+        self.setup = 0.0
+        self.teardown = 0.0
+        self.error = None
+        self.users = []
+        self._teardown_started = None
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'scope': self.scope,
+            'baseid': self.baseid,
+            'worker': self.worker,
+            'setup': self.setup,
+            'teardown': self.teardown,
+            'error': self.error,
+            'users': self.users,
+        }
+
+
+def summarise(records):
+    """Total up fixture records by fixture, and by the tests using them.
+
+    :param records: Fixture records, as dicts.
+    :return: A dict with fixtures and tests lists, most expensive first.
+    """
+    fixtures = {}
+    tests = {}
+    for record in records:
+        cost = record['setup'] + record['teardown']
+        key = (record['name'], record['scope'], record['baseid'])
+        fixture = fixtures.setdefault(key, {
+            'name': record['name'],
+            'scope': record['scope'],
+            'baseid': record['baseid'],
+            'instances': 0,
+            'uses': 0,
+            'setup': 0.0,
+            'teardown': 0.0,
+            'errors': 0,
+        })
+        fixture['instances'] += 1
+        fixture['uses'] += len(record['users'])
+        fixture['setup'] += record['setup']
+        fixture['teardown'] += record['teardown']
+        if record['error']:
+            fixture['errors'] += 1
+
+        if not record['users']:
+            continue
+        share = cost / len(record['users'])
+        for nodeid in record['users']:
+            test = tests.setdefault(nodeid, {'nodeid': nodeid,
+                                             'cost': 0.0,
+                                             'fixtures': {}})
+            test['cost'] += share
+            test['fixtures'][record['name']] = (
+                test['fixtures'].get(record['name'], 0.0) + share
+            )
+
+    for fixture in fixtures.values():
+        fixture['total'] = fixture['setup'] + fixture['teardown']
+        fixture['cost_per_use'] = (
+            fixture['total'] / fixture['uses'] if fixture['uses'] else None
+        )
+    return {
+        'fixtures': sorted(fixtures.values(),
+                           key=lambda fixture: fixture['total'],
+                           reverse=True),
+        'tests': sorted(tests.values(), key=lambda test: test['cost'],
+                        reverse=True),
+    }
+
+
+class FixtureProfiler(object):
+    """A pytest plugin recording how long each fixture takes to set up and
+    tear down, and which tests paid for it.
+
+    The cost of a fixture instance (its setup plus its teardown) is split
+    evenly between the tests that used it, so a session scoped manager
+    shared by twenty tests costs each of them a twentieth of its bootstrap,
+    while a function scoped one is paid for in full by every test.
+    Time spent setting up a fixture's own dependencies is counted against
+    the dependencies rather than the fixture.
+    With xdist, each worker writes its records beside the report and the
+    controller merges them.
+    """
+    def __init__(self, config, report_path):
+        self._report_path = os.path.abspath(report_path)
+        workerinput = getattr(config, 'workerinput', None)
+        self._worker = workerinput['workerid'] if workerinput else None
+        self._records = []
+        # Records for fixture instances that are currently set up, by
+        # FixtureDef
+        self._active = {}
+        # Fixtures being set up, innermost last, with the time spent
+        # setting up their dependencies
+        self._setting_up = []
+
+        if self._worker is None:
+            for stale in self._worker_paths():
+                os.remove(stale)
+
+    def _worker_paths(self):
+        return glob.glob('{}.gw*'.format(self._report_path))
+
+    @pytest.hookimpl(hookwrapper=True)
+    def pytest_fixture_setup(self, fixturedef, request):
+        record = FixtureRecord(fixturedef, self._worker)
+
+        def _teardown_finished():
+            if record._teardown_started is not None:
+                record.teardown = time.time() - record._teardown_started
+            self._active.pop(fixturedef, None)
+
+        # Finalizers run last first, so this runs after the fixture's own
+        # teardown, and the one added after setup runs before it.
+        request.addfinalizer(_teardown_finished)
+
+        frame = {'dependencies': 0.0}
+        self._setting_up.append(frame)
+        start = time.time()
+        outcome = yield
+        elapsed = time.time() - start
+        self._setting_up.pop()
+        if self._setting_up:
+            self._setting_up[-1]['dependencies'] += elapsed
+
+        record.setup = elapsed - frame['dependencies']
+        if outcome.excinfo:
+            record.error = outcome.excinfo[0].__name__
+
+        def _teardown_starting():
+            record._teardown_started = time.time()
+
+        request.addfinalizer(_teardown_starting)
+        self._records.append(record)
+        self._active[fixturedef] = record
+
+    @pytest.hookimpl(hookwrapper=True)
+    def pytest_runtest_setup(self, item):
+        yield
+        fixtureinfo = getattr(item, '_fixtureinfo', None)
+        if fixtureinfo is None:
+            return
+        for name in item.fixturenames:
+            fixturedefs = fixtureinfo.name2fixturedefs.get(name)
+            if not fixturedefs:
+                continue
+            record = self._active.get(fixturedefs[-1])
+            if record is not None:
+                record.users.append(item.nodeid)
+
+    def _write(self, path, records):
+        with open(path, 'w') as report_handle:
+            json.dump({
+                'records': records,
+                'summary': summarise(records),
+            }, report_handle, indent=2)
+
+    def pytest_sessionfinish(self, session):
+        if self._worker is not None:
+            self._write(
+                '{}.{}'.format(self._report_path, self._worker),
+                [record.to_dict() for record in self._records],
+            )
+
+    def pytest_terminal_summary(self, terminalreporter):
+        if self._worker is not None:
+            return
+        records = [record.to_dict() for record in self._records]
+        for worker_path in sorted(self._worker_paths()):
+            with open(worker_path) as worker_handle:
+                records.extend(json.load(worker_handle)['records'])
+            os.remove(worker_path)
+        self._write(self._report_path, records)
+
+        summary = summarise(records)
+        terminalreporter.write_sep('=', 'fixture profile')
+        terminalreporter.write_line(
+            '{:>9} {:>9} {:>9} {:>5} {:>9}  {}'.format(
+                'setup', 'teardown', 'per use', 'uses', 'scope', 'fixture'))
+        for fixture in summary['fixtures'][:SUMMARY_LENGTH]:
+            terminalreporter.write_line(
+                '{setup:8.1f}s {teardown:8.1f}s {per_use:>9} {uses:5d} '
+                '{scope:>9}  {name}'.format(
+                    per_use=(
+                        '{:.1f}s'.format(fixture['cost_per_use'])
+                        if fixture['cost_per_use'] is not None else '-'
+                    ),
+                    **fixture
+                )
+            )
+        terminalreporter.write_line('')
+        terminalreporter.write_line('{:>9}  {}'.format('fixtures', 'test'))
+        for test in summary['tests'][:SUMMARY_LENGTH]:
+            terminalreporter.write_line(
+                '{cost:8.1f}s  {nodeid} ({fixtures})'.format(
+                    cost=test['cost'],
+                    nodeid=test['nodeid'],
+                    fixtures=', '.join(
+                        '{}: {:.1f}s'.format(name, cost)
+                        for name, cost in sorted(
+                            test['fixtures'].items(),
+                            key=lambda item: item[1], reverse=True,
+                        )[:3]
+                    ),
+                )
+            )
+        terminalreporter.write_line(
+            'Full fixture profile written to {}'.format(self._report_path))
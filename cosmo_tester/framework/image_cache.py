@@ -0,0 +1,270 @@
+import copy
+import hashlib
+import os
+import re
+import time
+
+import requests
+import yaml
+
+from cosmo_tester.framework.state_file import (
+    StateFile,
+    owner,
+    owner_is_alive,
+)
+
+CAPTURING = 'capturing'
+READY = 'ready'
+# Platforms whose VM blueprints can snapshot a server to an image
+SUPPORTED_PLATFORMS = ['openstack']
+# Install config settings which differ between VMs and are updated by
+# cfy_manager image-starter when a VM boots from a cached image
+_PER_VM_SETTINGS = ['public_ip', 'private_ip', 'hostname',
+                    'cloudify_license_path']
+
+
+def normalise_install_config(install_config):
+    """Remove the settings of an install config that are specific to the
+    VM it was installed on.
+    """
+    config = copy.deepcopy(install_config)
+    for setting in _PER_VM_SETTINGS:
+        config.get('manager', {}).pop(setting, None)
+    return config
+
+
+def cache_key(install_config, testing_version, base_image):
+    """Identify the image of a manager bootstrapped with an install config,
+    which is also used as the name of its snapshot.
+
+    :param base_image: The image the manager was bootstrapped on.
+    """
+    digest = hashlib.sha256()
+    digest.update(yaml.safe_dump(normalise_install_config(install_config),
+                                 default_flow_style=False).encode('utf-8'))
+    digest.update(base_image.encode('utf-8'))
+    return 'cosmo-bootstrapped-{version}-{digest}'.format(
+        version=re.sub('[^a-zA-Z0-9]', '-', testing_version),
+        digest=digest.hexdigest()[:16],
+    )
+
+
+def snapshot_image_name(server_id, key):
+    """The name of the image created by the openstack plugin's
+    cloudify.interfaces.snapshot.create operation, when run with the key as
+    its snapshot_name.
+    """
+    return 'vm-{server_id}-{key}-increment'.format(
+        server_id=server_id, key=key,
+    )
+
+
+class ImageCacheError(Exception):
+    pass
+
+
+class OpenstackImages(object):
+    """Delete images using the OpenStack image API directly, as images
+    can't be deleted through the infrastructure manager once the server
+    they were captured from is gone.
+    The keystone credentials are those in the openstack platform config.
+    """
+    def __init__(self, platform_config, timeout=60):
+        self._config = platform_config
+        self._timeout = timeout
+        self._session = requests.Session()
+        self._endpoint = None
+
+    def _authenticate(self):
+        auth_url = self._config['url'].rstrip('/')
+        if not auth_url.endswith('/v3'):
+            auth_url += '/v3'
+        domain = {'name': 'default'}
+        response = self._session.post(
+            auth_url + '/auth/tokens',
+            json={'auth': {
+                'identity': {
+                    'methods': ['password'],
+                    'password': {'user': {
+                        'name': self._config['username'],
+                        'password': self._config['password'],
+                        'domain': domain,
+                    }},
+                },
+                'scope': {'project': {
+                    'name': self._config['tenant'],
+                    'domain': domain,
+                }},
+            }},
+            timeout=self._timeout,
+        )
+        response.raise_for_status()
+        self._session.headers['X-Auth-Token'] = (
+            response.headers['X-Subject-Token']
+        )
+        for service in response.json()['token']['catalog']:
+            if service['type'] != 'image':
+                continue
+            for endpoint in service['endpoints']:
+                if (
+                    endpoint['interface'] == 'public'
+                    and endpoint['region'] == self._config['region']
+                ):
+                    url = endpoint['url'].rstrip('/')
+                    if url.endswith('/v2'):
+                        url = url[:-len('/v2')]
+                    self._endpoint = url + '/v2'
+                    return
+        raise ImageCacheError(
+            'No public image endpoint found for region {}'.format(
+                self._config['region'])
+        )
+
+    def delete(self, name):
+        """Delete every image with a name.
+
+        :return: How many images were deleted.
+        """
+        if self._endpoint is None:
+            self._authenticate()
+        response = self._session.get(
+            self._endpoint + '/images', params={'name': name},
+            timeout=self._timeout,
+        )
+        response.raise_for_status()
+        images = response.json()['images']
+        for image in images:
+            self._session.delete(
+                '{}/images/{}'.format(self._endpoint, image['id']),
+                timeout=self._timeout,
+            ).raise_for_status()
+        return len(images)
+
+
+class ImageCache(object):
+    """Images of bootstrapped managers, which managers with the same
+    install config can be booted from instead of being installed.
+
+    The images are recorded in a state file shared by all sessions, along
+    with the testing_version they were captured for. Images captured for
+    any other testing_version are dropped from the cache when it is next
+    used, and deleted by delete_dropped().
+    """
+    def __init__(self, test_config, logger):
+        config = test_config['image_cache']
+        self._logger = logger
+        self._platform = test_config['target_platform']
+        self._testing_version = test_config['testing_version']
+        self._platform_config = test_config.platform
+        self._state = StateFile(os.path.join(
+            os.path.expanduser(config['directory']), 'images.json'))
+
+    @property
+    def supported(self):
+        return self._platform in SUPPORTED_PLATFORMS
+
+    def _images(self, state):
+        images = state.setdefault('images', {})
+        for key, image in list(images.items()):
+            if image['testing_version'] != self._testing_version:
+                images.pop(key)
+                if image['state'] == READY:
+                    self._logger.info(
+                        'Dropped cached image %s, which was captured for '
+                        'testing_version %s.',
+                        image['image'], image['testing_version'],
+                    )
+                    state.setdefault('dropped', {})[image['image']] = {
+                        'platform': image['platform'],
+                        'dropped_at': time.time(),
+                    }
+        return images
+
+    def lookup(self, key):
+        """Return the name of the cached image for a key, or None."""
+        if not self.supported:
+            return None
+        with self._state.locked() as state:
+            image = self._images(state).get(key)
+        if image is None or image['state'] != READY:
+            return None
+        self._logger.info('Found cached image %s for %s.', image['image'],
+                          key)
+        return image['image']
+
+    def claim(self, key):
+        """Claim the right to capture the image for a key.
+
+        :return: True if the caller should capture the image and then call
+                 add() or abandon(), or False if it is already cached or
+                 being captured.
+        """
+        if not self.supported:
+            self._logger.info('Capturing images of bootstrapped managers '
+                              'is not supported on %s.', self._platform)
+            return False
+        with self._state.locked() as state:
+            images = self._images(state)
+            image = images.get(key)
+            if image and (
+                image['state'] == READY or owner_is_alive(image['owner'])
+            ):
+                return False
+            images[key] = {
+                'state': CAPTURING,
+                'owner': owner(),
+                'testing_version': self._testing_version,
+                'platform': self._platform,
+            }
+        return True
+
+    def add(self, key, image_name):
+        """Record an image captured after claim() returned True."""
+        with self._state.locked() as state:
+            self._images(state)[key] = {
+                'state': READY,
+                'image': image_name,
+                'testing_version': self._testing_version,
+                'platform': self._platform,
+                'created_at': time.time(),
+            }
+        self._logger.info('Cached image %s for %s.', image_name, key)
+
+    def abandon(self, key):
+        """Give up on capturing an image after claim() returned True."""
+        with self._state.locked() as state:
+            images = self._images(state)
+            image = images.get(key, {})
+            if image.get('state') == CAPTURING and image['owner'] == owner():
+                images.pop(key)
+
+    def delete_dropped(self):
+        """Delete the images that have been dropped from the cache.
+        Failures are logged rather than raised, and will be retried the
+        next time this is called.
+        """
+        if not self.supported:
+            return
+        with self._state.locked() as state:
+            self._images(state)
+            dropped = sorted(
+                name for name, image in state.get('dropped', {}).items()
+                if image['platform'] == self._platform
+            )
+        if not dropped:
+            return
+        images = OpenstackImages(self._platform_config)
+        deleted = []
+        for name in dropped:
+            try:
+                images.delete(name)
+            except Exception as err:
+                self._logger.warning('Failed to delete dropped image %s, '
+                                     'this will be retried later: %s',
+                                     name, err)
+            else:
+                deleted.append(name)
+        with self._state.locked() as state:
+            for name in deleted:
+                state.get('dropped', {}).pop(name, None)
+        self._logger.info('Deleted %d dropped images.', len(deleted))
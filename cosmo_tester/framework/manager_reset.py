@@ -0,0 +1,201 @@
+import hashlib
+
+from cloudify_rest_client.executions import Execution
+import yaml
+
+from cosmo_tester.framework import timeline
+from cosmo_tester.framework.parallel import run_parallel
+from cosmo_tester.framework.util import (
+    cancel_executions,
+    delete_deployments,
+    tenant_client,
+)
+
+DEFAULT_TENANT = 'default_tenant'
+# Event and log history, which the REST API has no way to remove
+_PURGE_DB_COMMAND = (
+    'sudo -u postgres psql cloudify_db -c "TRUNCATE events, logs"'
+)
+# Files left behind by blueprints, deployments and snapshots
+_PURGE_FILES_COMMAND = (
+    'sudo find /opt/manager/resources/uploaded-blueprints '
+    '/opt/manager/resources/blueprints /opt/manager/resources/deployments '
+    '/opt/manager/resources/snapshots -mindepth 1 -maxdepth 1 '
+    '-exec rm -rf {} +'
+)
+
+
+class ManagerResetError(Exception):
+    pass
+
+
+def install_config_hash(install_config):
+    """Identify an install config, so that we can tell whether a manager
+    would be installed any differently by reinstalling it.
+    """
+    return hashlib.sha256(
+        yaml.safe_dump(install_config, default_flow_style=False).encode(
+            'utf-8')
+    ).hexdigest()
+
+
+def _purge_tenant(client, tenant, logger):
+    client = tenant_client(client, tenant)
+
+    active = [
+        execution['id'] for execution in client.executions.list(
+            _include=['id', 'status'], _get_all_results=True,
+        )
+        if execution['status'] not in Execution.END_STATES
+    ]
+    not_cancelled = cancel_executions(client, active, logger)
+    if not_cancelled:
+        raise ManagerResetError(
+            'Executions in tenant {tenant} were not cancelled: '
+            '{executions}'.format(tenant=tenant,
+                                  executions=', '.join(not_cancelled))
+        )
+
+    delete_deployments(
+        client,
+        [deployment['id'] for deployment in client.deployments.list(
+            _include=['id'], _get_all_results=True,
+        )],
+        logger,
+        force=True,
+    )
+    for blueprint in client.blueprints.list(_include=['id'],
+                                            _get_all_results=True):
+        client.blueprints.delete(blueprint['id'], force=True)
+    for plugin in client.plugins.list(
+        _include=['id', 'tenant_name'], _get_all_results=True,
+    ):
+        if plugin['tenant_name'] == tenant:
+            client.plugins.delete(plugin['id'], force=True)
+    for secret in client.secrets.list(_include=['key', 'tenant_name'],
+                                      _get_all_results=True):
+        if secret['tenant_name'] == tenant:
+            client.secrets.delete(secret['key'])
+
+
+def find_leftovers(client):
+    """Check that a manager is empty, as it is after a fresh install.
+
+    :return: A list describing anything that is left on the manager.
+    """
+    leftovers = []
+    tenants = sorted(tenant['name'] for tenant in client.tenants.list())
+    if tenants != [DEFAULT_TENANT]:
+        leftovers.append('tenants: {}'.format(', '.join(tenants)))
+    snapshots = [snapshot['id']
+                 for snapshot in client.snapshots.list(_include=['id'])]
+    if snapshots:
+        leftovers.append('snapshots: {}'.format(', '.join(snapshots)))
+
+    client = tenant_client(client, DEFAULT_TENANT)
+    for resource, id_key in [
+        ('blueprints', 'id'),
+        ('deployments', 'id'),
+        ('plugins', 'id'),
+        ('secrets', 'key'),
+    ]:
+        found = [item[id_key] for item in getattr(client, resource).list(
+            _include=[id_key], _get_all_results=True,
+        )]
+        if found:
+            leftovers.append('{}: {}'.format(resource, ', '.join(found)))
+    active = [
+        execution['id'] for execution in client.executions.list(
+            _include=['id', 'status'], _get_all_results=True,
+        )
+        if execution['status'] not in Execution.END_STATES
+    ]
+    if active:
+        leftovers.append('active executions: {}'.format(', '.join(active)))
+    return leftovers
+
+
+@timeline.timed('vm.purge', lambda manager, *args, **kwargs: {
+    'vm': manager.deployment_id,
+})
+def purge_manager(manager, logger, purge_stores=False):
+    """Remove everything created on a manager through its REST API, then
+    check that it is empty.
+    Changes made to the manager in other ways (e.g. over SSH) are not
+    undone, so tests making them should be marked with mutates_manager.
+
+    :param purge_stores: Also remove the event and log history from the
+                         database, and anything left in the file store.
+    :raises ManagerResetError: If anything could not be removed.
+    """
+    client = manager.client
+    tenants = sorted(tenant['name'] for tenant in client.tenants.list())
+    # Tenants don't share deployments, so they can be purged at once
+    run_parallel(lambda tenant: _purge_tenant(client, tenant, logger),
+                 tenants, logger=logger, description='Purging tenants')
+
+    for tenant in tenants:
+        if tenant != DEFAULT_TENANT:
+            client.tenants.delete(tenant)
+    admin = manager._test_config['test_manager']['username']
+    for user in client.users.list(_include=['username']):
+        if user['username'] != admin:
+            client.users.delete(user['username'])
+    for group in client.user_groups.list(_include=['name']):
+        client.user_groups.delete(group['name'])
+    for snapshot in client.snapshots.list(_include=['id']):
+        client.snapshots.delete(snapshot['id'])
+
+    if purge_stores:
+        manager.run_command(_PURGE_DB_COMMAND)
+        manager.run_command(_PURGE_FILES_COMMAND)
+
+    leftovers = find_leftovers(client)
+    if leftovers:
+        raise ManagerResetError(
+            'Manager was not empty after purging: {}'.format(
+                '; '.join(leftovers))
+        )
+    logger.info('Purged %d tenants from manager %s.', len(tenants),
+                manager.ip_address)
+
+
+def keep_install(manager, test_config, logger):
+    """Return a manager to its freshly installed state after a test, so
+    that the next test can use it without reinstalling it.
+
+    :return: True if the manager was reset, or False if it must be torn
+             down instead.
+    """
+    try:
+        purge_manager(
+            manager, logger,
+            purge_stores=test_config['test_manager']['reset_purge_stores'],
+        )
+        status = manager.client.manager.get_status()
+        if status['status'] != 'OK':
+            raise ManagerResetError(
+                'Manager is not healthy: {}'.format(status['status'])
+            )
+    except Exception as err:
+        logger.warning('Could not reset manager %s, it will be '
+                       'reinstalled instead: %s', manager.ip_address, err)
+        return False
+    manager.install_kept = True
+    return True
+
+
+def reuse_install(manager, logger):
+    """Check whether a manager kept by keep_install can be used as if it
+    had just been installed.
+    """
+    if not manager.install_kept:
+        return False
+    if manager.installed_config_hash != install_config_hash(
+        manager.install_config
+    ):
+        logger.info('Install config of %s has changed, reinstalling.',
+                    manager.ip_address)
+        return False
+    logger.info('Reusing existing install on %s.', manager.ip_address)
+    return True
@@ -0,0 +1,99 @@
+from concurrent.futures import ThreadPoolExecutor
+import time
+
+from cosmo_tester.framework import timeline
+
+# Enough to cover our largest clusters at once without opening an
+# unreasonable number of connections from the test runner.
+DEFAULT_MAX_WORKERS = 10
+
+
+class ParallelResult(object):
+    """The outcome of calling a function for one target."""
+    def __init__(self, target, result=None, error=None, duration=0.0):
+        self.target = target
+        self.result = result
+        self.error = error
+        self.duration = duration
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    def __repr__(self):
+        return '<ParallelResult {target}: {state} in {duration:.1f}s>'.format(
+            target=self.target,
+            state='ok' if self.ok else 'failed ({})'.format(self.error),
+            duration=self.duration,
+        )
+
+
+class ParallelExecutionError(Exception):
+    """One or more calls made by run_parallel failed."""
+    def __init__(self, results):
+        self.results = results
+        self.failures = [result for result in results if not result.ok]
+        super(ParallelExecutionError, self).__init__(
+            '{failed} of {total} failed: {errors}'.format(
+                failed=len(self.failures),
+                total=len(results),
+                errors='; '.join(
+                    '{}: {}'.format(failure.target, failure.error)
+                    for failure in self.failures
+                ),
+            )
+        )
+
+
+def _timed_call(func, target, parent_span):
+    start = time.time()
+    try:
+        with timeline.attached(parent_span):
+            result = func(target)
+    except Exception as err:
+        return ParallelResult(target, error=err,
+                              duration=time.time() - start)
+    return ParallelResult(target, result=result,
+                          duration=time.time() - start)
+
+
+def run_parallel(func, targets, max_workers=DEFAULT_MAX_WORKERS,
+                 raise_on_error=True, logger=None, description=None):
+    """Call func(target) for every target on a bounded thread pool.
+
+    :param func: The function to call for each target.
+    :param targets: The targets (e.g. VMs) to call the function for.
+    :param max_workers: The maximum number of calls to make at once.
+    :param raise_on_error: Whether to raise a ParallelExecutionError,
+                           after all calls have finished, if any failed.
+    :param logger: If supplied, a summary of the timings will be logged.
+    :param description: What is being done, for the logged summary.
+    :return: A list of ParallelResult, in the same order as the targets.
+    """
+    targets = list(targets)
+    if not targets:
+        return []
+
+    start = time.time()
+    workers = max(1, min(max_workers, len(targets)))
+    parent_span = timeline.current()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            executor.submit(_timed_call, func, target, parent_span)
+            for target in targets
+        ]
+        results = [future.result() for future in futures]
+
+    if logger:
+        slowest = max(results, key=lambda result: result.duration)
+        logger.info(
+            '%s on %d targets took %.1fs (slowest: %s at %.1fs, '
+            '%d failed).',
+            description or 'Parallel run', len(results),
+            time.time() - start, slowest.target, slowest.duration,
+            len([result for result in results if not result.ok]),
+        )
+
+    if raise_on_error and any(not result.ok for result in results):
+        raise ParallelExecutionError(results)
+    return results
@@ -0,0 +1,59 @@
+import time
+
+DEFAULT_INITIAL_INTERVAL = 0.5
+DEFAULT_MAX_INTERVAL = 5
+DEFAULT_MULTIPLIER = 1.5
+
+_UNSET = object()
+
+
+class PollingPolicy(object):
+    """Decide how long to wait between polls of something that is changing
+    state, e.g. a running execution.
+
+    The interval starts at `initial` and grows by `multiplier` after every
+    poll that sees no change, up to `maximum`. After a poll that sees a
+    change it drops back to `fast`, as further changes (e.g. the next
+    operation finishing) tend to follow soon after.
+    Counters are kept so that the load added by polling can be reported.
+    """
+    def __init__(self, initial=DEFAULT_INITIAL_INTERVAL,
+                 maximum=DEFAULT_MAX_INTERVAL, multiplier=DEFAULT_MULTIPLIER,
+                 fast=None):
+        self.initial = initial
+        self.maximum = maximum
+        self.multiplier = multiplier
+        self.fast = initial if fast is None else fast
+
+        self.interval = initial
+        self.polls = 0
+        self.changes = 0
+        self.waited = 0.0
+        self._last_state = _UNSET
+
+    def next_interval(self, state=None):
+        """Record the state seen by a poll and return how long to wait
+        before the next one.
+        """
+        self.polls += 1
+        if self._last_state is _UNSET:
+            self.interval = self.initial
+        elif state != self._last_state:
+            self.changes += 1
+            self.interval = self.fast
+        else:
+            self.interval = min(self.interval * self.multiplier,
+                                self.maximum)
+        self._last_state = state
+        return self.interval
+
+    def wait(self, state=None):
+        """Record the state seen by a poll, then sleep until the next one."""
+        interval = self.next_interval(state)
+        time.sleep(interval)
+        self.waited += interval
+
+    def __str__(self):
+        return (
+            '{polls} polls, {changes} state changes, {waited:.1f}s waiting'
+        ).format(polls=self.polls, changes=self.changes, waited=self.waited)
@@ -0,0 +1,389 @@
+from collections import namedtuple
+import hashlib
+import io
+import os
+import posixpath
+import shlex
+import tarfile
+import threading
+import uuid
+
+CHUNK_SIZE = 64 * 1024
+# The sha256, size and mtime of each file written by
+# write_remote_file_cached, in an entry named by the sha256 of its path
+INDEX_DIR = '/var/tmp/cosmo_tester_uploads'
+# What the cached write script will do, which it tells us before reading
+# any content
+_SEND = b'send'
+_SKIP = b'skip'
+
+_hashes = {}
+_hashes_lock = threading.Lock()
+
+
+class RemoteTransferError(Exception):
+    """Transferring a file to or from a remote host failed."""
+
+
+def _open_channel(conn, command):
+    channel = conn.client.get_transport().open_session()
+    channel.exec_command(command)
+    return channel
+
+
+def _check_status(channel, action, remote_path):
+    status = channel.recv_exit_status()
+    if status != 0:
+        stderr = channel.makefile_stderr('rb').read().decode(
+            'utf-8', 'replace')
+        raise RemoteTransferError(
+            'Failed to {action} {path} (exit status {status}): '
+            '{stderr}'.format(
+                action=action,
+                path=remote_path,
+                status=status,
+                stderr=stderr.strip(),
+            )
+        )
+
+
+def _sudo(command, use_sudo):
+    if use_sudo:
+        # -n so that we fail rather than hanging if a password is required
+        return 'sudo -n sh -c {}'.format(shlex.quote(command))
+    return 'sh -c {}'.format(shlex.quote(command))
+
+
+def iter_remote_file(conn, remote_path, use_sudo=True,
+                     chunk_size=CHUNK_SIZE):
+    """Yield the contents of a remote file as chunks of bytes.
+    This uses a single channel on the connection, reading the file with
+    cat so that files only readable by root can be retrieved without
+    first copying them somewhere readable.
+
+    :param conn: An open fabric connection.
+    :param remote_path: The path of the file on the remote host.
+    """
+    channel = _open_channel(
+        conn,
+        _sudo('cat -- {}'.format(shlex.quote(remote_path)), use_sudo),
+    )
+    try:
+        while True:
+            data = channel.recv(chunk_size)
+            if not data:
+                break
+            yield data
+        _check_status(channel, 'read', remote_path)
+    finally:
+        channel.close()
+
+
+def read_remote_file(conn, remote_path, out_stream, use_sudo=True,
+                     chunk_size=CHUNK_SIZE):
+    """Stream a remote file into a local binary stream.
+
+    :param conn: An open fabric connection.
+    :param remote_path: The path of the file on the remote host.
+    :param out_stream: A file-like object opened for binary writing.
+    :return: The number of bytes transferred.
+    """
+    transferred = 0
+    for data in iter_remote_file(conn, remote_path, use_sudo, chunk_size):
+        out_stream.write(data)
+        transferred += len(data)
+    return transferred
+
+
+def iter_chunks(source, chunk_size=CHUNK_SIZE):
+    """Yield the content of source as chunks of bytes.
+    Text is encoded as utf-8.
+
+    :param source: bytes, text, a file-like object (binary or text) or an
+                   iterable of bytes or text.
+    """
+    if isinstance(source, (bytes, str)):
+        source = [source]
+    elif hasattr(source, 'read'):
+        handle = source
+        source = iter(lambda: handle.read(chunk_size), handle.read(0))
+    for data in source:
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        if data:
+            yield data
+
+
+def _owner_mode_commands(target, owner=None, mode=None):
+    """Shell commands to set the owner and mode of target (already quoted).
+    """
+    commands = []
+    if owner:
+        if ':' not in owner and '.' not in owner:
+            # Use the owner's login group, as if they had created the file
+            owner += ':'
+        commands.append('chown {} {}'.format(shlex.quote(owner), target))
+    if mode is not None:
+        if not isinstance(mode, str):
+            mode = '{:o}'.format(mode)
+        commands.append('chmod {} {}'.format(shlex.quote(mode), target))
+    return commands
+
+
+def _write_commands(owner=None, mode=None):
+    """Shell commands to write stdin to $dest atomically, setting ownership
+    and permissions before moving it into place.
+    """
+    return [
+        'tmp="$dest.{}.tmp"'.format(uuid.uuid4().hex[:8]),
+        'trap \'rm -f -- "$tmp"\' EXIT',
+        'mkdir -p -- "$(dirname -- "$dest")"',
+        'cat > "$tmp"',
+    ] + _owner_mode_commands('"$tmp"', owner, mode) + [
+        'mv -f -- "$tmp" "$dest"',
+    ]
+
+
+def _write_script(remote_path, owner=None, mode=None):
+    """Build a shell script that writes stdin to remote_path atomically."""
+    return '\n'.join(
+        ['set -e', 'dest={}'.format(shlex.quote(remote_path))]
+        + _write_commands(owner, mode)
+    )
+
+
+def write_remote_file(conn, remote_path, source, owner=None, mode=None,
+                      use_sudo=True, chunk_size=CHUNK_SIZE):
+    """Stream data to a remote file over a single channel.
+    Parent directories are created as required, and the owner and mode
+    are applied before the file is moved into place.
+
+    :param conn: An open fabric connection.
+    :param remote_path: The path of the file on the remote host.
+    :param source: The content to write, as accepted by iter_chunks.
+    :param owner: The user (or user:group) that should own the file.
+    :param mode: The permissions for the file, as an int or octal string.
+    :return: The number of bytes transferred.
+    """
+    channel = _open_channel(
+        conn,
+        _sudo(
+            _write_script(posixpath.normpath(remote_path), owner, mode),
+            use_sudo,
+        ),
+    )
+    transferred = 0
+    try:
+        for data in iter_chunks(source, chunk_size):
+            channel.sendall(data)
+            transferred += len(data)
+        channel.shutdown_write()
+        _check_status(channel, 'write', remote_path)
+    finally:
+        channel.close()
+    return transferred
+
+
+Artifact = namedtuple('Artifact', ['remote_path', 'local_path', 'content',
+                                   'owner', 'mode'])
+
+
+class ArtifactBundle(object):
+    """Files and content to be written to a remote host in one transfer.
+    See write_remote_bundle.
+    """
+    def __init__(self):
+        self.artifacts = []
+
+    def add_file(self, remote_path, local_path, owner=None, mode=None):
+        """Add a local file. Unless mode is supplied, the remote file will
+        have the same permissions as the local file.
+        """
+        if mode is None:
+            mode = os.stat(local_path).st_mode & 0o7777
+        self.artifacts.append(
+            Artifact(remote_path, local_path, None, owner, mode))
+
+    def add_content(self, remote_path, content, owner=None, mode=0o644):
+        """Add content, which may be anything accepted by iter_chunks."""
+        content = b''.join(iter_chunks(content))
+        self.artifacts.append(
+            Artifact(remote_path, None, content, owner, mode))
+
+    def __len__(self):
+        return len(self.artifacts)
+
+    def archive(self):
+        """Return a tar archive of the artifacts, named by their index."""
+        archive = io.BytesIO()
+        with tarfile.open(fileobj=archive, mode='w') as tar:
+            for index, artifact in enumerate(self.artifacts):
+                if artifact.local_path:
+                    tar.add(artifact.local_path, arcname=str(index),
+                            recursive=False)
+                else:
+                    member = tarfile.TarInfo(str(index))
+                    member.size = len(artifact.content)
+                    tar.addfile(member, io.BytesIO(artifact.content))
+        return archive.getvalue()
+
+
+def _install_script(artifacts):
+    """Build a shell script that unpacks a bundle's archive from stdin,
+    then installs each artifact at its destination with its owner and mode.
+    """
+    commands = [
+        'set -e',
+        'tmp="$(mktemp -d)"',
+        'trap \'rm -rf -- "$tmp"\' EXIT',
+        'tar -x -C "$tmp"',
+    ]
+    for index, artifact in enumerate(artifacts):
+        commands.extend(_install_commands(
+            '"$tmp/{}"'.format(index),
+            artifact.remote_path, artifact.owner, artifact.mode,
+        ))
+    return '\n'.join(commands)
+
+
+def _install_commands(source, remote_path, owner, mode):
+    """Shell commands to copy source (already quoted) to remote_path."""
+    owner_args = ''
+    if owner:
+        user, _, group = owner.partition(':')
+        # Use the owner's login group, as if they had created the file
+        group = shlex.quote(group) if group else '"$(id -gn {})"'.format(
+            shlex.quote(user))
+        owner_args = '-o {} -g {} '.format(shlex.quote(user), group)
+    if not isinstance(mode, str):
+        mode = '{:o}'.format(mode)
+    dest = shlex.quote(posixpath.normpath(remote_path))
+    return [
+        'dir="$(dirname -- {})"'.format(dest),
+        # New directories belong to the owner, as with write_remote_file
+        '[ -d "$dir" ] || install -d {}-- "$dir"'.format(owner_args),
+        'install {owner}-m {mode} -- {source} {dest}'.format(
+            owner=owner_args, mode=shlex.quote(mode), source=source,
+            dest=dest,
+        ),
+    ]
+
+
+def write_remote_bundle(conn, bundle, use_sudo=True):
+    """Write every artifact in a bundle to the remote host over a single
+    channel, as one archive.
+
+    :param conn: An open fabric connection.
+    :param bundle: The ArtifactBundle to write.
+    :return: The number of bytes transferred.
+    """
+    if not bundle.artifacts:
+        return 0
+    archive = bundle.archive()
+    channel = _open_channel(
+        conn, _sudo(_install_script(bundle.artifacts), use_sudo),
+    )
+    try:
+        channel.sendall(archive)
+        channel.shutdown_write()
+        _check_status(
+            channel, 'write',
+            ', '.join(artifact.remote_path for artifact in bundle.artifacts),
+        )
+    finally:
+        channel.close()
+    return len(archive)
+
+
+def file_sha256(local_path):
+    """Return the sha256 of a local file, remembering it for as long as the
+    file is unchanged as the same files tend to be uploaded to many VMs.
+    """
+    stat = os.stat(local_path)
+    key = (os.path.abspath(local_path), stat.st_size, stat.st_mtime)
+    with _hashes_lock:
+        if key in _hashes:
+            return _hashes[key]
+    digest = hashlib.sha256()
+    with open(local_path, 'rb') as local_handle:
+        for data in iter_chunks(local_handle):
+            digest.update(data)
+    with _hashes_lock:
+        _hashes[key] = digest.hexdigest()
+    return _hashes[key]
+
+
+def _cached_write_script(sha, remote_path, owner=None, mode=None):
+    """Build a shell script that writes stdin to remote_path like
+    _write_script, unless the file there already has the content with the
+    given sha256, in which case only its owner and mode are set.
+    The script first prints _SEND or _SKIP, and only reads stdin for _SEND.
+    The index entry for the path saves hashing the file again when it is
+    unchanged since we wrote it; otherwise the file itself is hashed, so
+    that changes made by anything else on the remote host are noticed.
+    """
+    remote_path = posixpath.normpath(remote_path)
+    entry = shlex.quote(posixpath.join(
+        INDEX_DIR,
+        hashlib.sha256(remote_path.encode('utf-8')).hexdigest(),
+    ))
+    stamp = '{} $(stat -c "%s %Y" -- "$dest")'.format(sha)
+    return '\n'.join(
+        [
+            'set -e',
+            'dest={}'.format(shlex.quote(remote_path)),
+            'entry={}'.format(entry),
+            'mkdir -p -m 700 -- {}'.format(shlex.quote(INDEX_DIR)),
+            'if [ -f "$dest" ] && {{ '
+            '[ "$(cat -- "$entry" 2>/dev/null)" = "{stamp}" ] || '
+            '[ "$(sha256sum < "$dest" | cut -d" " -f1)" = {sha} ]; '
+            '}}; then'.format(stamp=stamp, sha=sha),
+            'echo {}'.format(_SKIP.decode('ascii')),
+        ]
+        + _owner_mode_commands('"$dest"', owner, mode)
+        + ['else', 'echo {}'.format(_SEND.decode('ascii'))]
+        + _write_commands(owner, mode)
+        + ['fi', 'echo "{}" > "$entry"'.format(stamp)]
+    )
+
+
+def write_remote_file_cached(conn, remote_path, local_path, owner=None,
+                             mode=None, use_sudo=True,
+                             chunk_size=CHUNK_SIZE):
+    """Write a local file to the remote host over a single channel, unless
+    the remote file already has the same content, in which case only its
+    owner and mode are set.
+
+    :param conn: An open fabric connection.
+    :param remote_path: The path of the file on the remote host.
+    :param local_path: The path of the local file.
+    :param owner: The user (or user:group) that should own the file.
+    :param mode: The permissions for the file, as an int or octal string.
+                 By default, the permissions of the local file are used.
+    :return: A tuple of (bytes transferred, bytes saved).
+    """
+    if mode is None:
+        mode = os.stat(local_path).st_mode & 0o7777
+    channel = _open_channel(
+        conn,
+        _sudo(
+            _cached_write_script(file_sha256(local_path), remote_path,
+                                 owner, mode),
+            use_sudo,
+        ),
+    )
+    transferred = 0
+    try:
+        action = channel.makefile('rb').readline().strip()
+        if action == _SEND:
+            with open(local_path, 'rb') as local_handle:
+                for data in iter_chunks(local_handle, chunk_size):
+                    channel.sendall(data)
+                    transferred += len(data)
+        channel.shutdown_write()
+        _check_status(channel, 'write', remote_path)
+    finally:
+        channel.close()
+    if action == _SKIP:
+        return 0, os.path.getsize(local_path)
+    return transferred, 0
@@ -0,0 +1,121 @@
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from cosmo_tester.framework import util
+
+
+class RestClientFactoryError(Exception):
+    pass
+
+
+class RestClientFactory(object):
+    """Create REST clients for one manager.
+
+    The protocol the manager expects is detected once and cached, as is the
+    CA cert used to verify it, and clients created with the same protocol
+    and TLS settings share one pool of keep-alive connections to the
+    manager.
+    Call invalidate() whenever the manager's SSL configuration or
+    certificates may have changed.
+    """
+    def __init__(self, address, logger, fetch_ca=None, pool_size=10):
+        """
+        :param address: The address of the manager.
+        :param fetch_ca: A callable which retrieves the manager's CA cert
+                         and returns its local path.
+        :param pool_size: The most connections to keep open to the manager.
+        """
+        self.address = address
+        self._logger = logger
+        self._fetch_ca = fetch_ca
+        self._pool_size = pool_size
+        self._lock = threading.Lock()
+        # Pooled connections keep the TLS settings they were opened with,
+        # so they are only shared by clients with the same settings
+        self._adapters = {}
+        self._protocol = None
+        self._ca_path = None
+
+        self.probes = 0
+        self.clients_created = 0
+
+    def _share_connections(self, session, protocol, cert=None,
+                           trust_all=False):
+        """Mount the adapter for a protocol and TLS settings on a session,
+        creating it if this is the first session to use them.
+        """
+        key = (self.address, protocol, cert, trust_all)
+        with self._lock:
+            adapter = self._adapters.get(key)
+            if adapter is None:
+                adapter = HTTPAdapter(pool_connections=1,
+                                      pool_maxsize=self._pool_size)
+                self._adapters[key] = adapter
+        session.mount('{}://'.format(protocol), adapter)
+
+    def protocol(self):
+        """Return the protocol the manager's REST service expects."""
+        with self._lock:
+            if self._protocol is None:
+                self.probes += 1
+                session = requests.Session()
+                ssl_check = session.get(
+                    'http://{}/api/v3.1/status'.format(self.address))
+                self._logger.info(
+                    'Rest client generation SSL check response: %s',
+                    ssl_check.text)
+                if 'SSL_REQUIRED' in ssl_check.text:
+                    self._protocol = 'https'
+                else:
+                    self._protocol = 'http'
+            return self._protocol
+
+    def ca_path(self):
+        """Return the local path of the manager's CA cert, retrieving it
+        if it hasn't been retrieved since the last invalidate().
+        """
+        with self._lock:
+            if self._ca_path is None and self._fetch_ca:
+                self._ca_path = self._fetch_ca()
+            return self._ca_path
+
+    def create_client(self, protocol, cert=None, **kwargs):
+        """Create a REST client which shares our connection pool.
+        Other arguments are as for util.create_rest_client.
+
+        :raises RestClientFactoryError: If the REST client doesn't keep a
+                                        requests session we can share
+                                        connections through.
+        """
+        client = util.create_rest_client(
+            self.address, cert=cert, protocol=protocol, **kwargs)
+        # This relies on the HTTP client of cloudify-rest-client sending
+        # every request through its _session
+        session = getattr(client._client, '_session', None)
+        if not isinstance(session, requests.Session):
+            raise RestClientFactoryError(
+                'REST client for {} has no requests session to share '
+                'connections through. cloudify-rest-client may have '
+                'changed.'.format(self.address)
+            )
+        self._share_connections(session, protocol, cert,
+                                kwargs.get('trust_all', False))
+        self.clients_created += 1
+        return client
+
+    def invalidate(self):
+        """Forget the detected protocol and CA cert, and close any pooled
+        connections, e.g. after the manager's certificates are replaced.
+        """
+        with self._lock:
+            self._logger.info('Resetting cached REST client settings for %s',
+                              self.address)
+            self._protocol = None
+            self._ca_path = None
+            # Clients already created keep the old adapters, but their idle
+            # connections (verified with the old certs) are closed.
+            for adapter in self._adapters.values():
+                adapter.close()
+            self._adapters = {}
@@ -0,0 +1,198 @@
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import time
+
+
+class SchedulerError(Exception):
+    """One or more scheduled tasks failed or could not be run."""
+
+
+class Quorum(object):
+    """A requirement that is met once enough of the named tasks have
+    succeeded. By default a majority is required.
+    """
+    def __init__(self, names, count=None):
+        self.names = list(names)
+        self.count = len(self.names) // 2 + 1 if count is None else count
+
+    def __repr__(self):
+        return '{count} of ({names})'.format(
+            count=self.count, names=', '.join(self.names),
+        )
+
+
+class Task(object):
+    def __init__(self, name, func, requires):
+        self.name = name
+        self.func = func
+        self.requires = requires
+        self.scheduled_at = None
+        self.started = None
+        self.finished = None
+        self.error = None
+        self.succeeded = False
+        # The task that finished last among those needed to start this one
+        self.gated_by = None
+
+    @property
+    def duration(self):
+        if self.started is None or self.finished is None:
+            return 0.0
+        return self.finished - self.started
+
+
+class DependencyScheduler(object):
+    """Run tasks on threads, starting each one as soon as everything it
+    requires has succeeded.
+
+    Requirements are task names, or Quorum objects for tasks that only need
+    some of a group to have succeeded. Once any task fails no new tasks are
+    started; tasks already running are allowed to finish, then a
+    SchedulerError is raised.
+    """
+    def __init__(self, logger, max_workers=None):
+        self._logger = logger
+        self._max_workers = max_workers
+        self.tasks = {}
+        self._order = []
+        self._start = None
+
+    def add(self, name, func, requires=()):
+        if name in self.tasks:
+            raise ValueError('Task {} was already added.'.format(name))
+        self.tasks[name] = Task(name, func, list(requires))
+        self._order.append(name)
+        return self.tasks[name]
+
+    def _requirement_names(self, requirement):
+        if isinstance(requirement, Quorum):
+            return requirement.names
+        return [requirement]
+
+    def _validate(self):
+        for task in self.tasks.values():
+            for requirement in task.requires:
+                for name in self._requirement_names(requirement):
+                    if name not in self.tasks:
+                        raise SchedulerError(
+                            'Task {task} requires unknown task {name}.'
+                            .format(task=task.name, name=name)
+                        )
+
+    def _gate(self, task):
+        """Return the task whose completion allowed this task to start,
+        or None if it had no requirements. If the requirements are not yet
+        met, return False.
+        """
+        gate = None
+        for requirement in task.requires:
+            if isinstance(requirement, Quorum):
+                candidates = [self.tasks[name] for name in requirement.names]
+                count = requirement.count
+            else:
+                candidates = [self.tasks[requirement]]
+                count = 1
+            succeeded = sorted(
+                (candidate for candidate in candidates
+                 if candidate.succeeded),
+                key=lambda candidate: candidate.finished,
+            )
+            if len(succeeded) < count:
+                return False
+            if count:
+                last = succeeded[count - 1]
+                if gate is None or last.finished > gate.finished:
+                    gate = last
+        return gate
+
+    def _run_task(self, task):
+        task.started = time.time()
+        try:
+            task.func()
+        finally:
+            task.finished = time.time()
+        task.succeeded = True
+
+    def run(self):
+        self._validate()
+        self._start = time.time()
+        pending = list(self._order)
+        running = {}
+        failed = []
+        max_workers = self._max_workers or max(len(pending), 1)
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            while pending or running:
+                if not failed:
+                    for name in list(pending):
+                        task = self.tasks[name]
+                        gate = self._gate(task)
+                        if gate is False:
+                            continue
+                        task.gated_by = gate
+                        task.scheduled_at = time.time()
+                        pending.remove(name)
+                        self._logger.info('Starting %s', name)
+                        running[executor.submit(self._run_task, task)] = task
+                if not running:
+                    break
+                done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                for future in done:
+                    task = running.pop(future)
+                    try:
+                        future.result()
+                    except Exception as err:
+                        task.error = err
+                        failed.append(task)
+                        self._logger.error('%s failed after %.1fs: %s',
+                                           task.name, task.duration, err)
+                    else:
+                        self._logger.info('%s finished after %.1fs',
+                                          task.name, task.duration)
+
+        self.log_report()
+        if failed:
+            raise SchedulerError(
+                'Failed tasks: {failed}. Not started: {pending}'.format(
+                    failed='; '.join('{}: {}'.format(task.name, task.error)
+                                     for task in failed),
+                    pending=', '.join(pending) or 'none',
+                )
+            )
+        if pending:
+            raise SchedulerError(
+                'Requirements could never be met for: {}'.format(
+                    ', '.join(pending),
+                )
+            )
+
+    def critical_path(self):
+        """Return the chain of tasks that determined the total run time,
+        in the order they ran.
+        """
+        finished = [task for task in self.tasks.values()
+                    if task.finished is not None]
+        if not finished:
+            return []
+        path = []
+        task = max(finished, key=lambda task: task.finished)
+        while task:
+            path.append(task)
+            task = task.gated_by
+        return list(reversed(path))
+
+    def log_report(self):
+        if self._start is None:
+            return
+        total = max(
+            [task.finished for task in self.tasks.values()
+             if task.finished is not None] or [self._start]
+        ) - self._start
+        self._logger.info('Scheduled tasks took %.1fs in total. '
+                          'Critical path:', total)
+        for task in self.critical_path():
+            self._logger.info(
+                '  %s: started at +%.1fs, ran for %.1fs%s',
+                task.name, task.started - self._start, task.duration,
+                ' (waiting for {})'.format(task.gated_by.name)
+                if task.gated_by else '',
+            )
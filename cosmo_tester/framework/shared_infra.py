@@ -0,0 +1,248 @@
+import hashlib
+import json
+import os
+import shutil
+import time
+import uuid
+
+from path import Path
+
+from cosmo_tester.framework.state_file import (
+    StateFile,
+    owner,
+    owner_is_alive,
+)
+from cosmo_tester.framework.util import SSHKey
+
+CREATING = 'creating'
+READY = 'ready'
+REAPING = 'reaping'
+# How often to check on infrastructure being created by another session
+CREATE_POLL_INTERVAL = 15
+
+
+def infrastructure_key(inputs, resource_paths, extra=()):
+    """Identify an infrastructure deployment by what it is created from.
+
+    :param inputs: The infrastructure deployment inputs, excluding any
+                   that are unique to the session that creates it.
+    :param resource_paths: The blueprints (and any other files) used for
+                           the infrastructure and the VMs deployed on it.
+    :param extra: Anything else that affects the infrastructure.
+    """
+    digest = hashlib.sha256()
+    digest.update(json.dumps(inputs, sort_keys=True).encode('utf-8'))
+    for path in resource_paths:
+        with open(path, 'rb') as resource_handle:
+            digest.update(hashlib.sha256(resource_handle.read()).digest())
+    for item in extra:
+        digest.update(str(item).encode('utf-8'))
+    return 'infra-' + digest.hexdigest()
+
+
+class SharedInfrastructure(object):
+    """Infrastructure deployments which are shared by test sessions.
+
+    Each infrastructure deployment (and the tenant holding it) is recorded
+    in a state file under its key, along with the sessions that hold it.
+    A session that finds no infrastructure for its key creates it, and
+    other sessions wanting the same infrastructure wait for it rather than
+    creating their own. Infrastructure with no holders is kept for
+    idle_ttl seconds in case another session wants it.
+    """
+    def __init__(self, test_config, logger):
+        config = test_config['shared_infrastructure']
+        self._logger = logger
+        self._base_dir = os.path.expanduser(config['directory'])
+        self._idle_ttl = config['idle_ttl']
+        self._lease_ttl = config['lease_ttl']
+        self._state = StateFile(
+            os.path.join(self._base_dir, 'shared_infra.json'))
+        self.owner = dict(owner(), holder=uuid.uuid4().hex)
+
+    def _keys_dir(self, tenant):
+        return Path(os.path.join(self._base_dir, 'keys', tenant))
+
+    def ssh_key(self, tenant):
+        """Return the SSH key that VMs on a tenant's shared infrastructure
+        are created with.
+        """
+        return SSHKey(self._keys_dir(tenant), self._logger)
+
+    def _holder_expired(self, holder, now):
+        return (
+            not owner_is_alive(holder)
+            or now - holder['acquired_at'] > self._lease_ttl
+        )
+
+    def acquire(self, key, timeout=60 * 60):
+        """Hold the infrastructure for a key, waiting for it if another
+        session is creating it.
+
+        :return: The infrastructure's record, or None if there is no such
+                 infrastructure, in which case the caller must create it
+                 and then call register() or abandon().
+        """
+        deadline = time.time() + timeout
+        while True:
+            now = time.time()
+            with self._state.locked() as state:
+                infras = state.setdefault('infrastructure', {})
+                infra = infras.get(key)
+                if infra is None or (
+                    infra['state'] == CREATING
+                    and self._holder_expired(infra['creator'], now)
+                ):
+                    infras[key] = {
+                        'state': CREATING,
+                        'creator': dict(self.owner, acquired_at=now),
+                        'holders': {},
+                    }
+                    self._logger.info('Creating shared infrastructure %s.',
+                                      key)
+                    return None
+                if infra['state'] == READY:
+                    infra['holders'][self.owner['holder']] = dict(
+                        self.owner, acquired_at=now,
+                    )
+                    self._logger.info(
+                        'Using shared infrastructure %s in tenant %s, '
+                        'shared with %d other holders.',
+                        key, infra['tenant'], len(infra['holders']) - 1,
+                    )
+                    return dict(infra)
+                # Being created by someone else
+            if now > deadline:
+                raise RuntimeError(
+                    'Timed out waiting for shared infrastructure {key} '
+                    'to be created.'.format(key=key)
+                )
+            self._logger.info('Waiting for shared infrastructure %s to be '
+                              'created by another session.', key)
+            time.sleep(CREATE_POLL_INTERVAL)
+
+    def register(self, key, tenant, blueprints, ssh_key, details):
+        """Record infrastructure created after acquire() returned None,
+        held by this session.
+
+        :param tenant: The infrastructure manager tenant holding it.
+        :param blueprints: The blueprints uploaded to that tenant.
+        :param ssh_key: The SSHKey the infrastructure was created with.
+        :param details: Anything else needed to deploy VMs on it.
+        """
+        keys_dir = self._keys_dir(tenant)
+        if not os.path.isdir(keys_dir):
+            os.makedirs(keys_dir)
+        shared_key = self.ssh_key(tenant)
+        for source, dest in [
+            (ssh_key.private_key_path, shared_key.private_key_path),
+            (ssh_key.public_key_path, shared_key.public_key_path),
+        ]:
+            shutil.copyfile(source, dest)
+        os.chmod(shared_key.private_key_path, 0o400)
+
+        now = time.time()
+        with self._state.locked() as state:
+            state.setdefault('infrastructure', {})[key] = {
+                'state': READY,
+                'tenant': tenant,
+                'blueprints': blueprints,
+                'details': details,
+                'created_at': now,
+                'released_at': now,
+                'holders': {
+                    self.owner['holder']: dict(self.owner, acquired_at=now),
+                },
+            }
+        self._logger.info('Registered shared infrastructure %s in tenant '
+                          '%s.', key, tenant)
+
+    def abandon(self, key):
+        """Give up on creating infrastructure after acquire() returned
+        None, letting another session try instead.
+        """
+        with self._state.locked() as state:
+            infras = state.get('infrastructure', {})
+            infra = infras.get(key)
+            if infra and infra['state'] == CREATING and (
+                infra['creator']['holder'] == self.owner['holder']
+            ):
+                infras.pop(key)
+
+    def release(self, key, tenant, broken=False):
+        """Stop holding infrastructure.
+
+        :param broken: The infrastructure is no longer usable, so it won't
+                       be handed out again, and will be reaped as soon as
+                       it has no other holders.
+        """
+        now = time.time()
+        with self._state.locked() as state:
+            infras = state.setdefault('infrastructure', {})
+            reaping = state.setdefault('reaping', {})
+            infra = infras.get(key)
+            if not infra or infra.get('tenant') != tenant:
+                infra = reaping.get(tenant)
+            if not infra:
+                return
+            infra['holders'].pop(self.owner['holder'], None)
+            infra['released_at'] = now
+            if broken and infras.get(key) is infra:
+                reaping[tenant] = dict(infras.pop(key), key=key)
+            remaining = len(infra['holders'])
+        self._logger.info('Released shared infrastructure %s, which has %d '
+                          'other holders.', key, remaining)
+
+    def _drop_expired_holders(self, infra, now):
+        for holder_id, holder in list(infra['holders'].items()):
+            if self._holder_expired(holder, now):
+                infra['holders'].pop(holder_id)
+
+    def reap(self):
+        """Claim infrastructure which has been idle for too long (or is
+        broken) for destruction by the caller. Call forget() for each once
+        it has been destroyed.
+        Claimed infrastructure no longer has a key, so sessions wanting
+        the same infrastructure will create it again rather than wait.
+
+        :return: A dict of {tenant: infrastructure record}.
+        """
+        now = time.time()
+        reaped = {}
+        with self._state.locked() as state:
+            infras = state.setdefault('infrastructure', {})
+            reaping = state.setdefault('reaping', {})
+            for key, infra in list(infras.items()):
+                if infra['state'] != READY:
+                    continue
+                self._drop_expired_holders(infra, now)
+                if (
+                    not infra['holders']
+                    and now - infra['released_at'] > self._idle_ttl
+                ):
+                    reaping[infra['tenant']] = dict(infras.pop(key), key=key)
+
+            for tenant, infra in reaping.items():
+                self._drop_expired_holders(infra, now)
+                if infra['holders']:
+                    # Still in use by sessions that found it broken
+                    continue
+                if 'reaper' in infra and not self._holder_expired(
+                    infra['reaper'], now,
+                ):
+                    # Someone else is already destroying it
+                    continue
+                infra.update(state=REAPING,
+                             reaper=dict(self.owner, acquired_at=now))
+                reaped[tenant] = dict(infra)
+
+        if reaped:
+            self._logger.info('Reaping %d shared infrastructure '
+                              'deployments.', len(reaped))
+        return reaped
+
+    def forget(self, tenant):
+        """Remove reaped infrastructure once it has been destroyed."""
+        with self._state.locked() as state:
+            state.get('reaping', {}).pop(tenant, None)
+        shutil.rmtree(self._keys_dir(tenant), ignore_errors=True)
@@ -0,0 +1,149 @@
+from contextlib import contextmanager
+import socket
+import threading
+import time
+
+from fabric import Connection
+from paramiko.ssh_exception import SSHException
+
+
+class SSHConnectionPool(object):
+    """Keep authenticated SSH connections to a single host open for reuse.
+
+    Connections are checked out exclusively, so one pool can safely be
+    shared between threads: each concurrent user gets its own connection,
+    and a new one is only opened when no idle connection is available.
+    Connections found to be dead are discarded and replaced.
+    """
+    def __init__(self, host, user, key_filename, logger, port=22,
+                 connect_timeout=3, max_idle=4, keepalive=15,
+                 max_idle_time=300):
+        self.host = host
+        self.user = user
+        self._key_filename = key_filename
+        self._logger = logger
+        self._port = port
+        self._connect_timeout = connect_timeout
+        self._max_idle = max_idle
+        self._keepalive = keepalive
+        self._max_idle_time = max_idle_time
+
+        self._lock = threading.Lock()
+        # (connection, time it was returned to the pool)
+        self._idle = []
+        self.hits = 0
+        self.misses = 0
+        self.reconnects = 0
+        self.discards = 0
+
+    def _open_connection(self):
+        conn = Connection(
+            host=self.host,
+            user=self.user,
+            connect_kwargs={
+                'key_filename': [self._key_filename],
+            },
+            port=self._port,
+            connect_timeout=self._connect_timeout,
+        )
+        conn.open()
+        if self._keepalive:
+            conn.client.get_transport().set_keepalive(self._keepalive)
+        return conn
+
+    def _acquire(self):
+        stale = []
+        conn = None
+        with self._lock:
+            while self._idle:
+                candidate, released_at = self._idle.pop()
+                if (
+                    candidate.is_connected
+                    and time.time() - released_at < self._max_idle_time
+                ):
+                    conn = candidate
+                    self.hits += 1
+                    break
+                stale.append(candidate)
+            if conn is None:
+                if stale:
+                    self.reconnects += 1
+                else:
+                    self.misses += 1
+
+        for candidate in stale:
+            self._close(candidate)
+
+        if conn is None:
+            conn = self._open_connection()
+        return conn
+
+    def _release(self, conn):
+        if conn.is_connected:
+            with self._lock:
+                if len(self._idle) < self._max_idle:
+                    self._idle.append((conn, time.time()))
+                    return
+        else:
+            with self._lock:
+                self.discards += 1
+        self._close(conn)
+
+    def _discard(self, conn):
+        with self._lock:
+            self.discards += 1
+        self._close(conn)
+
+    @staticmethod
+    def _close(conn):
+        try:
+            conn.close()
+        except Exception:
+            # We only care that it's no longer in use
+            pass
+
+    @contextmanager
+    def connection(self):
+        """Check out a connection for exclusive use by the caller."""
+        conn = self._acquire()
+        try:
+            yield conn
+        except (SSHException, EOFError, socket.error):
+            # The transport is probably broken, so don't hand it out again
+            self._discard(conn)
+            raise
+        except BaseException:
+            self._release(conn)
+            raise
+        else:
+            self._release(conn)
+
+    def close_all(self):
+        """Close all idle connections.
+        Connections currently checked out will be closed when they are
+        returned if they are no longer usable, or kept otherwise.
+        """
+        with self._lock:
+            idle = [conn for conn, _ in self._idle]
+            self._idle = []
+        for conn in idle:
+            self._close(conn)
+
+    @property
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'reconnects': self.reconnects,
+                'discards': self.discards,
+                'idle': len(self._idle),
+            }
+
+    def log_stats(self):
+        self._logger.info(
+            'SSH connection pool for %(host)s: %(hits)d hits, '
+            '%(misses)d misses, %(reconnects)d reconnects, '
+            '%(discards)d discards, %(idle)d idle.',
+            dict(self.stats, host=self.host),
+        )
@@ -0,0 +1,85 @@
+from contextlib import contextmanager
+import copy
+import errno
+import fcntl
+import json
+import os
+import socket
+import tempfile
+
+
+def owner():
+    """Identify this process (and xdist worker), e.g. as a lease holder."""
+    return {
+        'host': socket.gethostname(),
+        'pid': os.getpid(),
+        'worker': os.environ.get('PYTEST_XDIST_WORKER', 'master'),
+    }
+
+
+def owner_is_alive(owner):
+    """Whether the process identified by owner() may still be running."""
+    if not owner:
+        return False
+    if owner['host'] != socket.gethostname():
+        # We can't tell, so we'll rely on the lease expiring
+        return True
+    try:
+        os.kill(owner['pid'], 0)
+    except OSError as err:
+        return err.errno == errno.EPERM
+    return True
+
+
+class StateFile(object):
+    """A JSON document on disk that can be shared safely between test
+    sessions and xdist workers.
+
+    All access happens while holding an exclusive lock on a companion lock
+    file, and changes are written to a temporary file before being moved
+    into place so that readers never see a partially written document.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._lock_path = path + '.lock'
+
+    def _read(self):
+        if not os.path.exists(self.path):
+            return {}
+        with open(self.path) as state_handle:
+            return json.load(state_handle)
+
+    def _write(self, state):
+        state_dir = os.path.dirname(self.path)
+        fd, tmp_path = tempfile.mkstemp(dir=state_dir, prefix='.state_')
+        try:
+            with os.fdopen(fd, 'w') as state_handle:
+                json.dump(state, state_handle, indent=2, sort_keys=True)
+            os.rename(tmp_path, self.path)
+        except Exception:
+            os.unlink(tmp_path)
+            raise
+
+    @contextmanager
+    def locked(self):
+        """Yield the current state for modification, saving it when the
+        block exits without an exception.
+        """
+        state_dir = os.path.dirname(self.path)
+        if state_dir and not os.path.isdir(state_dir):
+            os.makedirs(state_dir)
+        # flock locks belong to the open file, so this also excludes other
+        # threads of this process that open the lock file themselves.
+        with open(self._lock_path, 'a') as lock_handle:
+            fcntl.flock(lock_handle, fcntl.LOCK_EX)
+            try:
+                state = self._read()
+                yield state
+                self._write(state)
+            finally:
+                fcntl.flock(lock_handle, fcntl.LOCK_UN)
+
+    def read(self):
+        """Return a copy of the current state."""
+        with self.locked() as state:
+            return copy.deepcopy(state)
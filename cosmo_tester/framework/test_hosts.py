@@ -2,33 +2,59 @@ from contextlib import contextmanager
 import copy
 from datetime import datetime
 import functools
-import hashlib
+import io
 import json
 import os
 import random
 import re
+import shlex
 import string
 import socket
 import subprocess
 import sys
+import threading
 import time
-import uuid
 import yaml
 
-from fabric import Connection
 from ipaddress import ip_address, ip_network
 from paramiko.ssh_exception import NoValidConnectionsError, SSHException
-import requests
 import retrying
 import textwrap
 import winrm
 
 from cloudify_rest_client.exceptions import CloudifyClientError
 
-from cosmo_tester.framework import util
-from cosmo_tester.framework.constants import CLOUDIFY_TENANT_HEADER
+from cosmo_tester.framework import (
+    bootstrap_watcher,
+    image_cache,
+    manager_reset,
+    parallel,
+    remote_files,
+    shared_infra,
+    timeline,
+    util,
+    vm_pool,
+)
+from cosmo_tester.framework.polling import PollingPolicy
+from cosmo_tester.framework.rest_clients import RestClientFactory
+from cosmo_tester.framework.ssh_pool import SSHConnectionPool
 
 HEALTHY_STATE = 'OK'
+# Where the state of a pooled VM, as it was when it was created, is kept
+PRISTINE_STATE_DIR = '/var/lib/cosmo_tester/pristine'
+
+
+def _remaining(deadline):
+    """Seconds left until a deadline, allowing at least one more check."""
+    return max(1, deadline - time.time())
+
+
+def _vm_span_attrs(vm, *args, **kwargs):
+    return {'vm': getattr(vm, 'deployment_id', None)}
+
+
+def _hosts_span_attrs(hosts, *args, **kwargs):
+    return {'instances': len(hosts.instances)}
 
 
 def only_manager(func):
@@ -40,6 +66,75 @@ def only_manager(func):
     return wrapped
 
 
+def run_on_all(nodes, command, sudo=False, warn_only=False,
+               hide_stdout=False, max_workers=parallel.DEFAULT_MAX_WORKERS,
+               logger=None):
+    """Run a command on several VMs at once.
+
+    :param nodes: The VMs to run the command on.
+    :param command: The command to run, or a function that takes a VM and
+                    returns the command to run on that VM.
+    :param sudo: Whether to run the command with sudo.
+    :param max_workers: The maximum number of VMs to run the command on at
+                        the same time.
+    :return: A list of ParallelResult, one per VM, in the same order as the
+             nodes. If the command fails on any VM then ParallelExecutionError
+             will be raised after it has finished on all of them.
+    """
+    def _run(node):
+        node_command = command(node) if callable(command) else command
+        return node.run_command(node_command, use_sudo=sudo,
+                                warn_only=warn_only, hide_stdout=hide_stdout)
+
+    return parallel.run_parallel(
+        _run, nodes, max_workers=max_workers, logger=logger,
+        description='Running {}'.format(
+            'command' if callable(command) else command),
+    )
+
+
+def wait_for_bootstraps(nodes, logger=None, timeout=None):
+    """Wait for bootstraps started on several VMs to finish.
+    Every VM is watched at the same time, so this takes as long as the
+    slowest bootstrap.
+    """
+    return parallel.run_parallel(
+        lambda node: node.wait_for_bootstrap(timeout=timeout),
+        nodes, max_workers=max(len(nodes), 1), logger=logger,
+        description='Waiting for bootstrap',
+    )
+
+
+def put_file_on_all(nodes, remote_path, local_path=None, content=None,
+                    owner=None, mode=None,
+                    max_workers=parallel.DEFAULT_MAX_WORKERS, logger=None):
+    """Put a file on several VMs at once.
+    Either local_path or content must be supplied. As the content is sent to
+    every VM it must be text or bytes, or a function that takes a VM and
+    returns the content for that VM.
+
+    :return: A list of ParallelResult, one per VM, in the same order as the
+             nodes.
+    """
+    if (local_path is None) == (content is None):
+        raise ValueError('Exactly one of local_path or content must be '
+                         'supplied.')
+
+    def _put(node):
+        if local_path is not None:
+            node.put_remote_file(remote_path, local_path,
+                                 owner=owner, mode=mode)
+        else:
+            node_content = content(node) if callable(content) else content
+            node.put_remote_file_content(remote_path, node_content,
+                                         owner=owner, mode=mode)
+
+    return parallel.run_parallel(
+        _put, nodes, max_workers=max_workers, logger=logger,
+        description='Putting {}'.format(remote_path),
+    )
+
+
 class VM(object):
     def __init__(self, image_type, test_config, bootstrappable=False):
         self.image_name = None
@@ -54,11 +149,28 @@ class VM(object):
         self._test_config = test_config
         self.windows = 'windows' in image_type
         self._tmpdir_base = None
+        self._ssh_pool = None
+        self._rest_clients = None
+        # Bytes not uploaded because the VM already had the content
+        self.upload_bytes_saved = 0
+        # Uploads may be made from several threads at once
+        self._upload_stats_lock = threading.Lock()
         self.bootstrappable = bootstrappable
         self.image_type = image_type
         self.is_manager = self._is_manager_image_type()
         self._set_image_details()
         self._installed_configs = []
+        # Identifies the install_config the manager was last installed with
+        self.installed_config_hash = None
+        # Whether the manager was reset after a test rather than torn down,
+        # so that it can be used again without being reinstalled
+        self.install_kept = False
+        # The image cache key of the manager installed in the image this VM
+        # was booted from, if it was booted from a cached image
+        self.cached_install_key = None
+        # Called with this VM after each bootstrap that could be cached
+        self.on_bootstrapped = None
+        self._bootstrap_cacheable = False
         if self.windows:
             self.prepare_for_windows()
 
@@ -81,28 +193,34 @@ class VM(object):
         self._logger = logger
         self._tmpdir_base = tmpdir
         self._tmpdir = os.path.join(tmpdir, public_ip_address)
-        os.makedirs(self._tmpdir)
+        if not os.path.isdir(self._tmpdir):
+            # A pooled VM may be assigned more than once in a session
+            os.makedirs(self._tmpdir)
         self.node_instance_id = node_instance_id
         self.deployment_id = deployment_id
         self.server_id = server_id
         self.server_index = server_index
         if self.is_manager:
             self.networks = networks
-            self.basic_install_config = {
-                'manager': {
-                    'public_ip': str(public_ip_address),
-                    'private_ip': str(private_ip_address),
-                    'hostname': str(server_id),
-                    'security': {
-                        'admin_username': self._test_config[
-                            'test_manager']['username'],
-                        'admin_password': self._test_config[
-                            'test_manager']['password'],
-                    },
-                },
-                'sanity': {'skip_sanity': True},
-            }
+            self.basic_install_config = self._basic_install_config(
+                public_ip_address, private_ip_address, server_id,
+            )
             self.install_config = copy.deepcopy(self.basic_install_config)
+            if self.cached_install_key:
+                # Installed in the image with the default config path
+                self._installed_configs = [None]
+        self._rest_clients = RestClientFactory(
+            self.ip_address, self._logger, fetch_ca=self.download_rest_ca,
+        )
+        if not self.windows:
+            # A pooled VM is assigned again each time it is leased
+            self.close_ssh_connections()
+            self._ssh_pool = SSHConnectionPool(
+                host=self.ip_address,
+                user=self.username,
+                key_filename=self.private_key_path,
+                logger=self._logger,
+            )
         self._create_conn_script()
 
     def _create_conn_script(self):
@@ -182,6 +300,7 @@ $user.SetInfo()""".format(fw_cmd=add_firewall_cmd,
             'Get-Content -Path {}'.format(path),
             powershell=True).std_out
 
+    @timeline.timed('vm.wait_for_ssh', _vm_span_attrs)
     @retrying.retry(stop_max_attempt_number=60, wait_fixed=3000)
     def wait_for_ssh(self):
         if self.enable_ssh_wait:
@@ -194,20 +313,18 @@ $user.SetInfo()""".format(fw_cmd=add_firewall_cmd,
 
     @contextmanager
     def ssh(self):
-        conn = Connection(
-            host=self.ip_address,
-            user=self.username,
-            connect_kwargs={
-                'key_filename': [self.private_key_path],
-            },
-            port=22,
-            connect_timeout=3,
-        )
-        try:
-            conn.open()
+        """Get an SSH connection to this VM.
+        Connections are pooled, so this will usually reuse an already
+        authenticated connection rather than opening a new one.
+        """
+        with self._ssh_pool.connection() as conn:
             yield conn
-        finally:
-            conn.close()
+
+    def close_ssh_connections(self):
+        """Close any pooled SSH connections to this VM."""
+        if self._ssh_pool:
+            self._ssh_pool.log_stats()
+            self._ssh_pool.close_all()
 
     def __str__(self):
         if self.is_manager:
@@ -224,6 +341,9 @@ $user.SetInfo()""".format(fw_cmd=add_firewall_cmd,
         # clean shutdown
         self.run_command('shutdown -h now', warn_only=True, use_sudo=True)
         while True:
+            # Pooled connections would hang rather than failing to connect
+            # once the server is down, so always check with a fresh one.
+            self._ssh_pool.close_all()
             try:
                 self.run_command('echo Still up...')
                 time.sleep(3)
@@ -238,6 +358,7 @@ $user.SetInfo()""".format(fw_cmd=add_firewall_cmd,
                 self._logger.info('Server stopped.')
                 break
 
+    @timeline.timed('vm.finalize_preparation', _vm_span_attrs)
     def finalize_preparation(self):
         """Complete preparations for using a new instance."""
         self._logger.info('Finalizing server preparations.')
@@ -278,90 +399,121 @@ print('{{}} {{}}'.format(distro, codename).lower())
 
     def get_remote_file(self, remote_path, local_path):
         """ Dump the contents of the remote file into the local path """
-        # Similar to the way fabric1 did it
-        remote_tmp = '/tmp/' + hashlib.sha1(
-            remote_path.encode('utf-8')).hexdigest()
-        self.run_command(
-            'cp {} {}'.format(remote_path, remote_tmp),
-            use_sudo=True,
-        )
-        self.run_command(
-            'chmod 444 {}'.format(remote_tmp),
-            use_sudo=True,
-        )
-
-        with self.ssh() as fabric_ssh:
-            fabric_ssh.get(
-                remote_tmp,
-                local_path,
-            )
+        try:
+            with open(local_path, 'wb') as local_handle:
+                with self.ssh() as fabric_ssh:
+                    remote_files.read_remote_file(
+                        fabric_ssh, remote_path, local_handle,
+                    )
+        except Exception:
+            # Don't leave a partial file behind for anything checking
+            # whether the file was already retrieved
+            if os.path.exists(local_path):
+                os.unlink(local_path)
+            raise
 
-    def put_remote_file(self, remote_path, local_path):
-        """ Dump the contents of the local file into the remote path """
+    def put_remote_file(self, remote_path, local_path, owner=None,
+                        mode=None):
+        """ Dump the contents of the local file into the remote path.
+        The remote file will be owned by the SSH user and have the same
+        permissions as the local file unless owner or mode are supplied.
+        The file is not sent if the remote file already has its content.
+        """
         if self.windows:
             with open(local_path) as fh:
                 content = fh.read()
             self.put_remote_file_content(remote_path, content)
         else:
-            remote_tmp = '/tmp/' + hashlib.sha1(
-                remote_path.encode('utf-8')).hexdigest()
-            self.run_command(
-                'rm -rf {}'.format(remote_tmp),
-                use_sudo=True,
-            )
             with self.ssh() as fabric_ssh:
-                # Similar to the way fabric1 did it
-                fabric_ssh.put(
-                    local_path,
-                    remote_tmp,
+                _, saved = remote_files.write_remote_file_cached(
+                    fabric_ssh, remote_path, local_path,
+                    owner=owner or self.username,
+                    mode=mode,
                 )
-            self.run_command(
-                'mkdir -p {}'.format(
-                    os.path.dirname(remote_path),
-                ),
-                use_sudo=True,
-            )
-            self.run_command(
-                'mv {} {}'.format(remote_tmp, remote_path),
-                use_sudo=True,
+            if saved:
+                with self._upload_stats_lock:
+                    self.upload_bytes_saved += saved
+                    total_saved = self.upload_bytes_saved
+                self._logger.info(
+                    'Skipped uploading %s to %s, as the VM already had its '
+                    'content (%d bytes saved, %d in total).',
+                    local_path, remote_path, saved, total_saved,
+                )
+
+    def put_remote_bundle(self, bundle):
+        """Write every file in a remote_files.ArtifactBundle to this VM
+        with one transfer. Files without an owner will be owned by the SSH
+        user.
+        :return: The number of bytes transferred.
+        """
+        if self.windows:
+            for artifact in bundle.artifacts:
+                if artifact.local_path:
+                    self.put_remote_file(artifact.remote_path,
+                                         artifact.local_path)
+                else:
+                    self.put_remote_file_content(artifact.remote_path,
+                                                 artifact.content)
+            return None
+        owned = remote_files.ArtifactBundle()
+        owned.artifacts = [
+            artifact._replace(owner=artifact.owner or self.username)
+            for artifact in bundle.artifacts
+        ]
+        with self.ssh() as fabric_ssh:
+            return remote_files.write_remote_bundle(fabric_ssh, owned)
+
+    def stream_remote_file(self, remote_path, out_stream):
+        """Write the contents of the remote file to a binary stream.
+        :return: The number of bytes transferred.
+        """
+        with self.ssh() as fabric_ssh:
+            return remote_files.read_remote_file(
+                fabric_ssh, remote_path, out_stream,
             )
 
-    def get_remote_file_content(self, remote_path):
-        tmp_local_path = os.path.join(self._tmpdir, str(uuid.uuid4()))
+    def iter_remote_file(self, remote_path):
+        """Yield the contents of the remote file as chunks of bytes."""
+        with self.ssh() as fabric_ssh:
+            for chunk in remote_files.iter_remote_file(fabric_ssh,
+                                                       remote_path):
+                yield chunk
 
-        try:
-            self.get_remote_file(remote_path, tmp_local_path)
-            with open(tmp_local_path, 'r') as f:
-                content = f.read()
-        finally:
-            if os.path.exists(tmp_local_path):
-                os.unlink(tmp_local_path)
-        return content
-
-    def put_remote_file_content(self, remote_path, content):
+    def get_remote_file_bytes(self, remote_path):
+        content = io.BytesIO()
+        self.stream_remote_file(remote_path, content)
+        return content.getvalue()
+
+    def get_remote_file_content(self, remote_path):
+        return self.get_remote_file_bytes(remote_path).decode('utf-8')
+
+    def put_remote_file_content(self, remote_path, content, owner=None,
+                                mode=None):
+        """Write content to the remote path.
+        content can be text, bytes, a file-like object, or an iterable of
+        text or bytes chunks, and is streamed directly to the remote file.
+        The remote file will be owned by the SSH user unless owner is
+        supplied.
+        """
         if self.windows:
+            content = b''.join(remote_files.iter_chunks(content))
             self.run_command(
                 "Add-Content -Path {} -Value '{}'".format(
                     remote_path,
                     # Single quoted string will not be interpreted
                     # But single quotes must be represented in such a string
                     # with double single quotes
-                    content.replace("'", "''"),
+                    content.decode('utf-8').replace("'", "''"),
                 ),
                 powershell=True,
             )
         else:
-            tmp_local_path = os.path.join(self._tmpdir, str(uuid.uuid4()))
-
-            try:
-                with open(tmp_local_path, 'w') as f:
-                    f.write(content)
-
-                self.put_remote_file(remote_path, tmp_local_path)
-
-            finally:
-                if os.path.exists(tmp_local_path):
-                    os.unlink(tmp_local_path)
+            with self.ssh() as fabric_ssh:
+                remote_files.write_remote_file(
+                    fabric_ssh, remote_path, content,
+                    owner=owner or self.username,
+                    mode=mode,
+                )
 
     def run_command(self, command, use_sudo=False, warn_only=False,
                     hide_stdout=False, powershell=False):
@@ -403,23 +555,30 @@ print('{{}} {{}}'.format(distro, codename).lower())
             tenant_name)
 
     def _upload_plugin(self, plugin_path, tenant_name):
-        with util.set_client_tenant(self.client, tenant_name):
-            try:
-                self.client.plugins.upload(
-                    util.get_resource_path(plugin_path),
-                )
-                self.wait_for_all_executions(include_system_workflows=True)
-            except CloudifyClientError as err:
-                if self._test_config['premium']:
-                    raise
-                # On community this can happen if multiple tests use the
-                # same manager (because the first will upload the plugin and
-                # the later test(s) will then conflict due to it existing).
-                # Premium avoids this with multiple tenants.
-                if 'already exists' in str(err):
-                    pass
-                else:
-                    raise
+        client = util.tenant_client(self.client, tenant_name)
+        plugin_path = util.get_resource_path(plugin_path)
+        package_name, package_version = util.get_plugin_package(plugin_path)
+        if client.plugins.list(package_name=package_name,
+                               package_version=package_version,
+                               _include=['id']):
+            self._logger.info('Plugin %s %s is already available to %s, '
+                              'not uploading it again.', package_name,
+                              package_version, tenant_name)
+            return
+        try:
+            client.plugins.upload(plugin_path)
+            self.wait_for_all_executions(include_system_workflows=True)
+        except CloudifyClientError as err:
+            if self._test_config['premium']:
+                raise
+            # On community this can happen if multiple tests use the
+            # same manager (because the first will upload the plugin and
+            # the later test(s) will then conflict due to it existing).
+            # Premium avoids this with multiple tenants.
+            if 'already exists' in str(err):
+                pass
+            else:
+                raise
 
     @only_manager
     @retrying.retry(stop_max_attempt_number=6 * 10, wait_fixed=10000)
@@ -454,6 +613,7 @@ print('{{}} {{}}'.format(distro, codename).lower())
                     display_name, service['status'])
 
     @only_manager
+    @timeline.timed('vm.teardown', _vm_span_attrs)
     def teardown(self, kill_certs=True):
         self._logger.info('Tearing down using any installed configs')
         for config_name in self._installed_configs:
@@ -461,11 +621,114 @@ print('{{}} {{}}'.format(distro, codename).lower())
             self._logger.info('Tearing down using {}'.format(config_path))
             self.run_command('cfy_manager remove -c {}'.format(config_path))
         self._installed_configs = []
+        self.installed_config_hash = None
+        self.install_kept = False
+        self.cached_install_key = None
         if kill_certs:
             self._logger.info('Removing certs directory')
             self.run_command('sudo rm -rf /etc/cloudify/ssl')
         if self.api_ca_path and os.path.exists(self.api_ca_path):
             os.unlink(self.api_ca_path)
+        if self._rest_clients:
+            self._rest_clients.invalidate()
+
+    def record_pristine_state(self):
+        """Record the state of this freshly provisioned VM that tests may
+        change, so that reset_for_reuse can restore it.
+        """
+        self.run_command(
+            'if [ ! -f {dir}/complete ]; then '
+            '  sudo mkdir -p {dir} && '
+            '  hostname | sudo tee {dir}/hostname >/dev/null && '
+            '  sudo cp /etc/hosts {dir}/hosts && '
+            '  rpm -qa | sort | sudo tee {dir}/rpms >/dev/null && '
+            '  ls -A ~ | sort | sudo tee {dir}/home >/dev/null && '
+            '  ls -A /opt | sort | sudo tee {dir}/opt >/dev/null && '
+            '  sudo touch {dir}/complete; '
+            'fi'.format(dir=PRISTINE_STATE_DIR)
+        )
+
+    def reset_for_reuse(self):
+        """Return this VM to the state recorded by record_pristine_state,
+        so that it can be used again, e.g. after being leased from the VM
+        pool.
+        This removes agents, anything installed by cfy_manager, packages
+        and files added to the home directory or /opt, and restores the
+        hostname and /etc/hosts.
+        """
+        self.wait_for_ssh()
+        self.run_command(
+            'set -e; '
+            'test -f {dir}/complete; '
+            'for unit in /etc/systemd/system/cloudify-worker-*.service; do '
+            '  [ -f "$unit" ] || continue; '
+            '  name=$(basename "$unit" .service); '
+            '  sudo systemctl stop "$name" || true; '
+            '  sudo systemctl disable "$name" || true; '
+            '  sudo rm -f "$unit" "/etc/default/$name"; '
+            'done; '
+            'sudo systemctl daemon-reload; '
+            'for config in /etc/cloudify/*config.yaml; do '
+            '  if [ -f "$config" ]; then '
+            '    cfy_manager remove -c "$config"; '
+            '  fi; '
+            'done; '
+            'rpm -qa | sort > /tmp/cosmo_tester_rpms; '
+            'extra=$(comm -13 {dir}/rpms /tmp/cosmo_tester_rpms); '
+            'if [ -n "$extra" ]; then sudo yum remove -y $extra; fi; '
+            'cd ~ && ls -A | sort | comm -13 {dir}/home - '
+            '  | xargs -r -d "\\n" sudo rm -rf; '
+            'cd /opt && ls -A | sort | comm -13 {dir}/opt - '
+            '  | xargs -r -d "\\n" sudo rm -rf; '
+            'sudo hostnamectl set-hostname "$(cat {dir}/hostname)"; '
+            'sudo cp {dir}/hosts /etc/hosts; '
+            'sudo rm -rf /etc/cloudify/ssl /tmp/bs_logs /tmp/cloudify.conf '
+            '  /tmp/bootstrap_complete /tmp/bootstrap_failed '
+            '  /tmp/cosmo_tester_rpms {index}'.format(
+                dir=PRISTINE_STATE_DIR, index=remote_files.INDEX_DIR,
+            )
+        )
+        self._installed_configs = []
+        self.installed_config_hash = None
+        self.install_kept = False
+        self.cached_install_key = None
+
+    def authorize_ssh_key(self, public_key):
+        """Allow SSH access to this VM with another public key."""
+        self.run_command(
+            'grep -qxF {key} ~/.ssh/authorized_keys '
+            '|| echo {key} >> ~/.ssh/authorized_keys'.format(
+                key=shlex.quote(public_key.strip()),
+            )
+        )
+
+    def _basic_install_config(self, public_ip_address='',
+                              private_ip_address='', server_id=''):
+        return {
+            'manager': {
+                'public_ip': str(public_ip_address),
+                'private_ip': str(private_ip_address),
+                'hostname': str(server_id),
+                'security': {
+                    'admin_username': self._test_config[
+                        'test_manager']['username'],
+                    'admin_password': self._test_config[
+                        'test_manager']['password'],
+                },
+            },
+            'sanity': {'skip_sanity': True},
+        }
+
+    @only_manager
+    def image_cache_key(self, install_config=None):
+        """The key of the cached image of this manager once bootstrapped
+        with an install config, by default the basic one.
+        """
+        return image_cache.cache_key(
+            install_config or self._basic_install_config(),
+            self._test_config['testing_version'],
+            self.image_name,
+        )
 
     @only_manager
     def _create_config_file(self, upload_license=True):
@@ -482,6 +745,7 @@ print('{{}} {{}}'.format(distro, codename).lower())
         return config_file
 
     @only_manager
+    @timeline.timed('vm.apply_license', _vm_span_attrs)
     def apply_license(self):
         license = util.get_resource_path('test_valid_paying_license.yaml')
         self.client.license.upload(license)
@@ -494,18 +758,39 @@ print('{{}} {{}}'.format(distro, codename).lower())
             return '/etc/cloudify/config.yaml'
 
     @only_manager
+    @timeline.timed('vm.bootstrap', _vm_span_attrs)
     def bootstrap(self, upload_license=False,
                   blocking=True, restservice_expected=True, config_name=None,
                   include_sanity=False):
         if self.image_type == '5.0.5':
             # We don't have a bootstrappable 5.0.5, so skip this
             return
+        if self.install_kept:
+            # Kept by manager_reset.keep_install, but not reused
+            self.teardown()
         if include_sanity:
             self.install_config['sanity']['skip_sanity'] = False
         self.wait_for_ssh()
+        # The install may change the SSL settings and certs of the manager
+        self._rest_clients.invalidate()
         self.restservice_expected = restservice_expected
         install_config = self._create_config_file(
             upload_license and self._test_config['premium'])
+        from_cache = (
+            self.cached_install_key is not None
+            and config_name is None
+            and self.cached_install_key == self.image_cache_key(
+                self.install_config)
+        )
+        if self.cached_install_key and not from_cache:
+            self._logger.info('Install config differs from the cached '
+                              'image this VM was booted from, removing '
+                              'the cached install.')
+            self.teardown()
+        self.cached_install_key = None
+        self._bootstrap_cacheable = not from_cache and config_name is None
+        self.installed_config_hash = manager_reset.install_config_hash(
+            self.install_config)
         with self.ssh() as fabric_ssh:
             # If we leave this lying around on a compact cluster, we think we
             # finished bootstrapping every component after the first as soon
@@ -513,17 +798,23 @@ print('{{}} {{}}'.format(distro, codename).lower())
             fabric_ssh.run('rm -f /tmp/bootstrap_complete')
 
             fabric_ssh.run('mkdir -p /tmp/bs_logs')
-            self.put_remote_file(
-                '/tmp/cloudify.conf',
-                install_config,
-            )
+            bundle = remote_files.ArtifactBundle()
+            bundle.add_file('/tmp/cloudify.conf', install_config)
             if upload_license:
-                self.put_remote_file(
+                bundle.add_file(
                     '/tmp/test_valid_paying_license.yaml',
                     util.get_resource_path('test_valid_paying_license.yaml'),
                 )
 
-            if config_name:
+            if from_cache:
+                # Already installed, but with the addresses and certs of
+                # the VM the image was captured from
+                commands = [
+                    'sudo mv /tmp/cloudify.conf /etc/cloudify/config.yaml',
+                    'sudo cfy_manager image-starter > '
+                    '/tmp/bs_logs/3_install 2>&1'
+                ]
+            elif config_name:
                 dest_config_path = self._get_config_path(config_name)
                 self._installed_configs.append(config_name)
                 commands = [
@@ -550,75 +841,69 @@ print('{{}} {{}}'.format(distro, codename).lower())
                 self.ip_address,
             )
             install_file.write_text(install_command)
-            self.put_remote_file('/tmp/bootstrap_script', install_file)
+            bundle.add_file('/tmp/bootstrap_script', install_file)
+            self.put_remote_bundle(bundle)
 
             fabric_ssh.run('nohup bash /tmp/bootstrap_script &>/dev/null &')
 
         if blocking:
-            while True:
-                if self.bootstrap_is_complete():
-                    break
-                else:
-                    time.sleep(5)
+            self.wait_for_bootstrap()
 
     @only_manager
-    def bootstrap_is_complete(self):
+    def wait_for_bootstrap(self, timeout=None):
+        """Wait for a bootstrap started with blocking=False to finish,
+        then finalize preparation of this VM.
+        """
         if self.image_type == '5.0.5':
             # We don't have a bootstrappable 5.0.5, so we use pre-bootstrapped
-            return True
+            return
 
-        with self.ssh() as fabric_ssh:
-            # Using a bash construct because fabric seems to change its mind
-            # about how non-zero exit codes should be handled frequently
-            result = fabric_ssh.run(
-                'if [[ -f /tmp/bootstrap_complete ]]; then'
-                '  echo done; '
-                'elif [[ -f /tmp/bootstrap_failed ]]; then '
-                '  echo failed; '
-                'else '
-                '  echo not done; '
-                'fi'
-            ).stdout.strip()
-
-            if result == 'done':
-                self._logger.info('Bootstrap complete.')
-                self.finalize_preparation()
-                return True
-            else:
-                # To aid in troubleshooting (e.g. where a VM runs commands too
-                # slowly)
-                fabric_ssh.run('date > /tmp/cfy_mgr_last_check_time')
-                if result == 'failed':
-                    self._logger.error('BOOTSTRAP FAILED!')
-                    # Get all the logs on failure
-                    fabric_ssh.run(
-                        'cat /tmp/bs_logs/*'
-                    )
-                    raise RuntimeError('Bootstrap failed.')
-                else:
-                    fabric_ssh.run(
-                        'tail -n5 /tmp/bs_logs/* || echo Waiting for logs'
-                    )
-                    self._logger.info('Bootstrap in progress...')
-                    return False
+        if bootstrap_watcher.watch_bootstrap(self, self._logger, timeout):
+            self._logger.info('Bootstrap complete.')
+            self.finalize_preparation()
+            if self.on_bootstrapped and self._bootstrap_cacheable:
+                self.on_bootstrapped(self)
+        else:
+            self._logger.error('BOOTSTRAP FAILED!')
+            raise RuntimeError('Bootstrap failed.')
 
     @only_manager
-    @retrying.retry(stop_max_attempt_number=200, wait_fixed=1000)
-    def wait_for_all_executions(self, include_system_workflows=True):
-        executions = self.client.executions.list(
-            include_system_workflows=include_system_workflows,
-            _all_tenants=True,
-            _get_all_results=True
-        )
-        for execution in executions:
-            if execution['status'] != 'terminated':
+    def wait_for_all_executions(self, include_system_workflows=True,
+                                timeout=200, polling=None):
+        polling = polling or PollingPolicy()
+        deadline = time.time() + timeout
+        while True:
+            try:
+                executions = self.client.executions.list(
+                    include_system_workflows=include_system_workflows,
+                    _all_tenants=True,
+                    _get_all_results=True
+                )
+            except CloudifyClientError as err:
+                if time.time() > deadline:
+                    raise
+                self._logger.warning('Failed to list executions: %s', err)
+                polling.wait()
+                continue
+
+            unfinished = sorted(
+                (execution['id'], execution['status'])
+                for execution in executions
+                if execution['status'] != 'terminated'
+            )
+            if not unfinished:
+                self._logger.info('Polling for all executions: %s', polling)
+                return
+            if time.time() > deadline:
                 raise Exception(
                     'Timed out: Execution {} did not terminate'.format(
-                        execution['id'],
+                        unfinished[0][0],
                     )
                 )
+            polling.wait(unfinished)
 
     @only_manager
+    @timeline.timed('vm.wait_for_manager', _vm_span_attrs)
     @retrying.retry(stop_max_attempt_number=60, wait_fixed=5000)
     def wait_for_manager(self):
         self._logger.info('Checking for starter service')
@@ -641,6 +926,7 @@ print('{{}} {{}}'.format(distro, codename).lower())
                 self._logger.info(
                     'Detected that SSL was required, '
                     'updating certs and client.')
+                self._rest_clients.invalidate()
                 self.client = self.get_rest_client()
             raise
 
@@ -666,19 +952,12 @@ print('{{}} {{}}'.format(distro, codename).lower())
         tenant = tenant or test_mgr_conf['tenant']
 
         if proto == 'auto':
-            proto = 'http'
-            ssl_check = requests.get(
-                'http://{}/api/v3.1/status'.format(self.ip_address))
-            self._logger.info('Rest client generation SSL check response: %s',
-                              ssl_check.text)
-            if 'SSL_REQUIRED' in ssl_check.text:
-                proto = 'https'
+            proto = self._rest_clients.protocol()
 
         if proto == 'https' and download_ca:
-            self.download_rest_ca()
+            self._rest_clients.ca_path()
 
-        return util.create_rest_client(
-            self.ip_address,
+        return self._rest_clients.create_client(
             username=username,
             password=password,
             tenant=tenant,
@@ -688,6 +967,9 @@ print('{{}} {{}}'.format(distro, codename).lower())
 
     @only_manager
     def download_rest_ca(self, force=False):
+        if force:
+            # The certs have probably been replaced
+            self._rest_clients.invalidate()
         self.api_ca_path = self._tmpdir / self.server_id + '_api.crt'
         if os.path.exists(self.api_ca_path):
             if force:
@@ -695,12 +977,13 @@ print('{{}} {{}}'.format(distro, codename).lower())
             else:
                 self._logger.info('Skipping rest CA download, already in %s',
                                   self.api_ca_path)
-                return
+                return self.api_ca_path
         self._logger.info('Downloading rest CA to %s', self.api_ca_path)
         self.get_remote_file(
             '/etc/cloudify/ssl/cloudify_internal_ca_cert.pem',
             self.api_ca_path,
         )
+        return self.api_ca_path
 
     @only_manager
     def enable_nics(self):
@@ -850,6 +1133,9 @@ class Hosts(object):
         self._test_config = test_config
         self._tmpdir = tmpdir
         self._ssh_key = ssh_key
+        # The key our VMs are created with, which differs from the session's
+        # key when they are deployed on shared infrastructure
+        self._vm_ssh_key = ssh_key
         self.preconfigure_callback = None
         if instances is None:
             self.instances = [VM('master', test_config, bootstrappable)
@@ -862,26 +1148,87 @@ class Hosts(object):
         self.blueprints = []
         self.test_identifier = None
         self._test_vm_installs = {}
+        # When the current phase of each VM deployment started, for timing
+        self._test_vm_phase_started = {}
         self._test_vm_uninstalls = {}
         self._platform_resource_ids = {}
+        # The pool records of our instances, if they belong to the VM pool
+        self._pooled_vms = None
 
         self.multi_net = multi_net
         self.vm_net_mappings = vm_net_mappings or {}
 
         infra_mgr_config = self._test_config['infrastructure_manager']
-        self._infra_client = util.create_rest_client(
+        self._admin_infra_client = util.create_rest_client(
             infra_mgr_config['address'],
             username='admin',
             password=infra_mgr_config['admin_password'],
             cert=infra_mgr_config['ca_cert'],
             protocol='https' if infra_mgr_config['ca_cert'] else 'http',
         )
+        # Acts on the test tenant once it exists
+        self._infra_client = self._admin_infra_client
 
         if flavor:
             self.server_flavor = flavor
         else:
             self.server_flavor = self._test_config.platform['linux_size']
 
+        self._vm_pool = None
+        if self._test_config['vm_pool']['enabled'] and self._poolable():
+            self._vm_pool = vm_pool.VMPool(self._test_config, self._logger)
+
+        self._shared_infra = None
+        # The key and tenant of the shared infrastructure we're using
+        self._shared_infra_key = None
+        self._shared_infra_tenant = None
+        if (
+            self._test_config['shared_infrastructure']['enabled']
+            and not self._vm_pool
+        ):
+            self._shared_infra = shared_infra.SharedInfrastructure(
+                self._test_config, self._logger,
+            )
+
+        self._image_cache = None
+        if self._test_config['image_cache']['enabled']:
+            self._image_cache = image_cache.ImageCache(self._test_config,
+                                                       self._logger)
+            for instance in self.instances:
+                if instance.is_manager:
+                    instance.on_bootstrapped = self._capture_image
+
+    def _poolable(self):
+        """Whether our instances can be taken from and returned to the VM
+        pool. Pre-bootstrapped managers can't be reset to a clean image,
+        and multi-net VMs depend on the network layout of their test.
+        """
+        if self.multi_net:
+            return False
+        return all(
+            not instance.windows
+            and (instance.bootstrappable or not instance.is_manager)
+            for instance in self.instances
+        )
+
+    def run_on_all(self, command, nodes=None, sudo=False, **kwargs):
+        """Run a command on all (or the specified) instances at once.
+        See run_on_all in this module for details.
+        """
+        return run_on_all(self.instances if nodes is None else nodes,
+                          command, sudo=sudo, logger=self._logger, **kwargs)
+
+    def put_file_on_all(self, remote_path, local_path=None, content=None,
+                        nodes=None, **kwargs):
+        """Put a file on all (or the specified) instances at once.
+        See put_file_on_all in this module for details.
+        """
+        return put_file_on_all(self.instances if nodes is None else nodes,
+                               remote_path, local_path=local_path,
+                               content=content, logger=self._logger,
+                               **kwargs)
+
+    @timeline.timed('hosts.create', _hosts_span_attrs)
     def create(self):
         """Creates the infrastructure for a Cloudify manager."""
         self._logger.info('Creating image based cloudify instances: '
@@ -903,24 +1250,8 @@ class Hosts(object):
         self.test_identifier = test_identifier
 
         try:
-            self._logger.info('Creating test tenant')
-            self._infra_client.tenants.create(test_identifier)
-            self._infra_client._client.headers[
-                CLOUDIFY_TENANT_HEADER] = test_identifier
-            self.tenant = test_identifier
-
-            self._upload_secrets_to_infrastructure_manager()
-            self._upload_plugins_to_infrastructure_manager()
-            self._upload_blueprints_to_infrastructure_manager()
-
-            self._deploy_test_infrastructure(test_identifier)
-
-            # Deploy hosts in parallel
-            for index, instance in enumerate(self.instances):
-                self._start_deploy_test_vm(instance.image_name, index,
-                                           test_identifier,
-                                           instance.is_manager)
-            self._finish_deploy_test_vms()
+            if not self._lease_from_pool():
+                self._provision(test_identifier)
 
             for instance in self.instances:
                 if instance.is_manager and not instance.bootstrappable:
@@ -930,14 +1261,25 @@ class Hosts(object):
                         upload_license=self._test_config['premium'],
                         blocking=False)
 
-            for instance in self.instances:
-                if instance.is_manager and not instance.bootstrappable:
-                    self._logger.info('Waiting for instance %s to bootstrap',
-                                      instance.image_name)
-                    while not instance.bootstrap_is_complete():
-                        time.sleep(3)
-                if instance.should_finalize:
-                    instance.finalize_preparation()
+            bootstrapped = [
+                instance for instance in self.instances
+                if instance.is_manager and not instance.bootstrappable
+            ]
+            if bootstrapped:
+                self._logger.info('Waiting for %d instances to bootstrap',
+                                  len(bootstrapped))
+                # This finalizes the instances as each bootstrap completes
+                with timeline.span('hosts.wait_for_bootstraps'):
+                    wait_for_bootstraps(bootstrapped, logger=self._logger)
+
+            parallel.run_parallel(
+                lambda instance: instance.finalize_preparation(),
+                [instance for instance in self.instances
+                 if instance.should_finalize
+                 and instance not in bootstrapped],
+                logger=self._logger,
+                description='Finalizing test VMs',
+            )
         except Exception as err:
             self._logger.error(
                 "Encountered exception trying to create test resources: %s.\n"
@@ -946,6 +1288,376 @@ class Hosts(object):
             self.destroy()
             raise
 
+    def _provision(self, test_identifier):
+        """Provision our instances, on shared infrastructure if that is
+        enabled, or else in a new infrastructure tenant.
+        """
+        if self._shared_infra:
+            infrastructure_name = self._use_shared_infrastructure(
+                test_identifier)
+            # Other sessions deploy their VMs in the same tenant
+            vm_id_prefix = '{}_'.format(test_identifier)
+        else:
+            self._create_infrastructure(test_identifier)
+            infrastructure_name = test_identifier
+            vm_id_prefix = ''
+
+        self._deploy_test_vms(infrastructure_name, vm_id_prefix)
+
+        if self._vm_ssh_key is not self._ssh_key:
+            self._authorize_session_key()
+
+        if self._vm_pool:
+            self._add_to_pool()
+
+    @timeline.timed('hosts.deploy_vms', _hosts_span_attrs)
+    def _deploy_test_vms(self, infrastructure_name, vm_id_prefix):
+        # Deploy hosts in parallel. Nothing uses a VM until all of them are
+        # installed, so they are assigned together once the installs finish.
+        parallel.run_parallel(
+            lambda index: self._start_deploy_test_vm(
+                self.instances[index].image_name, index,
+                infrastructure_name, self.instances[index].is_manager,
+                vm_id_prefix, self._boot_image(self.instances[index]),
+            ),
+            range(len(self.instances)),
+            logger=self._logger,
+            description='Creating test VM deployments',
+        )
+        self._finish_deploy_test_vms()
+
+    def _boot_image(self, instance):
+        """Find a cached image to boot a manager from, already installed
+        with the basic install config.
+
+        :return: The image name, or None if the instance should be booted
+                 from its usual image.
+        """
+        instance.cached_install_key = None
+        if not (self._image_cache and instance.is_manager):
+            return None
+        key = instance.image_cache_key()
+        image = self._image_cache.lookup(key)
+        if image:
+            instance.cached_install_key = key
+        return image
+
+    def _capture_image(self, instance):
+        """Snapshot a freshly bootstrapped manager into the image cache,
+        so that later managers with the same install config can be booted
+        from it. Failures are only logged, as the manager is still usable.
+        This blocks until the image has been created (timed as
+        vm.capture_image), as the test must not change the manager before
+        its disk has been captured, so the first test to bootstrap with
+        each install config pays for creating its image.
+        """
+        key = instance.image_cache_key(instance.install_config)
+        if not self._image_cache.claim(key):
+            return
+        client = self._infra_client
+        for vm in self._pooled_vms or []:
+            if vm['deployment_id'] == instance.deployment_id:
+                client = util.tenant_client(self._admin_infra_client,
+                                            vm['tenant'])
+        self._logger.info('Capturing image %s from %s.', key,
+                          instance.deployment_id)
+        try:
+            with timeline.span('vm.capture_image',
+                               vm=instance.deployment_id):
+                instance.run_command('sync')
+                util.run_blocking_execution(
+                    client, instance.deployment_id, 'execute_operation',
+                    self._logger,
+                    params={
+                        'operation': 'cloudify.interfaces.snapshot.create',
+                        'node_ids': ['test_host'],
+                        'operation_kwargs': {
+                            'snapshot_name': key,
+                            'snapshot_incremental': True,
+                        },
+                    },
+                )
+        except Exception as err:
+            self._image_cache.abandon(key)
+            self._logger.warning('Failed to capture image %s: %s', key, err)
+            return
+        self._image_cache.add(
+            key, image_cache.snapshot_image_name(instance.server_id, key),
+        )
+
+    @timeline.timed('hosts.create_infrastructure')
+    def _create_infrastructure(self, test_identifier):
+        """Create a new infrastructure tenant and deploy the test
+        infrastructure in it.
+        """
+        self._logger.info('Creating test tenant')
+        with timeline.span('infra.create_tenant'):
+            self._admin_infra_client.tenants.create(test_identifier)
+        self._infra_client = util.tenant_client(self._admin_infra_client,
+                                                test_identifier)
+        self.tenant = test_identifier
+
+        self._upload_secrets_to_infrastructure_manager()
+        self._upload_plugins_to_infrastructure_manager()
+        self._upload_blueprints_to_infrastructure_manager()
+
+        self._deploy_test_infrastructure(test_identifier)
+
+    def _shared_infrastructure_key(self):
+        platform = self._test_config.platform
+        inputs = self._infrastructure_inputs()
+        inputs.pop('test_infrastructure_name')
+        return shared_infra.infrastructure_key(
+            inputs,
+            [path for _, path in self._infrastructure_blueprints()],
+            extra=[
+                self._test_config['target_platform'],
+                self._test_config['infrastructure_manager']['address'],
+                self.multi_net,
+                # Changed credentials need new secrets in the tenant
+                sorted(
+                    (name, platform[mapping])
+                    for name, mapping in platform.get(
+                        'secrets_mapping', {}).items()
+                ),
+            ],
+        )
+
+    @timeline.timed('hosts.use_shared_infrastructure')
+    def _use_shared_infrastructure(self, test_identifier):
+        """Use shared infrastructure, creating it if no other session has.
+
+        :return: The name the infrastructure was created with.
+        """
+        key = self._shared_infrastructure_key()
+        infra = self._shared_infra.acquire(key)
+        if infra is not None:
+            self._infra_client = util.tenant_client(
+                self._admin_infra_client, infra['tenant'])
+            try:
+                self._infra_client.deployments.get(
+                    'infrastructure', _include=['id'])
+            except CloudifyClientError as err:
+                self._logger.warning(
+                    'Shared infrastructure in tenant %s is unusable, '
+                    'creating new infrastructure: %s', infra['tenant'], err,
+                )
+                self._shared_infra.release(key, infra['tenant'],
+                                           broken=True)
+                infra = self._shared_infra.acquire(key)
+
+        if infra is None:
+            try:
+                self._create_infrastructure(test_identifier)
+            except Exception:
+                self._shared_infra.abandon(key)
+                raise
+            details = {
+                'network_mappings': {
+                    name: str(network)
+                    for name, network in getattr(
+                        self, 'network_mappings', {}).items()
+                },
+                'platform_resource_ids': self._platform_resource_ids,
+            }
+            self._shared_infra.register(key, self.tenant, self.blueprints,
+                                        self._ssh_key, details)
+            infra = {'tenant': self.tenant, 'details': details}
+            # The infrastructure now belongs to everyone sharing it
+            self.tenant = None
+            self.blueprints = []
+            self.deployments = []
+
+        self._shared_infra_key = key
+        self._shared_infra_tenant = infra['tenant']
+        self._infra_client = util.tenant_client(self._admin_infra_client,
+                                                infra['tenant'])
+        self._vm_ssh_key = self._shared_infra.ssh_key(infra['tenant'])
+        self._platform_resource_ids = infra['details'][
+            'platform_resource_ids']
+        if self.multi_net:
+            self.network_mappings = {
+                name: ip_network(u'{}'.format(network))
+                for name, network in infra['details'][
+                    'network_mappings'].items()
+            }
+        return infra['tenant']
+
+    @timeline.timed('hosts.authorize_session_key')
+    def _authorize_session_key(self):
+        """Allow access to our VMs with the session's SSH key, as tests
+        expect it to work on all of their VMs.
+        """
+        with open(self._ssh_key.public_key_path) as ssh_pubkey_handle:
+            ssh_pubkey = ssh_pubkey_handle.read()
+        with open(self._vm_ssh_key.public_key_path) as vm_pubkey_handle:
+            if vm_pubkey_handle.read() == ssh_pubkey:
+                return
+
+        def _authorize(instance):
+            instance.wait_for_ssh()
+            instance.authorize_ssh_key(ssh_pubkey)
+
+        parallel.run_parallel(
+            _authorize,
+            [instance for instance in self.instances
+             if not instance.windows],
+            logger=self._logger,
+            description='Authorizing session SSH key',
+        )
+
+    @timeline.timed('hosts.lease_from_pool')
+    def _lease_from_pool(self):
+        """Try to take all of our instances from the VM pool.
+
+        :return: True if the instances were leased and are ready to use.
+        """
+        if not self._vm_pool:
+            return False
+        leased = self._vm_pool.lease([
+            (instance.image_name, self.server_flavor)
+            for instance in self.instances
+        ])
+        if not leased:
+            return False
+
+        for index, (instance, vm) in enumerate(zip(self.instances, leased)):
+            instance.assign(
+                vm['public_ip'],
+                vm['private_ip'],
+                {},
+                self._vm_pool.ssh_key(vm['tenant']),
+                self._logger,
+                self._tmpdir,
+                vm['node_instance_id'],
+                vm['deployment_id'],
+                vm['server_id'],
+                index,
+            )
+        # Tests expect the session's key to work on all of their VMs, e.g.
+        # to install agents on them from a manager.
+        with open(self._ssh_key.public_key_path) as ssh_pubkey_handle:
+            ssh_pubkey = ssh_pubkey_handle.read()
+
+        def _prepare(instance):
+            instance.reset_for_reuse()
+            instance.authorize_ssh_key(ssh_pubkey)
+
+        results = parallel.run_parallel(
+            _prepare,
+            self.instances,
+            raise_on_error=False,
+            logger=self._logger,
+            description='Resetting pooled VMs',
+        )
+        for vm, result in zip(leased, results):
+            vm['healthy'] = result.ok
+        if all(result.ok for result in results):
+            self._pooled_vms = leased
+            return True
+
+        self._logger.warning(
+            'Could not reset pooled VMs, provisioning new VMs instead: %s',
+            parallel.ParallelExecutionError(results),
+        )
+        for instance in self.instances:
+            instance.close_ssh_connections()
+        self._vm_pool.release(leased)
+        return False
+
+    def _add_to_pool(self):
+        """Hand our newly provisioned instances over to the VM pool.
+        The pool then owns the tenant, which will be torn down once all of
+        its VMs have been reaped.
+        """
+        parallel.run_parallel(
+            lambda instance: instance.record_pristine_state(),
+            self.instances,
+            logger=self._logger,
+            description='Recording pristine state of pooled VMs',
+        )
+        self._pooled_vms = [
+            {
+                'tenant': self.tenant,
+                'deployment_id': instance.deployment_id,
+                'image': instance.image_name,
+                'flavor': self.server_flavor,
+                'public_ip': instance.ip_address,
+                'private_ip': instance.private_ip_address,
+                'node_instance_id': instance.node_instance_id,
+                'server_id': instance.server_id,
+            }
+            for instance in self.instances
+        ]
+        self._vm_pool.register(self.tenant, self.blueprints, self._ssh_key,
+                               self._pooled_vms)
+        self.tenant = None
+
+    @timeline.timed('teardown.return_to_pool')
+    def _return_to_pool(self):
+        results = parallel.run_parallel(
+            lambda instance: instance.run_command('true'),
+            self.instances,
+            raise_on_error=False,
+            logger=self._logger,
+            description='Checking pooled VMs',
+        )
+        for vm, result in zip(self._pooled_vms, results):
+            vm['healthy'] = result.ok
+        self._vm_pool.release(self._pooled_vms)
+        self._pooled_vms = None
+
+    def _abandon_pool_lease(self):
+        """Give back pooled VMs that are being left as they are, marked as
+        unhealthy so that they will be reaped rather than leased again.
+        """
+        if not self._pooled_vms:
+            return
+        self._logger.info('Releasing %d pooled VMs without resetting them. '
+                          'They will be destroyed when the pool is next '
+                          'reaped.', len(self._pooled_vms))
+        for vm in self._pooled_vms:
+            vm['healthy'] = False
+        self._vm_pool.release(self._pooled_vms)
+        self._pooled_vms = None
+
+    @timeline.timed('teardown.reap_pool')
+    def _reap_pool(self):
+        """Destroy VMs (and then tenants) that have expired from the pool.
+        Failures are logged rather than raised, as the pool will retry
+        them later.
+        """
+        vms, tenants = self._vm_pool.reap()
+        vms_by_tenant = {}
+        for vm in vms:
+            vms_by_tenant.setdefault(vm['tenant'], []).append(vm)
+
+        for tenant in sorted(set(vms_by_tenant).union(tenants)):
+            self._infra_client = util.tenant_client(
+                self._admin_infra_client, tenant)
+            try:
+                tenant_vms = vms_by_tenant.get(tenant, [])
+                if tenant_vms:
+                    self._test_vm_uninstalls = {}
+                    self._start_undeploy_test_vms(
+                        [vm['deployment_id'] for vm in tenant_vms],
+                    )
+                    self._finish_undeploy_test_vms()
+                    for vm in tenant_vms:
+                        self._vm_pool.forget(vm=vm)
+                if tenant in tenants:
+                    self._delete_tenant_resources(
+                        tenant, tenants[tenant]['blueprints'],
+                    )
+                    self._vm_pool.forget(tenant=tenant)
+            except Exception as err:
+                self._logger.error(
+                    'Failed to reap VMs from tenant %s, this will be '
+                    'retried later: %s', tenant, err,
+                )
+        self._infra_client = self._admin_infra_client
+
+    @timeline.timed('hosts.destroy', _hosts_span_attrs)
     def destroy(self, passed=None):
         """Destroys the infrastructure. """
         if passed is None:
@@ -962,6 +1674,7 @@ class Hosts(object):
                     'To tear down, clean deployments on your test manager '
                     'under tenant {}'.format(self.test_identifier)
                 )
+                self._abandon_pool_lease()
                 return
         else:
             if self._test_config['teardown']['on_failure']:
@@ -972,14 +1685,26 @@ class Hosts(object):
                     'To tear down, clean deployments on your test manager '
                     'under tenant {}'.format(self.test_identifier)
                 )
+                self._abandon_pool_lease()
                 return
 
         self._logger.info('Destroying test hosts..')
-        if self.tenant:
+        if self._pooled_vms:
+            self._return_to_pool()
+        for instance in self.instances:
+            instance.close_ssh_connections()
+        if self.tenant or self._shared_infra_key:
+            deadline = time.time() + self._test_config['teardown']['timeout']
             self._logger.info('Ensuring executions are stopped.')
-            cancelled = []
-            execs = self._infra_client.executions.list()
-            for execution in execs:
+            to_cancel = []
+            for execution in self._infra_client.executions.list(
+                _include=['id', 'workflow_id', 'deployment_id'],
+            ):
+                if self._shared_infra_key and (
+                    execution['deployment_id'] not in self.deployments
+                ):
+                    # Belongs to another session sharing the tenant
+                    continue
                 if execution['workflow_id'] != (
                     'create_deployment_environment'
                 ):
@@ -988,10 +1713,7 @@ class Hosts(object):
                         execution['id'],
                         execution['workflow_id'],
                     )
-                    self._infra_client.executions.cancel(
-                        execution['id'], force=True, kill=True
-                    )
-                    cancelled.append(execution['id'])
+                    to_cancel.append(execution['id'])
                 else:
                     self._logger.info(
                         'Skipping %s (%s).',
@@ -999,25 +1721,11 @@ class Hosts(object):
                         execution['workflow_id'],
                     )
 
-            cancel_complete = []
-            for execution_id in cancelled:
-                self._logger.info('Checking {} is cancelled.'.format(
-                    execution_id,
-                ))
-                for _ in range(30):
-                    execution = self._infra_client.executions.get(
-                        execution_id)
-                    self._logger.info('{} is in state {}.'.format(
-                        execution_id,
-                        execution['status'],
-                    ))
-                    if execution['status'] == 'cancelled':
-                        cancel_complete.append(execution_id)
-                        break
-                    else:
-                        time.sleep(3)
-
-            cancel_failures = set(cancelled).difference(cancel_complete)
+            with timeline.span('teardown.cancel_executions'):
+                cancel_failures = util.cancel_executions(
+                    self._infra_client, to_cancel, self._logger,
+                    timeout=min(90, _remaining(deadline)),
+                )
             if cancel_failures:
                 self._logger.error(
                     'Teardown failed due to the following executions not '
@@ -1027,44 +1735,121 @@ class Hosts(object):
                 )
                 raise RuntimeError('Could not complete teardown.')
 
-            self._start_undeploy_test_vms()
-            self._finish_undeploy_test_vms()
+            try:
+                self._start_undeploy_test_vms()
+                self._finish_undeploy_test_vms(
+                    timeout=_remaining(deadline))
+            finally:
+                if self._shared_infra_key:
+                    self._shared_infra.release(self._shared_infra_key,
+                                               self._shared_infra_tenant)
+                    self._shared_infra_key = None
+
+            if self.tenant:
+                self._delete_tenant_resources(self.tenant, self.blueprints,
+                                              deadline)
+                self.tenant = None
+            self._infra_client = self._admin_infra_client
+
+        if self._vm_pool:
+            self._reap_pool()
+        if self._shared_infra:
+            self._reap_shared_infra()
+        if self._image_cache:
+            with timeline.span('teardown.delete_dropped_images'):
+                self._image_cache.delete_dropped()
+
+    @timeline.timed('teardown.reap_shared_infrastructure')
+    def _reap_shared_infra(self):
+        """Destroy shared infrastructure that is no longer wanted, along
+        with any VMs left on it by sessions that didn't finish.
+        Failures are logged rather than raised, as reaping will be retried
+        later.
+        """
+        for tenant, infra in sorted(self._shared_infra.reap().items()):
+            self._infra_client = util.tenant_client(
+                self._admin_infra_client, tenant)
+            try:
+                abandoned = [
+                    deployment['id']
+                    for deployment in self._infra_client.deployments.list(
+                        _include=['id'], _get_all_results=True,
+                    )
+                    if deployment['id'] != 'infrastructure'
+                ]
+                if abandoned:
+                    self._test_vm_uninstalls = {}
+                    self._start_undeploy_test_vms(abandoned)
+                    self._finish_undeploy_test_vms()
+                self._delete_tenant_resources(tenant, infra['blueprints'])
+                self._shared_infra.forget(tenant)
+            except Exception as err:
+                self._logger.error(
+                    'Failed to reap shared infrastructure in tenant %s, '
+                    'this will be retried later: %s', tenant, err,
+                )
+        self._infra_client = self._admin_infra_client
+
+    @timeline.timed('teardown.delete_tenant_resources')
+    def _delete_tenant_resources(self, tenant, blueprints, deadline=None):
+        """Uninstall the infrastructure of a tenant once its VMs are gone,
+        then delete the tenant and everything uploaded to it.
 
-            self._logger.info('Uninstalling infrastructure')
+        :param deadline: When (as a timestamp) this must be finished by.
+        """
+        if deadline is None:
+            deadline = time.time() + self._test_config['teardown']['timeout']
+        self._logger.info('Uninstalling infrastructure')
+        with timeline.span('teardown.uninstall_infrastructure'):
             util.run_blocking_execution(
                 self._infra_client, 'infrastructure', 'uninstall',
-                self._logger)
-            util.delete_deployment(self._infra_client, 'infrastructure',
-                                   self._logger)
-
-            self._logger.info('Deleting blueprints.')
-            for blueprint in self.blueprints:
-                self._logger.info('Deleting %s', blueprint)
-                self._infra_client.blueprints.delete(blueprint)
-
-            self._logger.info('Deleting plugins.')
-            plugins = self._infra_client.plugins.list()
-            for plugin in plugins:
-                if plugin["tenant_name"] != self.tenant:
-                    self._logger.info(
-                        'Skipping shared %s (%s)',
-                        plugin['package_name'],
-                        plugin['id'],
-                    )
-                else:
-                    self._logger.info(
-                        'Deleting %s (%s)',
-                        plugin['package_name'],
-                        plugin['id'],
-                    )
-                    self._infra_client.plugins.delete(plugin['id'])
+                self._logger, timeout=_remaining(deadline))
+            util.delete_deployments(self._infra_client, ['infrastructure'],
+                                    self._logger,
+                                    timeout=min(90, _remaining(deadline)))
+
+        def _delete_blueprint(blueprint):
+            self._logger.info('Deleting %s', blueprint)
+            self._infra_client.blueprints.delete(blueprint)
+
+        self._logger.info('Deleting blueprints.')
+        with timeline.span('teardown.delete_blueprints'):
+            parallel.run_parallel(_delete_blueprint, blueprints,
+                                  logger=self._logger,
+                                  description='Deleting blueprints')
+
+        plugins = []
+        for plugin in self._infra_client.plugins.list(
+            _include=['id', 'package_name', 'tenant_name'],
+        ):
+            if plugin["tenant_name"] != tenant:
+                self._logger.info(
+                    'Skipping shared %s (%s)',
+                    plugin['package_name'],
+                    plugin['id'],
+                )
+            else:
+                plugins.append(plugin)
 
-            self._logger.info('Deleting tenant %s', self.tenant)
-            self._infra_client._client.headers[
-                CLOUDIFY_TENANT_HEADER] = 'default_tenant'
-            self._infra_client.tenants.delete(self.tenant)
-            self.tenant = None
+        def _delete_plugin(plugin):
+            self._logger.info(
+                'Deleting %s (%s)',
+                plugin['package_name'],
+                plugin['id'],
+            )
+            self._infra_client.plugins.delete(plugin['id'])
+
+        self._logger.info('Deleting plugins.')
+        with timeline.span('teardown.delete_plugins'):
+            parallel.run_parallel(_delete_plugin, plugins,
+                                  logger=self._logger,
+                                  description='Deleting plugins')
+
+        self._logger.info('Deleting tenant %s', tenant)
+        with timeline.span('teardown.delete_tenant'):
+            self._admin_infra_client.tenants.delete(tenant)
 
+    @timeline.timed('infra.upload_secrets')
     def _upload_secrets_to_infrastructure_manager(self):
         self._logger.info(
             'Uploading secrets to infrastructure manager.'
@@ -1083,6 +1868,7 @@ class Hosts(object):
             "ssh_public_key", ssh_pubkey,
         )
 
+    @timeline.timed('infra.check_plugins')
     def _upload_plugins_to_infrastructure_manager(self):
         plugin_details = self._test_config.platform
         current_plugins = self._infra_client.plugins.list(_all_tenants=True)
@@ -1101,45 +1887,52 @@ class Hosts(object):
                 )
             )
 
-    def _upload_blueprints_to_infrastructure_manager(self):
-        self._logger.info(
-            'Uploading test blueprints to infrastructure manager.'
-        )
+    def _infrastructure_blueprints(self):
+        """The IDs and paths of the blueprints for the infrastructure and
+        its VMs, in the order they should be uploaded.
+        """
+        platform = self._test_config['target_platform']
         suffix = '-multi-net' if self.multi_net else ""
-        self._infra_client.blueprints.upload(
+        blueprints = [(
+            'infrastructure',
             util.get_resource_path(
                 'infrastructure_blueprints/{}/infrastructure{}.yaml'.format(
-                    self._test_config['target_platform'],
+                    platform,
                     suffix,
                 )
             ),
-            "infrastructure",
-            async_upload=True
-        )
-        util.wait_for_blueprint_upload(self._infra_client, "infrastructure")
+        )]
 
-        self.blueprints.append('infrastructure')
         test_vm_suffixes = ['']
         if self.multi_net:
             test_vm_suffixes.append('-multi-net')
-
         for suffix in test_vm_suffixes:
-            blueprint_id = "test_vm{}".format(suffix)
-            self._infra_client.blueprints.upload(
+            blueprints.append((
+                'test_vm{}'.format(suffix),
                 util.get_resource_path(
                     'infrastructure_blueprints/{}/vm{}.yaml'.format(
-                        self._test_config['target_platform'],
+                        platform,
                         suffix,
                     )
                 ),
+            ))
+        return blueprints
+
+    @timeline.timed('infra.upload_blueprints')
+    def _upload_blueprints_to_infrastructure_manager(self):
+        self._logger.info(
+            'Uploading test blueprints to infrastructure manager.'
+        )
+        for blueprint_id, blueprint_path in self._infrastructure_blueprints():
+            self._infra_client.blueprints.upload(
+                blueprint_path,
                 blueprint_id,
                 async_upload=True
             )
             util.wait_for_blueprint_upload(self._infra_client, blueprint_id)
-            self.blueprints.append('test_vm{}'.format(suffix))
+            self.blueprints.append(blueprint_id)
 
-    def _deploy_test_infrastructure(self, test_identifier):
-        self._logger.info('Creating test infrastructure inputs.')
+    def _infrastructure_inputs(self, test_identifier=None):
         infrastructure_inputs = {'test_infrastructure_name': test_identifier}
         mappings = self._test_config.platform.get(
             'infrastructure_inputs_mapping', {})
@@ -1148,6 +1941,12 @@ class Hosts(object):
             infrastructure_inputs[blueprint_input] = (
                 self._test_config.platform[mapping]
             )
+        return infrastructure_inputs
+
+    @timeline.timed('infra.install')
+    def _deploy_test_infrastructure(self, test_identifier):
+        self._logger.info('Creating test infrastructure inputs.')
+        infrastructure_inputs = self._infrastructure_inputs(test_identifier)
 
         # Written to disk to aid in troubleshooting
         infrastructure_inputs_path = self._tmpdir / 'infra_inputs.yaml'
@@ -1186,15 +1985,16 @@ class Hosts(object):
         if self._test_config['target_platform'] == 'aws':
             self._populate_aws_platform_properties()
 
-    def _start_deploy_test_vm(self, image_id, index, test_identifier,
-                              is_manager):
+    def _start_deploy_test_vm(self, image_id, index, infrastructure_name,
+                              is_manager, vm_id_prefix='', boot_image=None):
         self._logger.info(
             'Preparing to deploy instance %d of image %s',
             index,
             image_id,
         )
 
-        vm_id = 'vm_{}_{}'.format(
+        vm_id = '{}vm_{}_{}'.format(
+            vm_id_prefix,
             image_id
             .replace(' ', '_')
             .replace('(', '_')
@@ -1208,7 +2008,7 @@ class Hosts(object):
         self._logger.info('Creating test VM inputs for %s_%d',
                           image_id, index)
         vm_inputs = {
-            'test_infrastructure_name': test_identifier,
+            'test_infrastructure_name': infrastructure_name,
             'userdata': self.instances[index].userdata,
             'flavor': self.server_flavor,
         }
@@ -1216,7 +2016,7 @@ class Hosts(object):
             vm_inputs['floating_network_id'] = (
                 self._test_config['openstack']['floating_network_id']
             )
-            vm_inputs['image'] = image_id
+            vm_inputs['image'] = boot_image or image_id
         elif self._test_config['target_platform'] == 'aws':
             vm_inputs.update(self._platform_resource_ids)
             if self.multi_net:
@@ -1251,65 +2051,98 @@ class Hosts(object):
             inp_handle.write(json.dumps(vm_inputs))
 
         self._logger.info('Deploying instance %d of %s', index, image_id)
-        util.create_deployment(
+        self._test_vm_phase_started[vm_id] = time.time()
+        execution = util.start_deployment_creation(
             self._infra_client, blueprint_id, vm_id, self._logger,
             inputs=vm_inputs,
         )
         self.deployments.append(vm_id)
-        self._test_vm_installs[vm_id] = (
-            self._infra_client.executions.start(
-                vm_id, 'install',
-            ),
-            index,
-        )
+        # Replaced by the install execution once the environment is created
+        self._test_vm_installs[vm_id] = (execution, index)
 
     def _populate_aws_platform_properties(self):
         self._logger.info('Retrieving AWS resource IDs')
-        resource_ids = {}
-
-        subnet = util.get_node_instances(
-            'test_subnet_1', 'infrastructure', self._infra_client)[0]
-        resource_ids['subnet_id'] = subnet['runtime_properties'][
-            'aws_resource_id']
+        resource_nodes = {
+            'subnet_id': 'test_subnet_1',
+            'vpc_id': 'vpc',
+            'security_group_id': 'security_group',
+        }
         if self.multi_net:
-            subnet_2 = util.get_node_instances(
-                'test_subnet_2', 'infrastructure', self._infra_client)[0]
-            resource_ids['subnet_2_id'] = subnet_2['runtime_properties'][
-                'aws_resource_id']
-            subnet_3 = util.get_node_instances(
-                'test_subnet_3', 'infrastructure', self._infra_client)[0]
-            resource_ids['subnet_3_id'] = subnet_3['runtime_properties'][
-                'aws_resource_id']
-
-        vpc = util.get_node_instances(
-            'vpc', 'infrastructure', self._infra_client)[0]
-        resource_ids['vpc_id'] = vpc['runtime_properties']['aws_resource_id']
-        security_group = util.get_node_instances(
-            'security_group', 'infrastructure', self._infra_client)[0]
-        resource_ids['security_group_id'] = security_group[
-            'runtime_properties']['aws_resource_id']
-
-        self._platform_resource_ids = resource_ids
-
-    def _finish_deploy_test_vms(self):
-        for vm_id, details in self._test_vm_installs.items():
-            execution, index = details
-            util.wait_for_execution(self._infra_client, execution,
-                                    self._logger)
-
-            self._logger.info('Retrieving deployed instance details.')
-            node_instance = util.get_node_instances('test_host', vm_id,
-                                                    self._infra_client)[0]
+            resource_nodes['subnet_2_id'] = 'test_subnet_2'
+            resource_nodes['subnet_3_id'] = 'test_subnet_3'
 
-            self._logger.info('Storing instance details.')
-            self._update_instance(
-                index,
-                node_instance,
+        node_instances = util.find_node_instances(
+            self._infra_client, ['infrastructure'],
+            resource_nodes.values(), include=['runtime_properties'],
+        )
+        self._platform_resource_ids = {
+            resource: node_instances[('infrastructure', node_id)][0][
+                'runtime_properties']['aws_resource_id']
+            for resource, node_id in resource_nodes.items()
+        }
+
+    def _finish_deploy_test_vms(self, timeout=30 * 60):
+        """Wait for all test VM deployments to be created and installed.
+        The executions for all VMs are polled together, each install is
+        started as soon as that VM's deployment environment is created, and
+        the VMs are then assigned using the details of all of their servers,
+        fetched with one request.
+        """
+        installed = []
+        vm_ids = {
+            execution['id']: vm_id
+            for vm_id, (execution, _) in self._test_vm_installs.items()
+        }
+
+        def _on_complete(execution):
+            vm_id = vm_ids[execution['id']]
+            index = self._test_vm_installs[vm_id][1]
+
+            if execution.workflow_id == 'create_deployment_environment':
+                timeline.record('vm.create',
+                                self._test_vm_phase_started[vm_id], vm=vm_id)
+                self._test_vm_phase_started[vm_id] = time.time()
+                self._logger.info('Installing %s', vm_id)
+                install = self._infra_client.executions.start(
+                    vm_id, 'install',
+                )
+                self._test_vm_installs[vm_id] = (install, index)
+                vm_ids[install['id']] = vm_id
+                return [install]
+
+            timeline.record('vm.install', self._test_vm_phase_started[vm_id],
+                            vm=vm_id)
+            installed.append(vm_id)
+
+        util.wait_for_executions(
+            self._infra_client,
+            [execution for execution, _ in self._test_vm_installs.values()],
+            self._logger,
+            timeout=timeout,
+            on_complete=_on_complete,
+        )
+
+        self._logger.info('Retrieving deployed instance details for %d '
+                          'VMs.', len(installed))
+        with timeline.span('hosts.assign_vms', vms=len(installed)):
+            node_instances = util.find_node_instances(
+                self._infra_client, installed, ['test_host'],
+                include=['runtime_properties'],
             )
+            self._logger.info('Storing instance details.')
+            for vm_id in installed:
+                self._update_instance(
+                    self._test_vm_installs[vm_id][1],
+                    node_instances[(vm_id, 'test_host')][0],
+                )
 
-    def _start_undeploy_test_vms(self):
-        # Operate on all deployments except the infrastructure one
-        for vm_id in self.deployments[1:]:
+    @timeline.timed('teardown.start_vm_uninstalls')
+    def _start_undeploy_test_vms(self, vm_ids=None):
+        if vm_ids is None:
+            # Operate on all deployments except the infrastructure one
+            vm_ids = [deployment for deployment in self.deployments
+                      if deployment != 'infrastructure']
+        for vm_id in vm_ids:
             self._logger.info('Uninstalling %s', vm_id)
             self._test_vm_uninstalls[vm_id] = (
                 self._infra_client.executions.start(
@@ -1317,15 +2150,18 @@ class Hosts(object):
                 )
             )
 
-    def _finish_undeploy_test_vms(self):
-        for vm_id, execution in self._test_vm_uninstalls.items():
-            util.wait_for_execution(self._infra_client, execution,
-                                    self._logger)
+    @timeline.timed('teardown.uninstall_vms')
+    def _finish_undeploy_test_vms(self, timeout=30 * 60):
+        deadline = time.time() + timeout
+        util.wait_for_executions(self._infra_client,
+                                 list(self._test_vm_uninstalls.values()),
+                                 self._logger, timeout=timeout)
         # Do this separately to cope with large deployment counts and small
         # mgmtworker worker counts
-        for vm_id, execution in self._test_vm_uninstalls.items():
-            util.delete_deployment(self._infra_client, vm_id,
-                                   self._logger)
+        util.delete_deployments(self._infra_client,
+                                list(self._test_vm_uninstalls),
+                                self._logger,
+                                timeout=_remaining(deadline))
 
     def _update_instance(self, server_index, node_instance):
         instance = self.instances[server_index]
@@ -1361,7 +2197,7 @@ class Hosts(object):
             public_ip_address,
             private_ip_address,
             networks,
-            self._ssh_key,
+            self._vm_ssh_key,
             self._logger,
             self._tmpdir,
             node_instance_id,
@@ -0,0 +1,230 @@
+from contextlib import contextmanager
+import functools
+import itertools
+import json
+import threading
+import time
+
+# Allow for clock resolution when comparing span start and end times
+_EPSILON = 0.001
+
+
+class Span(object):
+    """One timed phase, e.g. installing a VM."""
+    def __init__(self, span_id, name, parent, attrs, start=None):
+        self.id = span_id
+        self.name = name
+        self.parent_id = parent.id if parent else None
+        self.attrs = attrs
+        self.thread = threading.current_thread().name
+        self.start = time.time() if start is None else start
+        self.end = None
+        self.error = None
+
+    @property
+    def duration(self):
+        end = time.time() if self.end is None else self.end
+        return end - self.start
+
+    def describe(self):
+        if not self.attrs:
+            return self.name
+        return '{name} ({attrs})'.format(
+            name=self.name,
+            attrs=', '.join('{}={}'.format(key, value)
+                            for key, value in sorted(self.attrs.items())),
+        )
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'parent_id': self.parent_id,
+            'name': self.name,
+            'attrs': {key: str(value) for key, value in self.attrs.items()},
+            'thread': self.thread,
+            'start': self.start,
+            'end': self.end,
+            'duration': self.duration,
+            'error': self.error,
+        }
+
+
+class Timeline(object):
+    """Nested timing spans for the phases of creating, using and tearing
+    down test hosts.
+
+    A span started in a thread nests under the span that thread is already
+    in. Calls made by parallel.run_parallel nest under the span of the
+    thread that called it, so the spans for each VM of a parallel step are
+    children of that step.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self._local = threading.local()
+        self.spans = []
+
+    def _stack(self):
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def current(self):
+        """The innermost span this thread is in, if any."""
+        stack = self._stack()
+        return stack[-1] if stack else None
+
+    @contextmanager
+    def attached(self, parent):
+        """Nest spans started by this thread under a span from another
+        thread.
+        """
+        stack = self._stack()
+        stack.append(parent)
+        try:
+            yield
+        finally:
+            stack.pop()
+
+    def _new_span(self, name, attrs, start=None):
+        with self._lock:
+            span = Span(next(self._ids), name, self.current(), attrs, start)
+            self.spans.append(span)
+        return span
+
+    @contextmanager
+    def span(self, name, **attrs):
+        """Time the body of a with statement."""
+        span = self._new_span(name, attrs)
+        stack = self._stack()
+        stack.append(span)
+        try:
+            yield span
+        except Exception as err:
+            span.error = type(err).__name__
+            raise
+        finally:
+            stack.pop()
+            span.end = time.time()
+
+    def record(self, name, start, end=None, error=None, **attrs):
+        """Add a span timed by the caller, e.g. for something that was
+        waited for along with other things.
+        """
+        span = self._new_span(name, attrs, start)
+        span.end = time.time() if end is None else end
+        span.error = error
+        return span
+
+    def timed(self, name, attrs=None):
+        """Decorate a function to time every call to it.
+
+        :param attrs: A function called with the same arguments, returning
+                      a dict of attributes for the span.
+        """
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                span_attrs = attrs(*args, **kwargs) if attrs else {}
+                with self.span(name, **span_attrs):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def dump(self, path):
+        """Write all spans to a JSON file."""
+        with self._lock:
+            spans = [span.to_dict() for span in self.spans]
+        with open(path, 'w') as timeline_handle:
+            json.dump({'spans': spans}, timeline_handle, indent=2)
+
+    def _children(self):
+        children = {}
+        with self._lock:
+            for span in self.spans:
+                children.setdefault(span.parent_id, []).append(span)
+        return children
+
+    def critical_path(self):
+        """Find the spans that the session had to wait for.
+
+        Working back from the end of a span, the child that finished last
+        is on its critical path, then whichever child finished last before
+        that one started, and so on. Each of those children's own critical
+        paths are included beneath them.
+
+        :return: A list of (depth, span) in the order they ran.
+        """
+        children = self._children()
+
+        def _path(parent_id, start, end, depth):
+            chosen = []
+            cursor = end
+            candidates = sorted(
+                children.get(parent_id, []),
+                key=lambda span: span.start + span.duration,
+                reverse=True,
+            )
+            for span in candidates:
+                span_end = span.start + span.duration
+                if (
+                    span_end <= cursor + _EPSILON
+                    and span.start >= start - _EPSILON
+                ):
+                    chosen.append(span)
+                    cursor = span.start
+            path = []
+            for span in reversed(chosen):
+                path.append((depth, span))
+                path.extend(_path(span.id, span.start,
+                                  span.start + span.duration, depth + 1))
+            return path
+
+        top_level = children.get(None, [])
+        if not top_level:
+            return []
+        return _path(
+            None,
+            min(span.start for span in top_level),
+            max(span.start + span.duration for span in top_level),
+            0,
+        )
+
+    def report(self, slowest=10):
+        """Summarise the critical path and the slowest kinds of span."""
+        path = self.critical_path()
+        if not path:
+            return 'No spans were recorded.'
+        lines = ['Critical path:']
+        for depth, span in path:
+            lines.append('{indent}{duration:8.1f}s {name}{error}'.format(
+                indent='  ' * depth,
+                duration=span.duration,
+                name=span.describe(),
+                error=' [{}]'.format(span.error) if span.error else '',
+            ))
+
+        totals = {}
+        with self._lock:
+            for span in self.spans:
+                count, total, longest = totals.get(span.name, (0, 0.0, 0.0))
+                totals[span.name] = (count + 1, total + span.duration,
+                                     max(longest, span.duration))
+        lines.append('Slowest phases (count, total, longest):')
+        for name, (count, total, longest) in sorted(
+            totals.items(), key=lambda item: item[1][1], reverse=True,
+        )[:slowest]:
+            lines.append('{count:5d} {total:8.1f}s {longest:8.1f}s '
+                         '{name}'.format(count=count, total=total,
+                                         longest=longest, name=name))
+        return '\n'.join(lines)
+
+
+TIMELINE = Timeline()
+
+current = TIMELINE.current
+attached = TIMELINE.attached
+span = TIMELINE.span
+record = TIMELINE.record
+timed = TIMELINE.timed
@@ -1,7 +1,9 @@
 from contextlib import contextmanager
+import copy
 from datetime import datetime, timedelta
 import errno
 import glob
+import io
 import json
 import logging
 import os
@@ -14,6 +16,7 @@ import sys
 from tempfile import mkstemp
 import time
 import yaml
+import zipfile
 
 from cloudify_rest_client import CloudifyClient
 from cloudify_rest_client.exceptions import (
@@ -26,6 +29,8 @@ import cosmo_tester
 from cosmo_tester import resources
 from cosmo_tester.framework.constants import CLOUDIFY_TENANT_HEADER
 from cosmo_tester.framework.exceptions import ProcessExecutionError
+from cosmo_tester.framework.parallel import run_parallel
+from cosmo_tester.framework.polling import PollingPolicy
 
 
 class SSHKey(object):
@@ -59,6 +64,24 @@ def get_resource_path(resource, resources_dir=None):
     return os.path.join(resources_dir, resource)
 
 
+def get_plugin_package(plugin_path):
+    """Read the package name and version from a wagon's package.json.
+    The wagon may also be inside a zip, along with its plugin.yaml.
+
+    :return: A tuple of (package_name, package_version).
+    """
+    with zipfile.ZipFile(plugin_path) as archive:
+        names = archive.namelist()
+        wagons = [name for name in names if name.endswith('.wgn')]
+        if wagons:
+            with archive.open(wagons[0]) as wagon_handle:
+                return get_plugin_package(io.BytesIO(wagon_handle.read()))
+        package_json = [name for name in names
+                        if name.endswith('/package.json')]
+        package = json.loads(archive.read(package_json[0]).decode('utf-8'))
+    return package['package_name'], package['package_version']
+
+
 def create_rest_client(
         manager_ip,
         username=None,
@@ -162,8 +185,43 @@ def assert_snapshot_created(manager, snapshot_id):
     )
 
 
+class _SharedAPIClient(CloudifyClient):
+    """A rest client whose sub-clients all send their requests through an
+    existing HTTP client, rather than one of its own.
+    """
+    def __init__(self, api):
+        self._shared_api = api
+        super(_SharedAPIClient, self).__init__()
+
+    def client_class(self, *args, **kwargs):
+        # Called by CloudifyClient.__init__ to create its HTTP client
+        return self._shared_api
+
+
+def tenant_client(client, tenant):
+    """Return a view of a rest client which acts on the given tenant.
+
+    The view has its own headers, so it can be used at the same time as
+    the original client (or views for other tenants) from other threads,
+    but it shares the original's connections to the manager. Creating one
+    is cheap, so there is no need to keep them around.
+    If no tenant is given, the client itself is returned.
+    """
+    if not tenant:
+        return client
+    # A shallow copy shares the original's session, and so its connections
+    api = copy.copy(client._client)
+    api.headers = dict(client._client.headers)
+    api.headers[CLOUDIFY_TENANT_HEADER] = tenant
+    return _SharedAPIClient(api)
+
+
 @contextmanager
 def set_client_tenant(client, tenant):
+    """Temporarily switch a client to another tenant.
+    This changes the client for everything using it, so tenant_client
+    should be preferred wherever the client may be shared between threads.
+    """
     if tenant:
         original = client._client.headers[CLOUDIFY_TENANT_HEADER]
 
@@ -417,97 +475,316 @@ class ExecutionFailed(Exception):
 
 
 def wait_for_execution(client, execution, logger, tenant=None, timeout=10*60,
-                       allow_client_error=False):
+                       allow_client_error=False, polling=None):
+    """Wait for an execution to finish, logging its events as it runs.
+
+    :param polling: The PollingPolicy deciding how often to check on the
+                    execution. A default policy is used if not supplied.
+    """
+    polling = polling or PollingPolicy()
     logger.info(
         'Getting workflow execution [id={execution}]'.format(
             execution=execution['id'],
         )
     )
-    current_time = datetime.now()
-    timeout_time = current_time + timedelta(seconds=timeout)
-    output_events(client, execution, logger, to_time=current_time)
-
-    with set_client_tenant(client, tenant):
-        while True:
-            prev_time = current_time
-            current_time = datetime.now()
-
-            try:
-                execution = client.executions.get(execution['id'])
-
-                output_events(client, execution, logger, prev_time,
-                              current_time)
-            except UserUnauthorizedError:
-                # This is a specific client error which we don't want to catch
-                # as it can't get better with retries.
-                raise
-            except CloudifyClientError as err:
-                if allow_client_error:
-                    logger.warning(
-                        'Error trying to get execution state, retrying: %s',
-                        err
-                    )
-                    if current_time >= timeout_time:
-                        raise
-                    time.sleep(2)
-                    continue
-                else:
+    timeout_time = datetime.now() + timedelta(seconds=timeout)
+    client = tenant_client(client, tenant)
+    events = EventStream(client, [execution['id']])
+
+    events.output(logger)
+    while True:
+        current_time = datetime.now()
+
+        try:
+            execution = client.executions.get(execution['id'])
+
+            events.output(logger)
+        except UserUnauthorizedError:
+            # This is a specific client error which we don't want to catch
+            # as it can't get better with retries.
+            raise
+        except CloudifyClientError as err:
+            if allow_client_error:
+                logger.warning(
+                    'Error trying to get execution state, retrying: %s',
+                    err
+                )
+                if current_time >= timeout_time:
                     raise
+                polling.wait()
+                continue
+            else:
+                raise
+
+        if current_time >= timeout_time:
+            raise ExecutionTimeout(
+                'Execution {exc_id} timed out in state: {status}'.format(
+                    exc_id=execution['id'],
+                    status=execution.status,
+                )
+            )
 
-            if current_time >= timeout_time:
-                raise ExecutionTimeout(
-                    'Execution {exc_id} timed out in state: {status}'.format(
-                        exc_id=execution['id'],
+        if execution.status in execution.END_STATES:
+            # Give time for any last second events
+            time.sleep(2)
+            events.output(logger)
+
+            if execution.status != execution.TERMINATED:
+                logger.warning('Execution failed')
+                raise ExecutionFailed(
+                    '{status}: {error}'.format(
                         status=execution.status,
+                        error=execution['error'],
                     )
                 )
 
-            if execution.status in execution.END_STATES:
+            logger.info('Execution completed in state {status}'.format(
+                    status=execution.status,
+                )
+            )
+            logger.info('Polling for execution %s: %s. Events: %s',
+                        execution['id'], polling, events)
+            break
+
+        polling.wait(execution.status)
+
+    return execution
+
+
+def wait_for_executions(client, executions, logger, tenant=None,
+                        timeout=10*60, allow_client_error=False,
+                        on_complete=None, polling=None):
+    """Wait for several executions at once.
+    Each poll fetches the state of every pending execution with one list
+    call, and their new events with one events call per group of
+    executions that were started together. Completions and failures are
+    reported as they happen, and all executions share one timeout.
+
+    :param on_complete: Called with each execution that terminates
+                        successfully. It may return further executions,
+                        which will then be waited for within the same
+                        timeout.
+    :param polling: The PollingPolicy deciding how often to poll. A default
+                    policy is used if not supplied.
+    :return: A dict of the final state of each execution, by ID.
+    """
+    polling = polling or PollingPolicy()
+    pending = {execution['id']: execution for execution in executions}
+    client = tenant_client(client, tenant)
+    finished = {}
+    # An event stream can't have executions added to it, so executions
+    # added by on_complete get a stream of their own.
+    streams = [EventStream(client, list(pending))]
+    # Streams for executions that have all finished get one more read, to
+    # pick up any late events, before being dropped
+    finished_streams = []
+    timeout_time = datetime.now() + timedelta(seconds=timeout)
+    logger.info('Waiting for executions: %s', ', '.join(sorted(pending)))
+
+    def _output_events():
+        for stream in streams:
+            stream.output(logger)
+        for stream in finished_streams:
+            streams.remove(stream)
+            logger.info('Events for %s: %s',
+                        ', '.join(stream.execution_ids), stream)
+        del finished_streams[:]
+
+    _output_events()
+    while pending:
+        polling.wait(sorted(
+            (exc_id, execution.status)
+            for exc_id, execution in pending.items()
+        ))
+        current_time = datetime.now()
+
+        try:
+            states = client.executions.list(id=list(pending),
+                                            _get_all_results=True)
+            _output_events()
+        except UserUnauthorizedError:
+            # This is a specific client error which we don't want to catch
+            # as it can't get better with retries.
+            raise
+        except CloudifyClientError as err:
+            if allow_client_error and current_time < timeout_time:
+                logger.warning(
+                    'Error trying to get execution states, retrying: %s',
+                    err
+                )
+                continue
+            raise
+
+        added = []
+        for execution in states:
+            if execution.status not in execution.END_STATES:
+                pending[execution['id']] = execution
+                continue
+
+            del pending[execution['id']]
+            finished[execution['id']] = execution
+            description = '{id} ({workflow} on {deployment})'.format(
+                id=execution['id'],
+                workflow=execution.workflow_id,
+                deployment=execution.deployment_id,
+            )
+
+            if execution.status != execution.TERMINATED:
                 # Give time for any last second events
                 time.sleep(2)
-                output_events(client, execution, logger, current_time)
-
-                if execution.status != execution.TERMINATED:
-                    logger.warning('Execution failed')
-                    raise ExecutionFailed(
-                        '{status}: {error}'.format(
-                            status=execution.status,
-                            error=execution['error'],
-                        )
+                _output_events()
+                logger.warning('Execution %s failed', description)
+                raise ExecutionFailed(
+                    '{description} {status}: {error}'.format(
+                        description=description,
+                        status=execution.status,
+                        error=execution['error'],
                     )
+                )
 
-                logger.info('Execution completed in state {status}'.format(
-                        status=execution.status,
+            logger.info('Execution %s completed in state %s',
+                        description, execution.status)
+            if on_complete:
+                added.extend(on_complete(execution) or [])
+
+        if added:
+            for execution in added:
+                pending[execution['id']] = execution
+            streams.append(EventStream(
+                client, [execution['id'] for execution in added],
+            ))
+        finished_streams.extend(
+            stream for stream in streams
+            if stream not in finished_streams
+            and all(exc_id in finished
+                    for exc_id in stream.execution_ids)
+        )
+
+        if pending and current_time >= timeout_time:
+            raise ExecutionTimeout(
+                'Executions timed out: {}'.format(
+                    ', '.join(
+                        '{} in state {}'.format(exc_id, execution.status)
+                        for exc_id, execution in sorted(pending.items())
                     )
                 )
-                break
+            )
 
-    return execution
+    if streams:
+        # Give time for any last second events
+        time.sleep(2)
+        _output_events()
+
+    logger.info('Polling for %d executions: %s', len(finished), polling)
+    return finished
 
 
 def run_blocking_execution(client, deployment_id, workflow_id, logger,
                            params=None, tenant=None, timeout=(15*60)):
-    with set_client_tenant(client, tenant):
-        execution = client.executions.start(
-            deployment_id, workflow_id, parameters=params,
-        )
+    client = tenant_client(client, tenant)
+    execution = client.executions.start(
+        deployment_id, workflow_id, parameters=params,
+    )
     wait_for_execution(client, execution, logger,
                        tenant=tenant, timeout=timeout)
 
 
-def output_events(client, execution, logger, from_time=None, to_time=None):
-    if from_time:
-        from_time = from_time.strftime('%Y-%m-%d %H:%M:%S')
-    if to_time:
-        to_time = to_time.strftime('%Y-%m-%d %H:%M:%S')
-    events = client.events.list(
-        execution_id=execution.id,
-        _size=1000,
-        include_logs=True,
-        sort='reported_timestamp',
-        from_datetime=from_time,
-        to_datetime=to_time,
-    )
+def _parse_event_time(timestamp):
+    """Parse an event timestamp (in UTC) from the REST service."""
+    timestamp = timestamp.rstrip('Z').replace('T', ' ')
+    for time_format in ['%Y-%m-%d %H:%M:%S.%f', '%Y-%m-%d %H:%M:%S']:
+        try:
+            return datetime.strptime(timestamp, time_format)
+        except ValueError:
+            continue
+    return None
+
+
+class EventStream(object):
+    """Read the events of one or more executions incrementally.
+
+    Events are read in the order the manager stored them, paging on from
+    the offset of the last event read. Each event is therefore read exactly
+    once however many arrive between reads. A burst of more than max_pages
+    pages is spread over several reads so that no one read takes too long.
+    """
+    def __init__(self, client, execution_ids, page_size=500, max_pages=5):
+        self._client = client
+        self.execution_ids = list(execution_ids)
+        self._page_size = page_size
+        self._max_pages = max_pages
+        self._started = time.time()
+
+        self.offset = 0
+        # Events stored on the manager which we haven't read yet
+        self.backlog = 0
+        # How long before the last read the newest event read was stored
+        self.lag = None
+
+    def read(self):
+        """Return the events stored since the last read."""
+        events = []
+        for _ in range(self._max_pages):
+            page = self._client.events.list(
+                execution_id=(self.execution_ids
+                              if len(self.execution_ids) > 1
+                              else self.execution_ids[0]),
+                include_logs=True,
+                # The order events were stored in, so new events are always
+                # after the ones we have already read.
+                sort='timestamp',
+                _offset=self.offset,
+                _size=self._page_size,
+            )
+            items = list(page)
+            events.extend(items)
+            self.offset += len(items)
+            self.backlog = max(
+                page.metadata.pagination.total - self.offset, 0,
+            )
+            if not self.backlog or not items:
+                break
+
+        if events:
+            stored = _parse_event_time(events[-1].get('timestamp') or '')
+            if stored:
+                self.lag = (
+                    datetime.utcnow() - stored
+                ).total_seconds()
+        return events
+
+    def output(self, logger):
+        """Log the events stored since the last read.
+
+        :return: The number of events read.
+        """
+        events = self.read()
+        log_events(events, logger,
+                   show_deployment=len(self.execution_ids) > 1)
+        if self.backlog:
+            logger.info('%d more events to read for %s.', self.backlog,
+                        ', '.join(self.execution_ids))
+        return len(events)
+
+    @property
+    def events_per_second(self):
+        elapsed = time.time() - self._started
+        return self.offset / elapsed if elapsed else 0.0
+
+    def __str__(self):
+        return (
+            '{count} events read at {rate:.1f}/s, {lag} lag, '
+            '{backlog} unread'
+        ).format(
+            count=self.offset,
+            rate=self.events_per_second,
+            lag='unknown' if self.lag is None else '{:.1f}s'.format(
+                self.lag),
+            backlog=self.backlog,
+        )
+
+
+def log_events(events, logger, show_deployment=False):
     log_methods = {
         'debug': logger.debug,
         'info': logger.info,
@@ -531,7 +808,9 @@ def output_events(client, execution, logger, from_time=None, to_time=None):
                 # All well and good, but let's not bloat the logs
                 continue
             log_methods[level](
-                '%s%s',
+                '%s%s%s',
+                '[{}] '.format(event.get('deployment_id'))
+                if show_deployment else '',
                 '({}) '.format(node_instance) if node_instance else '',
                 message,
             )
@@ -570,8 +849,13 @@ class DeploymentCreationError(Exception):
     """Deployment creation failed."""
 
 
-def create_deployment(client, blueprint_id, deployment_id, logger,
-                      inputs=None, skip_plugins_validation=False):
+def start_deployment_creation(client, blueprint_id, deployment_id, logger,
+                              inputs=None, skip_plugins_validation=False):
+    """Create a deployment without waiting for its environment to be
+    created.
+
+    :return: The create_deployment_environment execution.
+    """
     wait_for_blueprint_upload(client, blueprint_id)
     logger.info('Creating deployment for %s', deployment_id)
     client.deployments.create(
@@ -581,17 +865,10 @@ def create_deployment(client, blueprint_id, deployment_id, logger,
         skip_plugins_validation=skip_plugins_validation,
     )
 
-    logger.info('Waiting for deployment env creation for %s',
-                deployment_id)
     executions = client.executions.list(deployment_id=deployment_id)
     for execution in executions:
         if execution.workflow_id == 'create_deployment_environment':
-            wait_for_execution(
-                client,
-                execution,
-                logger,
-            )
-            return
+            return execution
     raise DeploymentCreationError(
         'Deployment environment creation workflow not found for {}'.format(
             deployment_id,
@@ -599,33 +876,116 @@ def create_deployment(client, blueprint_id, deployment_id, logger,
     )
 
 
+def create_deployment(client, blueprint_id, deployment_id, logger,
+                      inputs=None, skip_plugins_validation=False):
+    execution = start_deployment_creation(
+        client, blueprint_id, deployment_id, logger,
+        inputs=inputs, skip_plugins_validation=skip_plugins_validation,
+    )
+    logger.info('Waiting for deployment env creation for %s',
+                deployment_id)
+    wait_for_execution(
+        client,
+        execution,
+        logger,
+    )
+
+
 class DeploymentDeletionError(Exception):
     """Deployment deletion failed."""
 
 
 def delete_deployment(client, deployment_id, logger):
-    logger.info('Deleting deployment %s', deployment_id)
-    client.deployments.delete(deployment_id)
-    # Allow a short delay to allow some time for the deletion
-    time.sleep(0.5)
-
-    for _ in range(40):
-        found = False
-        deployments = client.deployments.list()
-        for deployment in deployments:
-            if deployment['id'] == deployment_id:
-                found = True
-                logger.info('Still waiting for deployment %s to delete',
-                            deployment_id)
-                time.sleep(2)
-                break
+    delete_deployments(client, [deployment_id], logger)
+
 
-    if found:
-        raise DeploymentDeletionError(
-            'Deployment {} did not finish deleting.'.format(
-                deployment_id,
+def delete_deployments(client, deployment_ids, logger, timeout=90,
+                       polling=None, force=False):
+    """Delete several deployments at once, then wait for them all to be
+    gone, checking on only those deployments each time.
+
+    :param polling: The PollingPolicy deciding how often to check. A
+                    default policy is used if not supplied.
+    :param force: Delete the deployments even if they have live nodes.
+    """
+    deployment_ids = list(deployment_ids)
+    if not deployment_ids:
+        return
+    polling = polling or PollingPolicy()
+    deadline = time.time() + timeout
+
+    def _delete(deployment_id):
+        logger.info('Deleting deployment %s', deployment_id)
+        client.deployments.delete(deployment_id, force=force)
+
+    run_parallel(_delete, deployment_ids, logger=logger,
+                 description='Requesting deployment deletion')
+
+    remaining = sorted(deployment_ids)
+    while True:
+        remaining = sorted(
+            deployment['id'] for deployment in client.deployments.list(
+                id=remaining, _include=['id'], _get_all_results=True,
             )
         )
+        if not remaining:
+            break
+        if time.time() > deadline:
+            raise DeploymentDeletionError(
+                'Deployments did not finish deleting: {}'.format(
+                    ', '.join(remaining),
+                )
+            )
+        logger.info('Still waiting for deployments to delete: %s',
+                    ', '.join(remaining))
+        polling.wait(remaining)
+    logger.info('Deleted %d deployments (%s).', len(deployment_ids),
+                polling)
+
+
+def cancel_executions(client, execution_ids, logger, timeout=90,
+                      polling=None):
+    """Kill-cancel several executions at once, then wait for them all to
+    be cancelled, checking on all of them with each request.
+
+    :param polling: The PollingPolicy deciding how often to check. A
+                    default policy is used if not supplied.
+    :return: The IDs of any executions that weren't cancelled in time.
+    """
+    execution_ids = list(execution_ids)
+    if not execution_ids:
+        return []
+    polling = polling or PollingPolicy()
+    deadline = time.time() + timeout
+
+    def _cancel(execution_id):
+        client.executions.cancel(execution_id, force=True, kill=True)
+
+    run_parallel(_cancel, execution_ids, logger=logger,
+                 description='Kill-cancelling executions')
+
+    while True:
+        states = {
+            execution['id']: execution['status']
+            for execution in client.executions.list(
+                id=execution_ids, _include=['id', 'status'],
+                _get_all_results=True,
+            )
+        }
+        pending = sorted(
+            execution_id for execution_id in execution_ids
+            if states.get(execution_id) != 'cancelled'
+        )
+        if not pending or time.time() > deadline:
+            break
+        logger.info('Waiting for executions to be cancelled: %s',
+                    ', '.join(
+                        '{} ({})'.format(execution_id,
+                                         states.get(execution_id))
+                        for execution_id in pending
+                    ))
+        polling.wait(sorted(states.items()))
+    return pending
 
 
 @retrying.retry(stop_max_attempt_number=100, wait_fixed=250)
@@ -650,19 +1010,45 @@ def cancel_install(example, deployment_id):
 
 
 def get_node_instances(node_name, deployment_id, client):
-    node_instances = []
+    return find_node_instances(
+        client, [deployment_id], [node_name],
+    )[(deployment_id, node_name)]
 
-    node_instance_list = client.node_instances.list(
-        deployment_id=deployment_id,
-    )
 
-    for inst in node_instance_list:
-        if inst['node_id'] == node_name:
-            node_instances.append(client.node_instances.get(
-                inst['id'],
-            ))
+def find_node_instances(client, deployment_ids, node_ids, include=None):
+    """Fetch the instances of several nodes in several deployments with
+    one (paged) list call, filtered by the manager.
 
-    return node_instances
+    :param include: The node instance fields to fetch. By default all of
+                    them are fetched. The deployment_id and node_id are
+                    always included.
+    :return: A dict of lists of node instances by (deployment_id, node_id),
+             with an entry for every requested pair, sorted by ID.
+    """
+    deployment_ids = sorted(set(deployment_ids))
+    node_ids = sorted(set(node_ids))
+    found = {
+        (deployment_id, node_id): []
+        for deployment_id in deployment_ids
+        for node_id in node_ids
+    }
+    if not found:
+        return found
+    kwargs = {}
+    if include is not None:
+        kwargs['_include'] = sorted(
+            set(include).union(['id', 'deployment_id', 'node_id'])
+        )
+    for node_instance in sorted(
+        client.node_instances.list(
+            deployment_id=deployment_ids, node_id=node_ids,
+            _get_all_results=True, **kwargs
+        ),
+        key=lambda node_instance: node_instance['id'],
+    ):
+        found[(node_instance['deployment_id'],
+               node_instance['node_id'])].append(node_instance)
+    return found
 
 
 def update_dictionary(dict1, dict2):
@@ -0,0 +1,207 @@
+import os
+import shutil
+import time
+
+from path import Path
+
+from cosmo_tester.framework.state_file import (
+    StateFile,
+    owner,
+    owner_is_alive,
+)
+from cosmo_tester.framework.util import SSHKey
+
+IDLE = 'idle'
+LEASED = 'leased'
+REAPING = 'reaping'
+
+
+class VMPool(object):
+    """A pool of test VMs which are kept running between test sessions.
+
+    The pool is recorded in a state file which is shared by every session
+    and xdist worker using the same pool directory. VMs are leased in
+    groups which all come from the same infrastructure tenant, so that they
+    share a network. Each VM is either idle, leased by a running test
+    session, or being reaped (destroyed).
+    """
+    def __init__(self, test_config, logger):
+        config = test_config['vm_pool']
+        self._logger = logger
+        self._base_dir = os.path.expanduser(config['directory'])
+        self._idle_ttl = config['idle_ttl']
+        self._lease_ttl = config['lease_ttl']
+        self._state = StateFile(os.path.join(self._base_dir, 'vm_pool.json'))
+        self.owner = owner()
+
+    def _keys_dir(self, tenant):
+        return Path(os.path.join(self._base_dir, 'keys', tenant))
+
+    def ssh_key(self, tenant):
+        """Return the SSH key that can be used to access a tenant's VMs."""
+        return SSHKey(self._keys_dir(tenant), self._logger)
+
+    def register(self, tenant, blueprints, ssh_key, vms):
+        """Add newly provisioned VMs to the pool, leased by this session.
+
+        :param tenant: The infrastructure manager tenant holding the VMs.
+        :param blueprints: The blueprints uploaded to that tenant.
+        :param ssh_key: The SSHKey the VMs were provisioned with.
+        :param vms: A list of dicts describing each VM, each of which must
+                    have at least a deployment_id, image and flavor.
+        """
+        keys_dir = self._keys_dir(tenant)
+        if not os.path.isdir(keys_dir):
+            os.makedirs(keys_dir)
+        pool_key = self.ssh_key(tenant)
+        for source, dest in [
+            (ssh_key.private_key_path, pool_key.private_key_path),
+            (ssh_key.public_key_path, pool_key.public_key_path),
+        ]:
+            shutil.copyfile(source, dest)
+        os.chmod(pool_key.private_key_path, 0o400)
+
+        now = time.time()
+        with self._state.locked() as state:
+            state.setdefault('tenants', {})[tenant] = {
+                'blueprints': blueprints,
+                'created_at': now,
+                'state': LEASED,
+            }
+            pool_vms = state.setdefault('vms', {})
+            for vm in vms:
+                vm = dict(vm, tenant=tenant, state=LEASED, owner=self.owner,
+                          leased_at=now, created_at=now, healthy=True)
+                pool_vms[self._vm_key(vm)] = vm
+        self._logger.info('Added %d VMs from tenant %s to the VM pool.',
+                          len(vms), tenant)
+
+    @staticmethod
+    def _vm_key(vm):
+        return '{tenant}/{deployment_id}'.format(**vm)
+
+    def lease(self, wanted):
+        """Lease idle VMs matching the wanted images and flavors.
+        Either every wanted VM is leased from one tenant, or none are.
+
+        :param wanted: A list of (image, flavor) tuples, one per VM.
+        :return: A list of VM records in the same order as wanted, or None
+                 if the pool cannot satisfy the request.
+        """
+        now = time.time()
+        with self._state.locked() as state:
+            by_tenant = {}
+            for vm in state.get('vms', {}).values():
+                if (
+                    vm['state'] == IDLE and vm['healthy']
+                    and now - vm['released_at'] < self._idle_ttl
+                ):
+                    by_tenant.setdefault(vm['tenant'], []).append(vm)
+
+            for tenant, available in sorted(by_tenant.items()):
+                # Prefer the most recently used VMs so that old ones expire
+                available.sort(key=lambda vm: vm['released_at'],
+                               reverse=True)
+                leased = []
+                for image, flavor in wanted:
+                    for vm in available:
+                        if (
+                            vm not in leased
+                            and vm['image'] == image
+                            and vm['flavor'] == flavor
+                        ):
+                            leased.append(vm)
+                            break
+                    else:
+                        break
+                if len(leased) == len(wanted):
+                    for vm in leased:
+                        vm.update(state=LEASED, owner=self.owner,
+                                  leased_at=now)
+                    self._logger.info(
+                        'Leased %d VMs from tenant %s in the VM pool.',
+                        len(leased), tenant,
+                    )
+                    return [dict(vm) for vm in leased]
+        self._logger.info('VM pool has no suitable idle VMs.')
+        return None
+
+    def release(self, vms):
+        """Return leased VMs to the pool.
+        Any VM whose record has healthy set to False will be reaped rather
+        than leased again.
+        """
+        now = time.time()
+        with self._state.locked() as state:
+            pool_vms = state.get('vms', {})
+            for vm in vms:
+                key = self._vm_key(vm)
+                if key in pool_vms:
+                    pool_vms[key].update(state=IDLE, owner=None,
+                                         released_at=now,
+                                         healthy=vm.get('healthy', True))
+        self._logger.info('Returned %d VMs to the VM pool.', len(vms))
+
+    def _expired(self, vm, now):
+        if vm['state'] == IDLE:
+            return (
+                not vm['healthy']
+                or now - vm['released_at'] > self._idle_ttl
+            )
+        # Leased or being reaped
+        return (
+            not owner_is_alive(vm['owner'])
+            or now - vm['leased_at'] > self._lease_ttl
+        )
+
+    def reap(self):
+        """Claim expired VMs, and tenants with no VMs left, for destruction
+        by the caller. Call forget() for each once it has been destroyed.
+
+        :return: A tuple of (VM records, {tenant: tenant record}).
+        """
+        now = time.time()
+        with self._state.locked() as state:
+            pool_vms = state.get('vms', {})
+            tenants = state.get('tenants', {})
+            expired = [vm for vm in pool_vms.values()
+                       if self._expired(vm, now)]
+            for vm in expired:
+                vm.update(state=REAPING, owner=self.owner, leased_at=now)
+
+            remaining = set(vm['tenant'] for vm in pool_vms.values()
+                            if vm['state'] != REAPING)
+            reaped_tenants = {}
+            for tenant, details in tenants.items():
+                if tenant in remaining:
+                    continue
+                if details['state'] == REAPING and owner_is_alive(
+                    details.get('owner')
+                ) and now - details['leased_at'] < self._lease_ttl:
+                    # Someone else is already destroying it
+                    continue
+                busy = [
+                    vm for vm in pool_vms.values()
+                    if vm['tenant'] == tenant and vm not in expired
+                ]
+                if busy:
+                    # Its VMs are still being destroyed by someone else
+                    continue
+                details.update(state=REAPING, owner=self.owner,
+                               leased_at=now)
+                reaped_tenants[tenant] = dict(details)
+
+        if expired or reaped_tenants:
+            self._logger.info('Reaping %d VMs and %d tenants from the VM '
+                              'pool.', len(expired), len(reaped_tenants))
+        return [dict(vm) for vm in expired], reaped_tenants
+
+    def forget(self, vm=None, tenant=None):
+        """Remove a destroyed VM or tenant from the pool."""
+        with self._state.locked() as state:
+            if vm:
+                state.get('vms', {}).pop(self._vm_key(vm), None)
+            if tenant:
+                state.get('tenants', {}).pop(tenant, None)
+        if tenant:
+            shutil.rmtree(self._keys_dir(tenant), ignore_errors=True)
@@ -0,0 +1,300 @@
+try:
+    import xdist
+    from xdist.scheduler import LoadScopeScheduling
+except ImportError:
+    # Only needed when running with pytest-xdist
+    xdist = None
+    LoadScopeScheduling = object
+
+# The pytest-xdist versions whose LoadScopeScheduling internals
+# VMShapeScheduling has been checked against
+SUPPORTED_XDIST_VERSIONS = ('2.2.',)
+# The LoadScopeScheduling internals which VMShapeScheduling relies on
+_XDIST_INTERNALS = ('_split_scope', '_assign_work_unit', '_reschedule',
+                    '_pending_of', 'workqueue', 'assigned_work',
+                    'registered_collections')
+
+SHAPES_CACHE_KEY = 'cosmo_tester/vm_shapes'
+DURATIONS_CACHE_KEY = 'cosmo_tester/test_durations'
+# Assumed for tests that have never been run, as most tests that need VMs
+# take several minutes
+DEFAULT_TEST_DURATION = 300
+# How much weight the latest run gets when updating a test's duration
+DURATION_SMOOTHING = 0.5
+
+# Session scoped fixtures which create VMs, and how many they create. VMs
+# created by these are kept until the end of the session of the xdist
+# worker that created them.
+SESSION_VM_FIXTURES = {
+    'session_manager': 1,
+    'prepared_manager': 1,
+    'three_session_vms': 3,
+    'four_session_vms': 4,
+    'three_plus_one_session_vms': 4,
+    'three_plus_manager_session_vms': 4,
+    'six_session_vms': 6,
+    'nine_session_vms': 9,
+    # A manager plus one VM per OS in cosmo_tester.test_suites.cli
+    'cli_tester': 4,
+    'cluster_cli_tester': 5,
+}
+# The markers (see pytest.ini) declaring how many VMs other tests use
+VM_MARKERS = {
+    'one_vm': 1,
+    'three_vms': 3,
+    'four_vms': 4,
+    'six_vms': 6,
+    'nine_vms': 9,
+}
+
+
+def get_shape(item):
+    """Describe the VMs a test needs.
+
+    :return: A dict with the group of tests sharing the same session VMs
+             (None if it uses none), the session VM fixtures it uses and
+             how many VMs each has, and how many VMs the test creates for
+             itself.
+    """
+    session_fixtures = {
+        name: SESSION_VM_FIXTURES[name] for name in item.fixturenames
+        if name in SESSION_VM_FIXTURES
+    }
+    if session_fixtures:
+        return {
+            'group': 'vms:{}'.format('+'.join(sorted(session_fixtures))),
+            'session_fixtures': session_fixtures,
+            'vms': 0,
+        }
+    marked = [count for marker, count in VM_MARKERS.items()
+              if item.get_closest_marker(marker)]
+    return {
+        'group': None,
+        'session_fixtures': {},
+        # Tests that don't say otherwise are assumed to need one VM
+        'vms': max(marked) if marked else 1,
+    }
+
+
+def record_shapes(config, items):
+    """Store the VM shapes of the collected tests, for the scheduler."""
+    cache = getattr(config, 'cache', None)
+    if cache is None:
+        return
+    shapes = cache.get(SHAPES_CACHE_KEY, {})
+    shapes.update({item.nodeid: get_shape(item) for item in items})
+    cache.set(SHAPES_CACHE_KEY, shapes)
+
+
+class DurationRecorder(object):
+    """A pytest plugin keeping a smoothed history of how long each test
+    took, including its setup and teardown.
+    """
+    def __init__(self, config):
+        self._config = config
+        self._durations = {}
+
+    def pytest_runtest_logreport(self, report):
+        self._durations[report.nodeid] = (
+            self._durations.get(report.nodeid, 0) + report.duration
+        )
+
+    def pytest_sessionfinish(self, session):
+        cache = getattr(self._config, 'cache', None)
+        if cache is None or hasattr(self._config, 'workerinput'):
+            # xdist workers' reports are recorded by the controller
+            return
+        history = cache.get(DURATIONS_CACHE_KEY, {})
+        for nodeid, duration in self._durations.items():
+            previous = history.get(nodeid)
+            if previous is None:
+                history[nodeid] = duration
+            else:
+                history[nodeid] = (DURATION_SMOOTHING * duration
+                                   + (1 - DURATION_SMOOTHING) * previous)
+        cache.set(DURATIONS_CACHE_KEY, history)
+
+
+class UnsupportedXdistError(Exception):
+    pass
+
+
+def check_xdist_version():
+    """Make sure that the installed pytest-xdist is one VMShapeScheduling
+    works with, as it overrides private parts of LoadScopeScheduling.
+
+    :raises UnsupportedXdistError: If it isn't.
+    """
+    version = getattr(xdist, '__version__', None)
+    if version is None or not version.startswith(SUPPORTED_XDIST_VERSIONS):
+        raise UnsupportedXdistError(
+            '--vm-scheduling supports pytest-xdist {supported}, but '
+            '{version} is installed.'.format(
+                supported=', '.join(v + 'x' for v in SUPPORTED_XDIST_VERSIONS),
+                version=version,
+            )
+        )
+
+
+class VMShapeScheduling(LoadScopeScheduling):
+    """Schedule tests on xdist workers by the VMs they need.
+
+    Tests using the same session scoped VMs are sent to the same worker,
+    so that those VMs are only created once. Other tests are grouped by
+    module, as with --dist=loadscope.
+    Groups are started longest first (by the recorded durations of their
+    tests), preferring groups that can use VMs a worker already has, and
+    a group is only started if the VMs it needs would not take the total
+    over the quota. Session VMs are kept until their worker finishes, so
+    a worker that is holding VMs but has no work that fits the quota is
+    finished early to free them.
+    This overrides private methods of LoadScopeScheduling (and reproduces
+    _reschedule), so it checks that a supported version of pytest-xdist is
+    installed before being used.
+    """
+    def __init__(self, config, log=None):
+        check_xdist_version()
+        super(VMShapeScheduling, self).__init__(config, log)
+        missing = [name for name in _XDIST_INTERNALS
+                   if not hasattr(self, name)]
+        if missing:
+            raise UnsupportedXdistError(
+                'pytest-xdist no longer has the LoadScopeScheduling '
+                'internals needed by --vm-scheduling: {}'.format(
+                    ', '.join(missing))
+            )
+        self._quota = config.getoption('--vm-quota')
+        cache = getattr(config, 'cache', None)
+        self._durations = cache.get(DURATIONS_CACHE_KEY, {}) if cache else {}
+        self._shapes = None
+        # The session VM fixtures each worker has used, whose VMs it holds
+        self._held = {}
+        # The VMs needed by each worker for its current work
+        self._running = {}
+
+    def _shape(self, nodeid):
+        if self._shapes is None:
+            # Recorded by the workers as they collect tests, which has
+            # finished before scheduling starts
+            cache = getattr(self.config, 'cache', None)
+            self._shapes = (
+                cache.get(SHAPES_CACHE_KEY, {}) if cache else {}
+            )
+        return self._shapes.get(nodeid) or {
+            'group': None, 'session_fixtures': {}, 'vms': 1,
+        }
+
+    def _split_scope(self, nodeid):
+        group = self._shape(nodeid)['group']
+        if group:
+            return group
+        return super(VMShapeScheduling, self)._split_scope(nodeid)
+
+    def _unit_duration(self, work_unit):
+        return sum(self._durations.get(nodeid, DEFAULT_TEST_DURATION)
+                   for nodeid in work_unit)
+
+    def _unit_vms(self, work_unit):
+        """The session VM fixtures used by a unit of work, and the most VMs
+        any of its tests need for themselves.
+        """
+        session_fixtures = {}
+        vms = 0
+        for nodeid in work_unit:
+            shape = self._shape(nodeid)
+            session_fixtures.update(shape['session_fixtures'])
+            vms = max(vms, shape['vms'])
+        return session_fixtures, vms
+
+    def _vms_in_use(self, exclude=None):
+        total = 0
+        for node in self.nodes:
+            if node is exclude:
+                continue
+            total += sum(self._held.get(node, {}).values())
+            total += self._running.get(node, 0)
+        return total
+
+    def _choose_unit(self, node):
+        """Pick the next unit of work for a node, or None if nothing fits
+        within the VM quota.
+        """
+        in_use = self._vms_in_use(exclude=node)
+        held = self._held.get(node, {})
+        candidates = []
+        for scope, work_unit in self.workqueue.items():
+            session_fixtures, vms = self._unit_vms(work_unit)
+            new_held = dict(held, **session_fixtures)
+            needed = sum(new_held.values()) + max(
+                vms, self._running.get(node, 0))
+            fits = (
+                not self._quota
+                or in_use + needed <= self._quota
+                # Work must always be able to start somewhere
+                or in_use == 0
+            )
+            if fits:
+                reused = sum(count for name, count in held.items()
+                             if name in session_fixtures)
+                candidates.append((
+                    reused,
+                    self._unit_duration(work_unit),
+                    scope,
+                ))
+        if not candidates:
+            return None
+        # Reuse VMs first, then the longest work
+        return max(candidates)[2]
+
+    def _assign_work_unit(self, node):
+        scope = self._choose_unit(node)
+        if scope is None:
+            self.log('No work for', node.gateway.id,
+                     'fits within the VM quota of', self._quota)
+            return
+        work_unit = self.workqueue.pop(scope)
+        session_fixtures, vms = self._unit_vms(work_unit)
+        self._held.setdefault(node, {}).update(session_fixtures)
+        self._running[node] = max(vms, self._running.get(node, 0))
+
+        assigned_to_node = self.assigned_work.setdefault(node, {})
+        assigned_to_node[scope] = work_unit
+        worker_collection = self.registered_collections[node]
+        node.send_runtest_some([
+            worker_collection.index(nodeid)
+            for nodeid, completed in work_unit.items()
+            if not completed
+        ])
+
+    def _reschedule(self, node):
+        if node.shutting_down:
+            return
+        if not self.workqueue:
+            node.shutdown()
+            return
+        if self._pending_of(self.assigned_work[node]) > 2:
+            return
+        if self._pending_of(self.assigned_work[node]) == 0:
+            # Its per-test VMs have been destroyed
+            self._running[node] = 0
+        self._assign_work_unit(node)
+
+        if (
+            self._pending_of(self.assigned_work[node]) == 0
+            and self._held.get(node)
+            and any(not other.shutting_down
+                    for other in self.nodes if other is not node)
+        ):
+            self.log('Finishing', node.gateway.id, 'early to free its VMs')
+            node.shutdown()
+
+    def remove_node(self, node):
+        result = super(VMShapeScheduling, self).remove_node(node)
+        self._held.pop(node, None)
+        self._running.pop(node, None)
+        # Its VMs are gone, so work that didn't fit before may fit now
+        for other in self.nodes:
+            if not other.shutting_down and self.workqueue:
+                if self._pending_of(self.assigned_work[other]) == 0:
+                    self._assign_work_unit(other)
+        return result
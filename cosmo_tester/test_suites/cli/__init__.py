@@ -5,6 +5,7 @@ import tarfile
 import time
 
 from cosmo_tester.framework.examples import get_example_deployment
+from cosmo_tester.framework.test_hosts import run_on_all
 from cosmo_tester.framework.util import get_cli_package_url
 
 
@@ -105,10 +106,9 @@ def _test_logs_context(run, example, paths, managers):
 
     # Stop managers before stopping things managers depend on
     for config in reversed(configs):
-        for manager in managers:
-            # Stop manager services so the logs won't change during the test
-            manager.run_command('cfy_manager stop -c '
-                                '/etc/cloudify/{}.yaml'.format(config))
+        # Stop manager services so the logs won't change during the test
+        run_on_all(managers, 'cfy_manager stop -c '
+                             '/etc/cloudify/{}.yaml'.format(config))
 
     yield
 
@@ -4,6 +4,8 @@ import time
 import pytest
 import retrying
 
+from cosmo_tester.framework.parallel import run_parallel
+
 
 def get_broker_listing(broker, prefix='rabbit@'):
     brokers_list_output = broker.run_command(
@@ -35,12 +37,15 @@ def manager_list_brokers(manager):
 
 
 def add_to_hosts(target_broker, new_entry_brokers):
-    new_entry = 'echo "{ip} {hostname}" | sudo tee -a /etc/hosts'
-    for other_broker in new_entry_brokers:
-        target_broker.run_command(new_entry.format(
+    new_entries = '\n'.join(
+        '{ip} {hostname}'.format(
             ip=other_broker.private_ip_address,
             hostname=other_broker.hostname,
-        ))
+        )
+        for other_broker in new_entry_brokers
+    )
+    target_broker.run_command(
+        'echo "{}" | sudo tee -a /etc/hosts'.format(new_entries))
 
 
 def join_cluster(new_broker, cluster_member):
@@ -66,9 +71,11 @@ def kill_node(broker):
 
 
 def prepare_cluster_for_removal_tests(brokers):
-    add_to_hosts(brokers[0], brokers[1:])
-    add_to_hosts(brokers[1], [brokers[0], brokers[2]])
-    add_to_hosts(brokers[2], brokers[:2])
+    run_parallel(
+        lambda target: add_to_hosts(
+            target, [broker for broker in brokers if broker is not target]),
+        brokers,
+    )
     join_cluster(brokers[1], brokers[0])
     join_cluster(brokers[2], brokers[0])
 
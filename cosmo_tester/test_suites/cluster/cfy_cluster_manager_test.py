@@ -5,8 +5,9 @@ import pytest
 from jinja2 import Environment, FileSystemLoader
 from invoke import UnexpectedExit
 
-from cosmo_tester.framework.util import (generate_ca_cert,
-                                         generate_ssl_certificate)
+from cosmo_tester.framework.certs import (CertRequest,
+                                          generate_ca_cert,
+                                          generate_ssl_certificates)
 from .cfy_cluster_manager_shared import (
     CLUSTER_MANAGER_RESOURCES_PATH,
     _get_config_dict,
@@ -337,17 +338,22 @@ def _create_certificates(local_certs_path, nodes_list, pass_certs=False):
     ca_cert = ca_base + 'pem'
     ca_key = ca_base + 'key'
     generate_ca_cert(ca_cert, ca_key)
+    generate_ssl_certificates(
+        [
+            CertRequest(
+                [node.private_ip_address, node.ip_address],
+                node.hostname,
+                str(local_certs_path / 'node-{0}.crt'.format(i)),
+                str(local_certs_path / 'node-{0}.key'.format(i)),
+            )
+            for i, node in enumerate(nodes_list, start=1)
+        ],
+        ca_cert,
+        ca_key,
+    )
     for i, node in enumerate(nodes_list, start=1):
         node_cert = str(local_certs_path / 'node-{0}.crt'.format(i))
         node_key = str(local_certs_path / 'node-{0}.key'.format(i))
-        generate_ssl_certificate(
-            [node.private_ip_address, node.ip_address],
-            node.hostname,
-            node_cert,
-            node_key,
-            ca_cert,
-            ca_key
-        )
         if pass_certs:
             remote_cert = join(REMOTE_CERTS_PATH, 'node-{0}.crt'.format(i))
             remote_key = join(REMOTE_CERTS_PATH, 'node-{0}.key'.format(i))
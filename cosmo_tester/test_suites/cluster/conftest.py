@@ -1,16 +1,26 @@
 import copy
+import functools
 import os
-import time
+import threading
 
 from jinja2 import Environment, FileSystemLoader
 from os.path import join, dirname
 import pytest
 
-from cosmo_tester.framework.test_hosts import Hosts
-from cosmo_tester.framework import util
+from cosmo_tester.framework.test_hosts import (
+    Hosts,
+    run_on_all,
+)
+from cosmo_tester.framework import certs, parallel, util
+from cosmo_tester.framework.cert_cache import CertCache
+from cosmo_tester.framework.remote_files import ArtifactBundle
+from cosmo_tester.framework.scheduler import DependencyScheduler, Quorum
 
 CONFIG_DIR = join(dirname(__file__), 'config')
 
+# Nodes are prepared concurrently, but they share one CA and its serial file
+_CERT_LOCK = threading.Lock()
+
 
 class InsufficientVmsError(Exception):
     pass
@@ -74,8 +84,7 @@ def nine_session_vms(request, ssh_key, session_tmpdir, test_config,
 
 @pytest.fixture(scope='function')
 def brokers(three_session_vms, test_config, logger):
-    for vm in three_session_vms:
-        _ensure_installer_installed(vm)
+    _ensure_installer_installed(three_session_vms)
     yield _get_hosts(three_session_vms, test_config, logger,
                      broker_count=3)
     for vm in three_session_vms:
@@ -92,8 +101,7 @@ def broker(session_manager, test_config, logger):
 
 @pytest.fixture(scope='function')
 def dbs(three_session_vms, test_config, logger):
-    for vm in three_session_vms:
-        _ensure_installer_installed(vm)
+    _ensure_installer_installed(three_session_vms)
     yield _get_hosts(three_session_vms, test_config, logger,
                      db_count=3)
     for vm in three_session_vms:
@@ -102,8 +110,7 @@ def dbs(three_session_vms, test_config, logger):
 
 @pytest.fixture(scope='function')
 def brokers_and_manager(three_session_vms, test_config, logger):
-    for vm in three_session_vms:
-        _ensure_installer_installed(vm)
+    _ensure_installer_installed(three_session_vms)
     yield _get_hosts(three_session_vms, test_config, logger,
                      broker_count=2, manager_count=1)
     for vm in three_session_vms:
@@ -120,8 +127,7 @@ def brokers3_and_manager(four_session_vms, test_config, logger):
 
 @pytest.fixture(scope='function')
 def full_cluster_ips(nine_session_vms, test_config, logger):
-    for vm in nine_session_vms:
-        _ensure_installer_installed(vm)
+    _ensure_installer_installed(nine_session_vms)
     yield _get_hosts(nine_session_vms, test_config, logger,
                      broker_count=3, db_count=3, manager_count=3,
                      pre_cluster_rabbit=True)
@@ -131,8 +137,7 @@ def full_cluster_ips(nine_session_vms, test_config, logger):
 
 @pytest.fixture(scope='function')
 def full_cluster_names(nine_session_vms, test_config, logger):
-    for vm in nine_session_vms:
-        _ensure_installer_installed(vm)
+    _ensure_installer_installed(nine_session_vms)
     yield _get_hosts(nine_session_vms, test_config, logger,
                      broker_count=3, db_count=3, manager_count=3,
                      pre_cluster_rabbit=True, use_hostnames=True)
@@ -151,8 +156,7 @@ def cluster_with_lb(six_session_vms, test_config, logger):
 
 @pytest.fixture(scope='function')
 def cluster_missing_one_db(nine_session_vms, test_config, logger):
-    for vm in nine_session_vms:
-        _ensure_installer_installed(vm)
+    _ensure_installer_installed(nine_session_vms)
     yield _get_hosts(nine_session_vms, test_config, logger,
                      broker_count=3, db_count=3, manager_count=3,
                      skip_bootstrap_list=['db3'],
@@ -181,8 +185,7 @@ def minimal_cluster(four_session_vms, test_config, logger):
 
 @pytest.fixture(scope='function')
 def three_nodes_cluster(three_session_vms, test_config, logger):
-    for vm in three_session_vms:
-        _ensure_installer_installed(vm)
+    _ensure_installer_installed(three_session_vms)
     yield _get_hosts(three_session_vms, test_config, logger,
                      pre_cluster_rabbit=True, three_nodes_cluster=True)
     for vm in three_session_vms:
@@ -191,8 +194,7 @@ def three_nodes_cluster(three_session_vms, test_config, logger):
 
 @pytest.fixture(scope='function')
 def three_vms(three_session_vms, test_config, logger):
-    for vm in three_nodes_cluster:
-        _ensure_installer_not_installed(vm)
+    _ensure_installer_not_installed(three_session_vms)
     yield _get_hosts(three_session_vms, test_config, logger,
                      three_nodes_cluster=True, bootstrap=False)
     for vm in three_session_vms:
@@ -201,8 +203,7 @@ def three_vms(three_session_vms, test_config, logger):
 
 @pytest.fixture(scope='function')
 def nine_vms(nine_session_vms, test_config, logger):
-    for vm in nine_session_vms:
-        _ensure_installer_not_installed(vm)
+    _ensure_installer_not_installed(nine_session_vms)
     yield _get_hosts(nine_session_vms, test_config, logger,
                      broker_count=3, db_count=3,
                      manager_count=3, bootstrap=False)
@@ -210,19 +211,25 @@ def nine_vms(nine_session_vms, test_config, logger):
         vm.teardown()
 
 
-def _ensure_installer_not_installed(vm):
-    vm.wait_for_ssh()
-    vm.run_command(
+def _wait_for_ssh(vms):
+    parallel.run_parallel(lambda vm: vm.wait_for_ssh(), vms)
+
+
+def _ensure_installer_not_installed(vms):
+    _wait_for_ssh(vms)
+    run_on_all(
+        vms,
         'rpm -qi cloudify-manager-install '
-        '&& sudo yum remove -y cloudify-manager-install'
+        '&& sudo yum remove -y cloudify-manager-install',
     )
 
 
-def _ensure_installer_installed(vm):
-    vm.wait_for_ssh()
-    vm.run_command(
+def _ensure_installer_installed(vms):
+    _wait_for_ssh(vms)
+    run_on_all(
+        vms,
         'rpm -qi cloudify-manager-install '
-        '|| sudo yum install -y cloudify-manager-install.rpm'
+        '|| sudo yum install -y cloudify-manager-install.rpm',
     )
 
 
@@ -243,6 +250,9 @@ def _get_hosts(instances, test_config, logger,
         (1 if use_load_balancer else 0) + has_extra_node
     if skip_bootstrap_list is None:
         skip_bootstrap_list = []
+    if bootstrap:
+        # Have keys ready for the node certs by the time the VMs are
+        certs.start_key_pool()
 
     if len(instances) != number_of_instances:
         raise InsufficientVmsError('Required %s instances, but got %s',
@@ -267,15 +277,17 @@ def _get_hosts(instances, test_config, logger,
         name_mappings.append('extra_node')
 
     for idx, node in enumerate(instances):
-        node.wait_for_ssh()
-        # This needs to happen before we start bootstrapping nodes
-        # because the hostname is used by nodes that are being
-        # bootstrapped with reference to nodes that may not have been
-        # bootstrapped yet.
         node.hostname = name_mappings[idx]
-        node.run_command('sudo hostnamectl set-hostname {}'.format(
-            name_mappings[idx]
-        ))
+    # This needs to happen before we start bootstrapping nodes
+    # because the hostname is used by nodes that are being
+    # bootstrapped with reference to nodes that may not have been
+    # bootstrapped yet.
+    _wait_for_ssh(instances)
+    run_on_all(
+        instances,
+        lambda node: 'sudo hostnamectl set-hostname {}'.format(node.hostname),
+        logger=logger,
+    )
 
     if use_hostnames:
         hosts_entries = ['\n# Added for hostname test']
@@ -285,16 +297,18 @@ def _get_hosts(instances, test_config, logger,
             for node in instances
         )
         hosts_entries = '\n'.join(hosts_entries)
-        for node in instances:
-            if not hasattr(node, 'install_config'):
-                # This is a load balancer or other non-cloudify node
-                continue
+        # Load balancers and other non-cloudify nodes have no install config
+        cloudify_nodes = [node for node in instances
+                          if hasattr(node, 'install_config')]
+        for node in cloudify_nodes:
             node.install_config['manager']['private_ip'] = node.hostname
-            node.run_command(
-               "echo '{hosts}' | sudo tee -a /etc/hosts".format(
-                   hosts=hosts_entries,
-               )
-            )
+        run_on_all(
+            cloudify_nodes,
+            "echo '{hosts}' | sudo tee -a /etc/hosts".format(
+                hosts=hosts_entries,
+            ),
+            logger=logger,
+        )
     else:
         for node in instances:
             if not hasattr(node, 'install_config'):
@@ -319,6 +333,7 @@ def _get_hosts(instances, test_config, logger,
                               use_hostnames, tempdir, test_config, logger)
 
     if use_load_balancer:
+        _prepare_certs([('haproxy', lb)], tempdir, logger, test_config)
         _bootstrap_lb_node(lb, managers, tempdir, logger)
 
     logger.info('All nodes are created%s.',
@@ -331,91 +346,160 @@ def run_cluster_bootstrap(dbs, brokers, managers, skip_bootstrap_list,
                           pre_cluster_rabbit, high_security, use_hostnames,
                           tempdir, test_config, logger,
                           revert_install_config=False, credentials=None):
+    """Bootstrap the cluster, installing each node as soon as the nodes it
+    depends on are ready rather than one role at a time:
+      * Brokers joining a pre-clustered rabbit need the first broker.
+      * The first manager needs a quorum of the DBs and the first broker.
+      * Other managers need the first manager (which creates the schema and
+        uploads the license).
+    Where a VM has more than one role (compact clusters) its roles are
+    installed one after another in the usual order.
+    """
+    scheduler = DependencyScheduler(logger)
+    # The last task added for each VM, keyed by id as VMs are not hashable
+    previous_task = {}
+    # Task names are also the friendly names used for the nodes' certs
+    named_nodes = []
+
+    def _add_task(name, node, func, requires):
+        named_nodes.append((name, node))
+        requires = list(requires)
+        if id(node) in previous_task:
+            requires.append(previous_task[id(node)])
+        previous_task[id(node)] = name
+
+        def _task():
+            func()
+            if revert_install_config:
+                node.install_config = copy.deepcopy(node.basic_install_config)
+
+        scheduler.add(name, _task, requires)
+
     for node_num, node in enumerate(brokers, start=1):
-        _bootstrap_rabbit_node(node, node_num, brokers,
-                               skip_bootstrap_list, pre_cluster_rabbit,
-                               tempdir, logger, use_hostnames, credentials)
-        if revert_install_config:
-            node.install_config = copy.deepcopy(node.basic_install_config)
+        requires = []
+        if pre_cluster_rabbit and node_num != 1:
+            requires.append('rabbit1')
+        _add_task(
+            'rabbit{}'.format(node_num), node,
+            functools.partial(_bootstrap_rabbit_node, node, node_num,
+                              brokers, skip_bootstrap_list,
+                              pre_cluster_rabbit, tempdir, logger,
+                              use_hostnames, credentials),
+            requires,
+        )
 
     for node_num, node in enumerate(dbs, start=1):
-        _bootstrap_db_node(node, node_num, dbs, skip_bootstrap_list,
-                           high_security, tempdir, logger,
-                           use_hostnames, credentials)
-        if revert_install_config:
-            node.install_config = copy.deepcopy(node.basic_install_config)
-
-    # Ensure all backend nodes are up before installing managers
-    for node in brokers + dbs:
-        if node.friendly_name in skip_bootstrap_list:
-            continue
-        while not node.bootstrap_is_complete():
-            logger.info('Checking state of %s', node.friendly_name)
-            time.sleep(5)
+        _add_task(
+            'db{}'.format(node_num), node,
+            functools.partial(_bootstrap_db_node, node, node_num, dbs,
+                              skip_bootstrap_list, high_security, tempdir,
+                              logger, use_hostnames, credentials),
+            [],
+        )
+
+    backend_requirements = []
+    if dbs:
+        db_tasks = [
+            'db{}'.format(node_num)
+            for node_num in range(1, len(dbs) + 1)
+            if 'db{}'.format(node_num) not in skip_bootstrap_list
+        ]
+        # A majority of the whole DB cluster, skipped nodes included
+        quorum = min(len(dbs) // 2 + 1, len(db_tasks))
+        backend_requirements.append(Quorum(db_tasks, quorum))
+    if brokers:
+        backend_requirements.append('rabbit1')
 
     for node_num, node in enumerate(managers, start=1):
-        _bootstrap_manager_node(node, node_num, dbs, brokers,
-                                skip_bootstrap_list,
-                                pre_cluster_rabbit, high_security,
-                                tempdir, logger, test_config,
-                                use_hostnames, credentials)
-        if revert_install_config:
-            node.install_config = copy.deepcopy(node.basic_install_config)
-
-
-def _base_prep(node, tempdir):
-    with node.ssh() as fabric_ssh:
-        fabric_ssh.run(
-            'mkdir -p /tmp/bs_logs'
+        # Managers join the cluster one at a time, as concurrent joins are
+        # not supported
+        _add_task(
+            'manager{}'.format(node_num), node,
+            functools.partial(_bootstrap_manager_node, node, node_num, dbs,
+                              brokers, skip_bootstrap_list,
+                              pre_cluster_rabbit, high_security, tempdir,
+                              logger, test_config, use_hostnames,
+                              credentials),
+            backend_requirements if node_num == 1
+            else ['manager{}'.format(node_num - 1)],
         )
 
-        fabric_ssh.run(
-            'echo {name} > /tmp/bs_logs/0_node_name'.format(
-                name=node.friendly_name,
-            )
-        )
+    _prepare_certs(named_nodes, tempdir, logger, test_config)
+    scheduler.run()
 
+
+def _ca_paths(tempdir):
     ca_base = os.path.join(tempdir, 'ca.')
-    ca_cert = ca_base + 'cert'
-    ca_key = ca_base + 'key'
+    return ca_base + 'cert', ca_base + 'key'
 
-    if not os.path.exists(ca_cert):
-        util.generate_ca_cert(ca_cert, ca_key)
 
+def _node_cert_paths(tempdir, friendly_name):
     cert_base = os.path.join(tempdir, '{node_friendly_name}.{extension}')
-
-    node_cert = cert_base.format(node_friendly_name=node.friendly_name,
-                                 extension='crt')
-    node_key = cert_base.format(node_friendly_name=node.friendly_name,
-                                extension='key')
-
-    util.generate_ssl_certificate(
-        [node.friendly_name, node.hostname,
-         node.private_ip_address,
-         node.ip_address],
-        node.hostname,
-        node_cert,
-        node_key,
-        ca_cert,
-        ca_key,
+    return (
+        cert_base.format(node_friendly_name=friendly_name, extension='crt'),
+        cert_base.format(node_friendly_name=friendly_name, extension='key'),
     )
 
+
+def _prepare_certs(named_nodes, tempdir, logger, test_config=None):
+    """Generate certs for several nodes in one go, creating the CA first if
+    this is the first time.
+
+    :param named_nodes: A list of (friendly name, node) tuples.
+    :param test_config: If supplied, certs (and the CA) will be reused from
+                        the cert cache if it is enabled.
+    """
+    cache = None
+    if test_config and test_config['cert_cache']['enabled']:
+        cache = CertCache(test_config, logger)
+    ca_cert, ca_key = _ca_paths(tempdir)
+    cert_requests = []
+    for friendly_name, node in named_nodes:
+        node_cert, node_key = _node_cert_paths(tempdir, friendly_name)
+        cert_requests.append(certs.CertRequest(
+            [friendly_name, node.hostname,
+             node.private_ip_address,
+             node.ip_address],
+            node.hostname,
+            node_cert,
+            node_key,
+        ))
+
+    with _CERT_LOCK:
+        if not os.path.exists(ca_cert):
+            certs.generate_ca_cert(
+                ca_cert, ca_key, cache=cache,
+                # The same VMs in the same roles get the same CA
+                identity=[
+                    '{}={}'.format(name, node.ip_address)
+                    for name, node in named_nodes
+                ],
+                logger=logger,
+            )
+        certs.generate_ssl_certificates(cert_requests, ca_cert, ca_key,
+                                        cache=cache, logger=logger)
+    if cache:
+        cache.evict()
+
+
+def _base_prep(node, tempdir, logger):
+    ca_cert, _ = _ca_paths(tempdir)
+    node_cert, node_key = _node_cert_paths(tempdir, node.friendly_name)
+    if not os.path.exists(node_cert):
+        # Cluster nodes' certs are made in advance by run_cluster_bootstrap
+        _prepare_certs([(node.friendly_name, node)], tempdir, logger)
+
     remote_cert = '/tmp/' + node.friendly_name + '.crt'
     remote_key = '/tmp/' + node.friendly_name + '.key'
     remote_ca = '/tmp/ca.crt'
 
-    node.put_remote_file(
-        local_path=node_cert,
-        remote_path=remote_cert,
-    )
-    node.put_remote_file(
-        local_path=node_key,
-        remote_path=remote_key,
-    )
-    node.put_remote_file(
-        local_path=ca_cert,
-        remote_path=remote_ca,
-    )
+    bundle = ArtifactBundle()
+    bundle.add_content('/tmp/bs_logs/0_node_name',
+                       node.friendly_name + '\n')
+    bundle.add_file(remote_cert, node_cert)
+    bundle.add_file(remote_key, node_key)
+    bundle.add_file(remote_ca, ca_cert)
+    node.put_remote_bundle(bundle)
 
     node.local_cert = node_cert
     node.remote_cert = remote_cert
@@ -430,7 +514,7 @@ def _bootstrap_rabbit_node(node, rabbit_num, brokers, skip_bootstrap_list,
                            use_hostnames, credentials=None):
     node.friendly_name = 'rabbit' + str(rabbit_num)
 
-    _base_prep(node, tempdir)
+    _base_prep(node, tempdir, logger)
 
     logger.info('Preparing rabbit {}'.format(node.hostname))
 
@@ -472,19 +556,15 @@ def _bootstrap_rabbit_node(node, rabbit_num, brokers, skip_bootstrap_list,
     if credentials:
         util.update_dictionary(node.install_config, credentials)
 
-    if pre_cluster_rabbit and rabbit_num == 1:
-        node.bootstrap(blocking=True, restservice_expected=False,
-                       config_name='rabbit')
-    else:
-        node.bootstrap(blocking=False, restservice_expected=False,
-                       config_name='rabbit')
+    node.bootstrap(blocking=True, restservice_expected=False,
+                   config_name='rabbit')
 
 
 def _bootstrap_db_node(node, db_num, dbs, skip_bootstrap_list, high_security,
                        tempdir, logger, use_hostnames, credentials=None):
     node.friendly_name = 'db' + str(db_num)
 
-    _base_prep(node, tempdir)
+    _base_prep(node, tempdir, logger)
 
     logger.info('Preparing db {}'.format(node.hostname))
 
@@ -539,7 +619,7 @@ def _bootstrap_db_node(node, db_num, dbs, skip_bootstrap_list, high_security,
     if credentials:
         util.update_dictionary(node.install_config, credentials)
 
-    node.bootstrap(blocking=False, restservice_expected=False,
+    node.bootstrap(blocking=True, restservice_expected=False,
                    config_name='db')
 
 
@@ -549,7 +629,7 @@ def _bootstrap_manager_node(node, mgr_num, dbs, brokers, skip_bootstrap_list,
                             credentials=None):
     node.friendly_name = 'manager' + str(mgr_num)
 
-    _base_prep(node, tempdir)
+    _base_prep(node, tempdir, logger)
 
     logger.info('Preparing manager {}'.format(node.hostname))
 
@@ -654,7 +734,6 @@ def _bootstrap_manager_node(node, mgr_num, dbs, brokers, skip_bootstrap_list,
     if credentials:
         util.update_dictionary(node.install_config, credentials)
 
-    # We have to block on every manager
     node.bootstrap(blocking=True, restservice_expected=False,
                    upload_license=upload_license, config_name='manager')
 
@@ -664,7 +743,7 @@ def _bootstrap_manager_node(node, mgr_num, dbs, brokers, skip_bootstrap_list,
 
 def _bootstrap_lb_node(node, managers, tempdir, logger):
     node.friendly_name = 'haproxy'
-    _base_prep(node, tempdir)
+    _base_prep(node, tempdir, logger)
     logger.info('Preparing load balancer {}'.format(node.hostname))
 
     # install haproxy and import certs
@@ -683,9 +762,8 @@ def _bootstrap_lb_node(node, managers, tempdir, logger):
         loader=FileSystemLoader(CONFIG_DIR)).get_template('haproxy.cfg')
     config = template.render(managers=managers)
     config_path = '/etc/haproxy/haproxy.cfg'
-    node.put_remote_file_content(config_path, config)
-    node.run_command('sudo chown root. {}'.format(config_path))
-    node.run_command('sudo chmod 644 {}'.format(config_path))
+    node.put_remote_file_content(config_path, config,
+                                 owner='root', mode=0o644)
     node.run_command('sudo restorecon {}'.format(config_path))
 
     node.run_command('sudo systemctl enable haproxy')
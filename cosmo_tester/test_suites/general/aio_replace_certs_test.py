@@ -1,10 +1,13 @@
 from os.path import join
 
+import pytest
+
 from cosmo_tester.framework.util import validate_agents
 from cosmo_tester.framework.util import get_resource_path
 from cosmo_tester.framework.examples import get_example_deployment
 
 
+@pytest.mark.mutates_manager
 def test_aio_replace_certs(image_based_manager, ssh_key, logger, test_config):
     example = get_example_deployment(
         image_based_manager, ssh_key, logger, 'aio_replace_certs', test_config)
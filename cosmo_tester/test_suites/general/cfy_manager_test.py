@@ -53,6 +53,7 @@ def base_manager(request, ssh_key, module_tmpdir, test_config, logger):
         hosts.destroy()
 
 
+@pytest.mark.mutates_manager
 def test_cfy_manager_configure(image_based_manager, logger, test_config):
     logger.info('Putting code to get decrypted passwords on manager...')
     image_based_manager.put_remote_file_content(
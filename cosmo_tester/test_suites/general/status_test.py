@@ -1,7 +1,9 @@
+import pytest
 import retrying
 import requests
 
 
+@pytest.mark.mutates_manager
 def test_status(image_based_manager, logger):
     _check_status(image_based_manager, logger)
 
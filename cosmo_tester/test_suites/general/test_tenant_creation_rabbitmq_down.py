@@ -3,6 +3,7 @@ import pytest
 from cloudify_rest_client.exceptions import CloudifyClientError
 
 
+@pytest.mark.mutates_manager
 def test_tenant_creation_no_rabbitmq(image_based_manager):
     image_based_manager.run_command(
         'supervisorctl stop cloudify-rabbitmq', use_sudo=True)
@@ -1,8 +1,7 @@
-import time
 import pytest
 from copy import deepcopy
 
-from cosmo_tester.framework.test_hosts import Hosts, VM
+from cosmo_tester.framework.test_hosts import Hosts, VM, wait_for_bootstraps
 from cosmo_tester.framework.examples import get_example_deployment
 from cosmo_tester.test_suites.snapshots import (
     create_copy_and_restore_snapshot,
@@ -60,10 +59,9 @@ def prepare_managers(managers, logger):
 
         instance.bootstrap(blocking=False, upload_license=True)
 
-    for instance in managers:
-        logger.info('Waiting for bootstrap of {}'.format(instance.server_id))
-        while not instance.bootstrap_is_complete():
-            time.sleep(3)
+    logger.info('Waiting for bootstrap of {}'.format(
+        ', '.join(instance.server_id for instance in managers)))
+    wait_for_bootstraps(managers, logger=logger)
 
 
 @pytest.fixture(scope='function')
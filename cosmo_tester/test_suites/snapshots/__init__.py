@@ -8,12 +8,13 @@ from cloudify.snapshots import STATES
 from cloudify_rest_client.exceptions import UserUnauthorizedError
 
 from cosmo_tester.framework.constants import SUPPORTED_RELEASES
+from cosmo_tester.framework.parallel import run_parallel
 from cosmo_tester.framework.util import (
     assert_snapshot_created,
     ExecutionFailed,
     list_executions,
     list_snapshots,
-    set_client_tenant,
+    tenant_client,
     wait_for_execution,
 )
 
@@ -313,39 +314,39 @@ def verify_services_status(manager, logger):
 
 
 def get_manager_state(manager, tenants, logger):
-    tenant_state = {}
-    for tenant in tenants:
-        tenant_state[tenant] = {}
+    def _get_tenant_state(tenant):
+        client = tenant_client(manager.client, tenant)
+        state = {}
 
         logger.info('Getting plugin details for tenant %s', tenant)
-        with set_client_tenant(manager.client, tenant):
-            tenant_state[tenant]['plugins'] = sorted([
-                (
-                    item['package_name'],
-                    item['package_version'],
-                    item['distribution'],
-                )
-                for item in manager.client.plugins.list()
-            ])
+        state['plugins'] = sorted([
+            (
+                item['package_name'],
+                item['package_version'],
+                item['distribution'],
+            )
+            for item in client.plugins.list()
+        ])
 
         logger.info('Getting blueprints for tenant %s', tenant)
-        with set_client_tenant(manager.client, tenant):
-            tenant_state[tenant]['blueprints'] = sorted([
-                item['id'] for item in manager.client.blueprints.list()
-            ])
+        state['blueprints'] = sorted([
+            item['id'] for item in client.blueprints.list()
+        ])
 
         logger.info('Getting deployments for tenant %s', tenant)
-        with set_client_tenant(manager.client, tenant):
-            tenant_state[tenant]['deployments'] = sorted([
-                item['id'] for item in manager.client.deployments.list()
-            ])
+        state['deployments'] = sorted([
+            item['id'] for item in client.deployments.list()
+        ])
 
         logger.info('Getting secrets for tenant %s', tenant)
-        with set_client_tenant(manager.client, tenant):
-            tenant_state[tenant]['secrets'] = sorted([
-                item['key'] for item in manager.client.secrets.list()
-            ])
-    return tenant_state
+        state['secrets'] = sorted([
+            item['key'] for item in client.secrets.list()
+        ])
+        return state
+
+    results = run_parallel(_get_tenant_state, tenants, logger=logger,
+                           description='Getting tenant state')
+    return {result.target: result.result for result in results}
 
 
 def _log(message, logger, tenant=None):
@@ -12,14 +12,14 @@ from cosmo_tester.test_suites.snapshots import (
     create_copy_and_restore_snapshot,
     get_manager_state,
     prepare_credentials_tests,
-    set_client_tenant,
     SNAPSHOT_ID,
     stop_manager,
     update_credentials,
     upgrade_agents,
     verify_services_status,
 )
-from cosmo_tester.framework.util import get_resource_path
+from cosmo_tester.framework.parallel import run_parallel
+from cosmo_tester.framework.util import get_resource_path, tenant_client
 
 
 FROM_SOURCE_TENANT = 'from_source'
@@ -190,11 +190,15 @@ def prepare_old_manager_resources(manager, logger, ssh_key, test_config,
         manager.run_command('sudo cp {} {}'.format(
             tmp_path, agent_destination))
 
-    for tenant in INSTALL_TENANTS:
+    def _install(tenant):
         skip_validation = tenant == FROM_SOURCE_TENANT
         example_mappings[tenant].upload_and_verify_install(
             skip_plugins_validation=skip_validation,
         )
+
+    # Each example has its own tenant, so they can be installed at once
+    run_parallel(_install, INSTALL_TENANTS, logger=logger,
+                 description='Installing examples')
     example_mappings[NOINSTALL_TENANT].upload_blueprint()
     example_mappings[NOINSTALL_TENANT].create_deployment()
 
@@ -213,12 +217,13 @@ def create_tenant_secrets(manager, tenants, logger):
         :param logger: A logger to provide useful output.
     """
     logger.info('Creating secrets...')
-    for tenant in tenants:
-        with set_client_tenant(manager.client, tenant):
-            manager.client.secrets.create(
-                key=tenant,
-                value=tenant,
-            )
+    run_parallel(
+        lambda tenant: tenant_client(manager.client, tenant).secrets.create(
+            key=tenant,
+            value=tenant,
+        ),
+        tenants,
+    )
     logger.info('Secrets created.')
 
 
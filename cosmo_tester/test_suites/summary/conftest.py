@@ -4,10 +4,12 @@ import time
 import pytest
 
 from cloudify_rest_client.exceptions import CloudifyClientError
+from cosmo_tester.framework.parallel import run_parallel
 from cosmo_tester.framework.test_hosts import Hosts
 from cosmo_tester.framework.util import (
-    create_deployment,
-    set_client_tenant,
+    start_deployment_creation,
+    tenant_client,
+    wait_for_executions,
 )
 
 from . import DEPLOYMENTS_PER_SITE
@@ -82,31 +84,50 @@ def prepared_manager(request, ssh_key, session_tmpdir, test_config,
                 except CloudifyClientError:
                     time.sleep(2)
 
-        deployment_ids = []
-        for tenant in tenants:
-            with set_client_tenant(manager.client, tenant):
-                for blueprint, bp_path in BLUEPRINTS.items():
-                    manager.client.blueprints.upload(
-                        path=bp_path,
-                        entity_id=blueprint,
-                    )
+        def _populate_tenant(tenant):
+            client = tenant_client(manager.client, tenant)
+            tenant_deployment_ids = []
+            for blueprint, bp_path in BLUEPRINTS.items():
+                client.blueprints.upload(
+                    path=bp_path,
+                    entity_id=blueprint,
+                )
 
-                for bp_name, count in TENANT_DEPLOYMENT_COUNTS[tenant].items():
-                    for i in range(count):
-                        deployment_id = bp_name + str(i)
-                        create_deployment(
-                            manager.client, bp_name, deployment_id,
+            for bp_name, count in TENANT_DEPLOYMENT_COUNTS[tenant].items():
+                tenant_deployments = [
+                    bp_name + str(i) for i in range(count)
+                ]
+                wait_for_executions(
+                    client,
+                    [
+                        start_deployment_creation(
+                            client, bp_name, deployment_id,
                             session_logger,
                         )
-                        deployment_ids.append(deployment_id)
-                    manager.wait_for_all_executions()
-                    for i in range(count):
-                        deployment_id = bp_name + str(i)
-                        manager.client.executions.start(
+                        for deployment_id in tenant_deployments
+                    ],
+                    session_logger,
+                )
+                tenant_deployment_ids.extend(tenant_deployments)
+                wait_for_executions(
+                    client,
+                    [
+                        client.executions.start(
                             deployment_id,
                             'install',
                         )
-                    manager.wait_for_all_executions()
+                        for deployment_id in tenant_deployments
+                    ],
+                    session_logger,
+                )
+            return tenant_deployment_ids
+
+        # The tenants are independent, so they can be populated at once
+        deployment_ids = []
+        for result in run_parallel(_populate_tenant, tenants,
+                                   logger=session_logger,
+                                   description='Populating tenants'):
+            deployment_ids.extend(result.result)
 
         _create_sites(manager, deployment_ids)
         yield manager
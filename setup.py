@@ -27,6 +27,7 @@ setup(
         'fabric',
         'PyYAML',
         'requests>=2.7.0,<3.0.0',
+        'cryptography',
         'path.py',
         'retrying',
         'Jinja2',